@@ -0,0 +1,151 @@
+"""
+Admission control for the expensive endpoints.
+
+Each kind of work (OCR, verification, LLM) has its own gate: at most
+`max_concurrency` requests run at once, at most `max_queue` more wait for a
+slot, and none waits longer than `max_wait` seconds. Anything beyond that is
+turned away immediately with 429 and a Retry-After estimate, so an overload
+burst costs the server a rejection instead of a timeout for every request,
+and cheap work is never stuck behind OCR.
+"""
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from fastapi import HTTPException
+from starlette.responses import Response
+
+from . import config, metrics
+
+class AdmissionGate:
+    """Concurrency cap plus a bounded, time-limited wait queue"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queue_seconds = 0.0
+        # Exponentially weighted mean time a request holds a slot, for Retry-After
+        self.service_seconds = 1.0
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog has likely drained"""
+        backlog = (self.waiting + self.active) / self.max_concurrency
+        return min(60, max(1, math.ceil(backlog * self.service_seconds)))
+
+    def reject(self, reason: str):
+        raise HTTPException(
+            status_code=429,
+            detail=f"{self.name} is overloaded ({reason}), retry later",
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+    async def acquire(self) -> "Slot":
+        """Take a slot, waiting in the queue if there is room; 429 otherwise"""
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            self.reject("queue full")
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            self.reject(f"no slot within {self.max_wait:g}s")
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.admitted += 1
+        self.queue_seconds += time.perf_counter() - queued_at
+        return Slot(self)
+
+    def release(self, slot: "Slot"):
+        self.active -= 1
+        self.semaphore.release()
+        self.service_seconds = 0.8 * self.service_seconds + 0.2 * (time.perf_counter() - slot.started)
+
+    @asynccontextmanager
+    async def slot(self):
+        slot = await self.acquire()
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def stats(self) -> Dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "mean_queue_ms": round(self.queue_seconds / self.admitted * 1000, 1) if self.admitted else 0.0,
+        }
+
+class Slot:
+    """An admitted request's hold on its gate; release() is idempotent"""
+
+    def __init__(self, gate: AdmissionGate):
+        self.gate = gate
+        self.started = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.gate.release(self)
+
+class HeldResponse(Response):
+    """Sends a wrapped response (e.g. an event stream), then releases the slot, also if the client goes away"""
+
+    def __init__(self, response: Response, slot: Slot):
+        self.response = response
+        self.slot = slot
+        self.background = None
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.slot.release()
+        if self.background is not None:
+            await self.background()
+
+# One gate per kind of work
+ocr_gate = AdmissionGate("OCR", config.OCR_MAX_CONCURRENCY, config.OCR_MAX_QUEUE, config.OCR_MAX_WAIT)
+verify_gate = AdmissionGate("Verification", config.VERIFY_MAX_CONCURRENCY, config.VERIFY_MAX_QUEUE,
+                            config.VERIFY_MAX_WAIT)
+llm_gate = AdmissionGate("LLM", config.LLM_MAX_CONCURRENCY, config.LLM_MAX_QUEUE, config.LLM_MAX_WAIT)
+
+def admission_stats() -> Dict:
+    return {gate.name.lower(): gate.stats() for gate in (ocr_gate, verify_gate, llm_gate)}
+
+def admission_samples():
+    samples = []
+    for gate in (ocr_gate, verify_gate, llm_gate):
+        labels = {"gate": gate.name.lower()}
+        samples += [
+            ("medsafe_admission_in_flight", "gauge", "Requests holding a slot", labels, gate.active),
+            ("medsafe_admission_queue_depth", "gauge", "Requests waiting for a slot", labels, gate.waiting),
+            ("medsafe_admission_admitted_total", "counter", "Requests admitted", labels, gate.admitted),
+            ("medsafe_admission_rejected_total", "counter", "Requests rejected with 429, queue full", labels,
+             gate.rejected),
+            ("medsafe_admission_timed_out_total", "counter", "Requests rejected with 429 after max_wait", labels,
+             gate.timed_out),
+            ("medsafe_admission_queue_seconds_total", "counter", "Time admitted requests spent waiting", labels,
+             gate.queue_seconds),
+        ]
+    return samples
+
+metrics.register_collector(admission_samples)
@@ -0,0 +1,177 @@
+"""
+Response cache for Granite advice.
+
+With greedy decoding the advice is a pure function of the prompt, so it is
+keyed on the model, its CPU precision, the generation length, the
+canonicalized prescription text and the patient's age band (the prompt
+itself only sees the band).
+Entries live in a size-bounded in-memory LRU, optionally backed by a local
+SQLite file so the cache survives restarts and is shared between API workers.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from . import config, metrics
+
+logger = logging.getLogger(__name__)
+
+# (upper age bound, exclusive; label) — dosing guidance changes at these boundaries
+AGE_BANDS = [
+    (2, "infant (under 2 years)"),
+    (12, "child (2-11 years)"),
+    (18, "adolescent (12-17 years)"),
+    (65, "adult (18-64 years)"),
+    (None, "older adult (65 years and over)"),
+]
+
+def age_band(age: int) -> str:
+    for upper, label in AGE_BANDS:
+        if upper is None or age < upper:
+            return label
+
+def canonicalize_prescription(text: str) -> str:
+    """
+    Normalize formatting that does not change meaning, within each line: case,
+    whitespace, "100mg" vs "100 mg" and trailing punctuation. Lines keep their
+    order and content, so a frequency stays with its drug.
+    """
+    text = re.sub(r"(\d)\s*(mg|mcg|g|ml|units?)\b", r"\1 \2", text.lower())
+    lines = (re.sub(r"\s+([,;])", r"\1", re.sub(r"\s+", " ", line)).strip(" .,;") for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+def cache_enabled() -> bool:
+    """Sampled advice is not reproducible, so caching requires deterministic decoding"""
+    return config.GRANITE_DETERMINISTIC and config.ADVICE_CACHE_SIZE > 0
+
+class AdviceCache:
+    """LRU of advice results with hit/miss counters and an optional SQLite store"""
+
+    def __init__(self, max_entries: Optional[int] = None, path: Optional[str] = None,
+                 max_stored: Optional[int] = None):
+        self.max_entries = config.ADVICE_CACHE_SIZE if max_entries is None else max_entries
+        self.max_stored = max_stored or config.ADVICE_CACHE_DB_SIZE
+        self.path = config.ADVICE_CACHE_PATH if path is None else path
+        self.entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_pid: Optional[int] = None
+        self.stored = 0  # rows in the store, as far as this process knows
+
+    def store(self) -> Optional[sqlite3.Connection]:
+        """
+        This process's connection to the SQLite store, opened on first use:
+        a connection must not be carried across fork into the API workers.
+        Caller holds the lock.
+        """
+        if not self.path:
+            return None
+        if self.db is None or self.db_pid != os.getpid():
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS advice (key TEXT PRIMARY KEY, result TEXT, used REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS advice_used ON advice (used)")
+            self.db.commit()
+            self.db_pid = os.getpid()
+            self.stored = self.db.execute("SELECT COUNT(*) FROM advice").fetchone()[0]
+        return self.db
+
+    @staticmethod
+    def key(model: str, prescription_text: str, patient_age: int) -> str:
+        return "|".join([model, config.GRANITE_CPU_PRECISION, str(config.GRANITE_MAX_NEW_TOKENS),
+                         age_band(patient_age), canonicalize_prescription(prescription_text)])
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result
+            db = self.store()
+            if db is not None:
+                row = db.execute("SELECT result FROM advice WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    db.execute("UPDATE advice SET used = ? WHERE key = ?", (time.time(), key))
+                    db.commit()
+                    result = json.loads(row[0])
+                    self.remember(key, result)
+                    self.hits += 1
+                    self.store_hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def put(self, key: str, result: Dict):
+        """Cache a successful result (failures are never cached)"""
+        if not result.get("success"):
+            return
+        with self.lock:
+            self.remember(key, result)
+            db = self.store()
+            if db is not None:
+                row = (key, json.dumps(result), time.time())
+                if db.execute("INSERT OR IGNORE INTO advice (key, result, used) VALUES (?, ?, ?)", row).rowcount:
+                    self.stored += 1
+                else:
+                    db.execute("UPDATE advice SET result = ?, used = ? WHERE key = ?", row[1:] + row[:1])
+                if self.stored > self.max_stored:
+                    self.evict(db)
+                db.commit()
+
+    def evict(self, db: sqlite3.Connection):
+        """
+        Keep the store bounded: drop the least recently used rows over max_stored.
+        The row count is tracked per process, so it is recounted here to include
+        rows other API workers added. Caller holds the lock.
+        """
+        self.stored = db.execute("SELECT COUNT(*) FROM advice").fetchone()[0]
+        excess = self.stored - self.max_stored
+        if excess > 0:
+            db.execute("DELETE FROM advice WHERE key IN (SELECT key FROM advice ORDER BY used LIMIT ?)", (excess,))
+            self.stored -= excess
+
+    def remember(self, key: str, result: Dict):
+        """Insert into the in-memory LRU; caller holds the lock"""
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": cache_enabled(),
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "persistent": bool(self.path),
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+# Global instance
+advice_cache = AdviceCache()
+
+def advice_cache_samples():
+    stats = advice_cache.stats()
+    return [
+        ("medsafe_advice_cache_hits_total", "counter", "Advice served from the cache", {}, stats["hits"]),
+        ("medsafe_advice_cache_store_hits_total", "counter", "Cache hits served from the SQLite store", {},
+         stats["store_hits"]),
+        ("medsafe_advice_cache_misses_total", "counter", "Advice cache lookups that missed", {}, stats["misses"]),
+        ("medsafe_advice_cache_entries", "gauge", "Entries in the in-memory advice cache", {}, stats["entries"]),
+    ]
+
+metrics.register_collector(advice_cache_samples)
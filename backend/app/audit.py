@@ -0,0 +1,265 @@
+"""
+Audit log of every verification, in a local SQLite database.
+
+Enabled by AUDIT_DB. Each verification (/verify, /assess, the streamed and
+session variants, /analyze-image) leaves one row: when, which endpoint
+family, a SHA-256 of its input (listed drugs, prescription text and patient;
+for images the OCR text, as the upload itself is not kept), whether it was
+safe, the extracted drugs, the interaction and dosage alerts, the total and
+per-stage latencies and the trace id when tracing is on.
+
+The request only pays for an enqueue: record() puts references to the
+inputs and the finished verdict on a bounded in-memory queue, and a
+background thread (one per API worker process) does the hashing and JSON
+encoding and inserts the rows in batches, one transaction per batch, into
+the database in WAL mode, so several API workers can write to one file while
+readers query it. When AUDIT_QUEUE_SIZE records are waiting (the disk cannot
+keep up), AUDIT_OVERFLOW decides: "drop" (default) drops the new record,
+"block" makes the request wait up to AUDIT_MAX_WAIT seconds for room before
+dropping it (not on the event loop, where waiting would stall every request:
+/analyze-image records with block=False and drops). Dropped and failed records are counted in /metrics. The API
+flushes the queue on shutdown.
+
+    sqlite3 audit.db "SELECT datetime(created, 'unixepoch'), source, is_safe, total_ms FROM verifications"
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+from . import config, metrics, tracing
+from .records import VerificationRecord, drug_dict
+
+logger = logging.getLogger(__name__)
+
+enabled = bool(config.AUDIT_DB)
+
+OVERFLOW_POLICIES = ("drop", "block")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verifications (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    source TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    is_safe INTEGER NOT NULL,
+    drugs TEXT NOT NULL,
+    interactions TEXT NOT NULL,
+    dosage_alerts TEXT NOT NULL,
+    total_ms REAL,
+    stages TEXT,
+    trace_id TEXT,
+    pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS verifications_created ON verifications (created);
+CREATE INDEX IF NOT EXISTS verifications_input_hash ON verifications (input_hash);
+"""
+
+class Entry(NamedTuple):
+    """What the request hands over: references only, encoded by the writer thread"""
+    created: float
+    source: str
+    drugs: List
+    text: Optional[str]
+    patient: object
+    verification: object
+    total_ms: Optional[float]
+    stages: Optional[Dict[str, float]]
+    trace_id: Optional[str]
+
+def input_hash(drugs, text: Optional[str], patient) -> str:
+    """SHA-256 of the verification input, independent of JSON key order and drug model type"""
+    canonical = json.dumps({
+        "drugs": [drug_dict(drug) for drug in drugs],
+        "text": text or "",
+        "patient": {
+            "age": patient.age,
+            "weight_kg": patient.weight_kg,
+            "conditions": sorted(patient.conditions),
+            "allergies": sorted(patient.allergies),
+        },
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def row(entry: Entry) -> tuple:
+    if isinstance(entry.verification, VerificationRecord):
+        verdict = entry.verification.to_dict()
+    else:
+        verdict = jsonable_encoder(entry.verification)
+    return (
+        entry.created,
+        entry.source,
+        input_hash(entry.drugs, entry.text, entry.patient),
+        int(verdict["is_safe"]),
+        json.dumps(verdict["extracted_drugs"]),
+        json.dumps(verdict["interactions"]),
+        json.dumps(verdict["dosage_alerts"]),
+        entry.total_ms,
+        json.dumps(entry.stages) if entry.stages is not None else None,
+        entry.trace_id,
+        os.getpid(),
+    )
+
+class AuditLog:
+    """Bounded queue of audit entries, written to SQLite in batches from a background thread"""
+
+    def __init__(self, path: str, max_queue: int = 10000, batch_size: int = 500, interval: float = 1.0,
+                 overflow: str = "drop", max_wait: float = 1.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"AUDIT_OVERFLOW must be one of {', '.join(OVERFLOW_POLICIES)}, not {overflow!r}")
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.overflow = overflow
+        self.max_wait = max_wait
+        self.queue: "queue.Queue[Entry]" = queue.Queue(max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def record(self, entry: Entry, block: bool = True):
+        """Queue `entry`; block=False never waits for room, whatever AUDIT_OVERFLOW says"""
+        self.ensure_started()
+        try:
+            if block and self.overflow == "block":
+                self.queue.put(entry, timeout=self.max_wait)
+            else:
+                self.queue.put_nowait(entry)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                if self.dropped & (self.dropped - 1) == 0:  # 1, 2, 4, 8, ...: not once per request
+                    logger.warning(f"Audit queue full: {self.dropped} records dropped so far")
+
+    def ensure_started(self):
+        # Started lazily in the process that records, so a forked API worker gets its own thread
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    threading.Thread(target=self.run, name="audit-writer", daemon=True).start()
+                    atexit.register(self.flush)
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL only syncs at checkpoints; a power loss can lose the last batches
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        db.executescript(SCHEMA)
+        return db
+
+    def run(self):
+        db = None
+        while True:
+            item = self.queue.get()
+            batch, flushed = [], None
+            deadline = time.monotonic() + self.interval
+            while True:
+                if isinstance(item, threading.Event):
+                    flushed = item
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    db = db or self.connect()
+                    self.write(db, batch)
+                except Exception as e:
+                    self.failed += len(batch)
+                    logger.warning(f"Could not write {len(batch)} audit records to {self.path}: {e}")
+                    if db is not None:
+                        db.close()
+                        db = None
+            if flushed is not None:
+                flushed.set()
+
+    def write(self, db: sqlite3.Connection, batch: List[Entry]):
+        rows = [row(entry) for entry in batch]
+        with db:
+            db.executemany(
+                "INSERT INTO verifications (created, source, input_hash, is_safe, drugs, interactions, "
+                "dosage_alerts, total_ms, stages, trace_id, pid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        self.written += len(rows)
+
+    def flush(self, timeout: float = 5.0):
+        """Write everything recorded so far (at shutdown)"""
+        if self.pid != os.getpid():
+            return
+        flushed = threading.Event()
+        try:
+            self.queue.put(flushed, timeout=timeout)
+        except queue.Full:
+            return
+        flushed.wait(timeout)
+
+    def stats(self) -> Dict:
+        return {"written": self.written, "dropped": self.dropped, "failed": self.failed,
+                "queued": self.queue.qsize()}
+
+audit_log = AuditLog(
+    config.AUDIT_DB, config.AUDIT_QUEUE_SIZE, config.AUDIT_BATCH_SIZE, config.AUDIT_FLUSH_INTERVAL,
+    config.AUDIT_OVERFLOW, config.AUDIT_MAX_WAIT,
+) if enabled else None
+
+def collect(on_stage=None):
+    """
+    A stage callback that sums each stage's latency into a dict (OCR passes per
+    PSM, as they run concurrently) and passes the event on to `on_stage`;
+    returns (dict, callback)
+    """
+    stages: Dict[str, float] = {}
+
+    def collecting(name, elapsed_ms, **info):
+        key = f"{name}:{info['psm']}" if "psm" in info else name
+        stages[key] = round(stages.get(key, 0.0) + elapsed_ms, 1)
+        if on_stage is not None:
+            on_stage(name, elapsed_ms=elapsed_ms, **info)
+
+    return stages, collecting
+
+def record(source: str, drugs, text: Optional[str], patient, verification, started: Optional[float] = None,
+           stages: Optional[Dict[str, float]] = None, block: bool = True):
+    """
+    Queue the audit record of a finished verification; `started` is its time.perf_counter() start.
+    Callers on the event loop pass block=False: a full queue drops the record instead of waiting.
+    """
+    total_ms = round((time.perf_counter() - started) * 1000, 1) if started is not None else None
+    context = tracing.current.get() if tracing.enabled else None
+    audit_log.record(Entry(time.time(), source, list(drugs), text, patient, verification, total_ms, stages,
+                           context.trace_id if context is not None else None), block)
+
+def flush():
+    if audit_log is not None:
+        audit_log.flush()
+
+def audit_samples():
+    stats = audit_log.stats()
+    return [
+        ("medsafe_audit_written_total", "counter", "Verification audit records written to AUDIT_DB", {},
+         stats["written"]),
+        ("medsafe_audit_dropped_total", "counter", "Audit records dropped because the queue was full", {},
+         stats["dropped"]),
+        ("medsafe_audit_failed_total", "counter", "Audit records lost to database errors", {}, stats["failed"]),
+        ("medsafe_audit_queue_depth", "gauge", "Audit records waiting to be written", {}, stats["queued"]),
+    ]
+
+if audit_log is not None:
+    metrics.register_collector(audit_samples)
@@ -0,0 +1,368 @@
+"""
+Offline bulk processing of prescription archives, without the API.
+
+    python -m app.bulk INPUT --out results.jsonl [--workers N] [--format jsonl|parquet]
+
+INPUT is a directory, walked recursively for images (.png, .jpg, .jpeg,
+.tif, .tiff, .bmp, .webp) and .txt prescriptions, or a JSONL manifest such as
+benchmarks.corpus writes: one {"id", "text" and/or "image" (relative to the
+manifest), "patient"} object per line. Images go through OCR
+(OCRProcessor), then drug extraction, the rule checks and triage, like
+/analyze-image; text skips OCR. Items without a patient use --age.
+
+Items fan out over a pool of worker processes (default: one per core). Each
+worker imports the OCR stack once and runs its Tesseract passes one after
+another with single-threaded OpenCV and Tesseract, so a worker keeps one
+core busy and throughput grows with --workers up to the core count. The
+parent hands out a bounded number of items at a time and only ever holds
+the results of the current batch. When a worker dies mid-item (a crash in
+Tesseract or OpenCV) the run continues on a new pool: the items that were
+in flight are run again one at a time, so only the one that crashes it is
+recorded as an error.
+
+Results are written in batches of --batch-size, each flushed and fsynced
+before the next: appended lines for jsonl (the full verdict per item), or
+one part-NNNNN.parquet file per batch in the --out directory for parquet
+(flat columns, alerts as JSON strings; needs pyarrow). The output is also
+the checkpoint: a rerun with the same --out skips every item already in it
+without an error, so a crashed or interrupted run resumes where its last
+batch ended (a torn last jsonl line is cut off, an unfinished parquet part
+was never renamed into place) and failed items are tried again; their new
+row comes after the failed one. Progress with files/sec goes to stderr.
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterator, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp"}
+TEXT_EXTENSIONS = {".txt"}
+FORMATS = ("jsonl", "parquet")
+
+# Inputs
+
+def walk(directory: str) -> Iterator[Dict]:
+    """Items for the images and text files under `directory`, ids relative to it"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            extension = os.path.splitext(name)[1].lower()
+            if extension not in IMAGE_EXTENSIONS | TEXT_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            kind = "image" if extension in IMAGE_EXTENSIONS else "text"
+            yield {"id": os.path.relpath(path, directory), "kind": kind, "path": path}
+
+def read_manifest(path: str, prefer: str = "image") -> Iterator[Dict]:
+    """Items for the lines of a JSONL manifest; records with both an image and text use `prefer`"""
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            item = {"id": str(record.get("id", number)), "patient": record.get("patient")}
+            if record.get("image") and (prefer == "image" or not record.get("text")):
+                item.update(kind="image", path=os.path.join(base, record["image"]))
+            elif record.get("text") is not None:
+                item.update(kind="text", text=record["text"])
+            else:
+                raise SystemExit(f"{path}:{number}: a manifest record needs an image or text")
+            yield item
+
+def items(source: str, prefer: str = "image") -> Iterator[Dict]:
+    if os.path.isdir(source):
+        return walk(source)
+    return read_manifest(source, prefer)
+
+# Workers
+
+def init_worker():
+    """Import the OCR stack once per worker and keep each worker on one core"""
+    os.environ["OMP_THREAD_LIMIT"] = "1"  # read by each Tesseract subprocess
+    from concurrent.futures import ThreadPoolExecutor
+    import cv2
+    from .ocr_processor import ocr_processor
+
+    cv2.setNumThreads(1)
+    # The pool is the parallelism here: run the PSM passes one after another
+    ocr_processor.executor.shutdown()
+    ocr_processor.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr-psm")
+
+def blank_result(item: Dict) -> Dict:
+    return {"id": item["id"], "kind": item["kind"], "source": item.get("path"), "text": None,
+            "ocr_confidence": None, "verification": None, "triage": None, "stages": {}, "error": None}
+
+def failed_result(item: Dict, error: BaseException) -> Dict:
+    """The result of an item whose worker failed it (e.g. died while processing it)"""
+    result = blank_result(item)
+    result.update(error=f"{type(error).__name__}: {error}", seconds=None)
+    return result
+
+def process(item: Dict, default_age: int) -> Dict:
+    """OCR (for images), verify and triage one item; failures are reported in "error" """
+    from fastapi.encoders import jsonable_encoder
+    from .models import Patient
+    from .ocr_processor import ocr_processor
+    from .pipeline import verify_prescription
+    from .records import RECORD_TYPES
+    from .triage import triage
+
+    started = time.perf_counter()
+    stages: Dict[str, float] = {}
+
+    def on_stage(name, elapsed_ms, **info):
+        stages[name] = round(stages.get(name, 0.0) + elapsed_ms, 1)
+
+    result = blank_result(item)
+    result["stages"] = stages
+    try:
+        patient = Patient(**(item.get("patient") or {"age": default_age}))
+        if item["kind"] == "image":
+            with open(item["path"], "rb") as f:
+                # Not extract_text_with_confidence: it turns an unreadable image into "" (and a safe verdict)
+                text, confidence = ocr_processor.extract(f, on_stage)
+            if not text.strip():
+                raise ValueError("No text found in the image")
+        elif "text" in item:
+            text, confidence = item["text"], None
+        else:
+            with open(item["path"], encoding="utf-8", errors="replace") as f:
+                text, confidence = f.read(), None
+        verification = verify_prescription([], text, patient, on_stage, RECORD_TYPES)
+        result.update(
+            text=text,
+            ocr_confidence=confidence,
+            verification=verification.to_dict(),
+            triage=jsonable_encoder(triage(verification, confidence, on_stage)),
+        )
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    return result
+
+# Outputs, which double as the checkpoint
+
+class JSONLWriter:
+    """Appends one JSON line per result; the ids already in the file without an error are done"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = self.recover()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def recover(self) -> Set[str]:
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, "rb+") as f:
+            end = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn by a crash mid-write
+                result = json.loads(line)
+                if result["error"] is None:
+                    done.add(result["id"])
+                end += len(line)
+            if f.seek(0, os.SEEK_END) != end:
+                logger.warning(f"Cutting a partial last line off {self.path}")
+                f.truncate(end)
+        return done
+
+    def write(self, results: List[Dict]):
+        self.file.write("".join(json.dumps(result) + "\n" for result in results))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter:
+    """Writes each batch as its own part file in a directory; the ids in finished parts without an error are done"""
+
+    def __init__(self, directory: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("--format parquet needs pyarrow (pip install pyarrow)")
+        self.pa, self.pq = pa, pq
+        self.schema = pa.schema([
+            ("id", pa.string()), ("kind", pa.string()), ("source", pa.string()), ("text", pa.string()),
+            ("ocr_confidence", pa.float64()), ("is_safe", pa.bool_()), ("needs_advice", pa.bool_()),
+            ("drugs", pa.string()), ("interactions", pa.string()), ("dosage_alerts", pa.string()),
+            ("alternatives", pa.string()), ("triage_reasons", pa.string()), ("stages", pa.string()),
+            ("seconds", pa.float64()), ("error", pa.string()),
+        ])
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        for leftover in glob.glob(os.path.join(directory, "*.parquet.tmp")):
+            os.remove(leftover)
+        parts = sorted(glob.glob(os.path.join(directory, "part-*.parquet")))
+        self.done = set()
+        for part in parts:
+            table = pq.read_table(part, columns=["id", "error"]).to_pydict()
+            self.done.update(item_id for item_id, error in zip(table["id"], table["error"]) if error is None)
+        self.next_part = len(parts)
+
+    def row(self, result: Dict) -> Dict:
+        verification = result["verification"] or {}
+        decision = result["triage"] or {}
+        as_json = lambda value: None if value is None else json.dumps(value)
+        return {
+            "id": result["id"], "kind": result["kind"], "source": result["source"], "text": result["text"],
+            "ocr_confidence": result["ocr_confidence"], "is_safe": verification.get("is_safe"),
+            "needs_advice": decision.get("needs_advice"), "drugs": as_json(verification.get("extracted_drugs")),
+            "interactions": as_json(verification.get("interactions")),
+            "dosage_alerts": as_json(verification.get("dosage_alerts")),
+            "alternatives": as_json(verification.get("alternatives")),
+            "triage_reasons": as_json(decision.get("reasons")), "stages": json.dumps(result["stages"]),
+            "seconds": result["seconds"], "error": result["error"],
+        }
+
+    def write(self, results: List[Dict]):
+        path = os.path.join(self.directory, f"part-{self.next_part:05d}.parquet")
+        table = self.pa.Table.from_pylist([self.row(result) for result in results], schema=self.schema)
+        self.pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.next_part += 1
+
+    def close(self):
+        pass
+
+# Running
+
+class Progress:
+    """files/sec and an ETA on stderr, at most once per `interval` seconds"""
+
+    def __init__(self, total: Optional[int], skipped: int, interval: float = 1.0):
+        self.total, self.skipped, self.interval = total, skipped, interval
+        self.started = self.last = time.monotonic()
+        self.done = self.errors = 0
+        self.tty = sys.stderr.isatty()
+
+    def update(self, result: Dict, force: bool = False):
+        if result is not None:
+            self.done += 1
+            self.errors += result["error"] is not None
+        now = time.monotonic()
+        if not force and now - self.last < (self.interval if self.tty else 10 * self.interval):
+            return
+        self.last = now
+        rate = self.done / max(now - self.started, 1e-9)
+        line = f"{self.done} done"
+        if self.total is not None:
+            remaining = self.total - self.done
+            line = f"{self.done}/{self.total} done, ETA {remaining / rate:.0f}s" if rate else f"0/{self.total} done"
+        line += f", {rate:.1f} files/s, {self.errors} errors" + (f", {self.skipped} skipped" if self.skipped else "")
+        print(("\r" + line) if self.tty else line, end="" if self.tty and not force else "\n", file=sys.stderr,
+              flush=True)
+
+def start_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker)
+
+def run(source: str, out: str, output_format: str = "jsonl", workers: Optional[int] = None, batch_size: int = 100,
+        default_age: int = 40, prefer: str = "image") -> Dict:
+    """Process every item of `source` not yet in `out`; returns counts and the elapsed time"""
+    writer = ParquetWriter(out) if output_format == "parquet" else JSONLWriter(out)
+    todo = [item for item in items(source, prefer) if item["id"] not in writer.done]
+    skipped = len(writer.done)
+    workers = max(1, workers or os.cpu_count() or 1)
+    progress = Progress(len(todo), skipped)
+    batch: List[Dict] = []
+    # Enough work queued to keep every worker busy, without submitting the whole archive up front
+    window = 4 * workers
+    pending: Dict[Future, Dict] = {}
+    # In flight when a worker died: run again one at a time, so a crash names its item
+    suspects: List[Dict] = []
+    queue = iter(todo)
+    pool = start_pool(workers)
+    try:
+        while True:
+            if suspects:
+                if not pending:
+                    item = suspects.pop()
+                    pending[pool.submit(process, item, default_age)] = item
+            else:
+                for item in queue:
+                    pending[pool.submit(process, item, default_age)] = item
+                    if len(pending) >= window:
+                        break
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in finished):
+                # A worker died (e.g. a crash in Tesseract): every future still in flight fails with
+                # it, so collect them all, including those that completed before the crash
+                wait(pending)
+                finished = list(pending)
+            crashed = []
+            for future in finished:
+                item = pending.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    crashed.append((item, e))
+                    continue
+                except Exception as e:
+                    result = failed_result(item, e)
+                batch.append(result)
+                progress.update(result)
+            if crashed:
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = start_pool(workers)
+                if len(crashed) == 1:
+                    item, error = crashed[0]
+                    logger.warning(f"A bulk worker died while processing {item['id']}; restarting the pool")
+                    result = failed_result(item, error)
+                    batch.append(result)
+                    progress.update(result)
+                else:
+                    logger.warning(f"A bulk worker died with {len(crashed)} items in flight; restarting the "
+                                   f"pool and running them again one at a time")
+                    suspects.extend(item for item, _ in crashed)
+            if len(batch) >= batch_size:
+                writer.write(batch)
+                batch = []
+    finally:
+        pool.shutdown(cancel_futures=True)
+        try:
+            # Also when interrupted: the finished results are checkpointed, not processed again
+            if batch:
+                writer.write(batch)
+        finally:
+            writer.close()
+    if todo:
+        progress.update(None, force=True)
+    elapsed = time.monotonic() - progress.started
+    return {"processed": progress.done, "errors": progress.errors, "skipped": skipped, "seconds": elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR, verify and triage a directory or manifest of prescriptions")
+    parser.add_argument("input", help="directory of images/.txt files, or a JSONL manifest")
+    parser.add_argument("--out", required=True, help="jsonl: results file; parquet: directory of part files")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (default: one per core)")
+    parser.add_argument("--batch-size", type=int, default=100, help="results written (and checkpointed) together")
+    parser.add_argument("--age", type=int, default=40, help="patient age for items without a patient")
+    parser.add_argument("--prefer", choices=["image", "text"], default="image",
+                        help="manifest records with both: OCR the image or verify the text")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    summary = run(args.input, args.out, args.format, args.workers, args.batch_size, args.age, args.prefer)
+    rate = summary["processed"] / summary["seconds"] if summary["seconds"] else 0.0
+    print(f"Processed {summary['processed']} items in {summary['seconds']:.1f}s ({rate:.1f} files/s), "
+          f"{summary['errors']} errors, {summary['skipped']} already done; results in {args.out}")
+
+if __name__ == "__main__":
+    main()
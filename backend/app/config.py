@@ -0,0 +1,112 @@
+"""Runtime settings, read from the environment (and a .env file when python-dotenv is installed)."""
+import os
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+def env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+# Granite model: Hugging Face model id or a local directory
+GRANITE_MODEL = os.getenv("GRANITE_MODEL", "ibm-granite/granite-3.3-2b-instruct")
+# Load and warm up the model in the background when an API worker serving the llm role starts
+# (otherwise the first advice request starts loading it)
+GRANITE_PRELOAD = env_flag("GRANITE_PRELOAD", False)
+# How long an advice request waits for the model to become ready; 0 rejects immediately
+GRANITE_READY_TIMEOUT = env_float("GRANITE_READY_TIMEOUT", 0.0)
+# Upper bound on tokens generated per advice request
+GRANITE_MAX_NEW_TOKENS = env_int("GRANITE_MAX_NEW_TOKENS", 300)
+# Dynamic batching: concurrent advice requests are gathered for up to
+# GRANITE_BATCH_WAIT_MS (or until GRANITE_MAX_BATCH_SIZE) and generated together
+GRANITE_MAX_BATCH_SIZE = env_int("GRANITE_MAX_BATCH_SIZE", 4)
+GRANITE_BATCH_WAIT_MS = env_float("GRANITE_BATCH_WAIT_MS", 20.0)
+# Reuse the KV state of the constant prompt instructions instead of prefilling them per request
+GRANITE_PREFIX_CACHE = env_flag("GRANITE_PREFIX_CACHE", True)
+# CPU weight precision: fp32, bf16 (needs avx512_bf16/amx_bf16) or int8 (dynamic quantization of Linear layers)
+GRANITE_CPU_PRECISION = os.getenv("GRANITE_CPU_PRECISION", "fp32").strip().lower()
+# Dedicated inference worker processes (0 = generate inside the API process)
+GRANITE_WORKERS = env_int("GRANITE_WORKERS", 0)
+# torch threads per worker (0 = split the available cores evenly) and whether to pin workers to cores
+GRANITE_THREADS_PER_WORKER = env_int("GRANITE_THREADS_PER_WORKER", 0)
+GRANITE_PIN_CORES = env_flag("GRANITE_PIN_CORES", True)
+# Greedy decoding: identical prompts give identical advice (required for the advice cache)
+GRANITE_DETERMINISTIC = env_flag("GRANITE_DETERMINISTIC", True)
+# Advice response cache: in-memory LRU entries (0 disables) and an optional SQLite file
+# that persists entries across restarts, bounded to ADVICE_CACHE_DB_SIZE rows
+ADVICE_CACHE_SIZE = env_int("ADVICE_CACHE_SIZE", 1024)
+ADVICE_CACHE_PATH = os.getenv("ADVICE_CACHE_PATH", "")
+ADVICE_CACHE_DB_SIZE = env_int("ADVICE_CACHE_DB_SIZE", 100000)
+# Triage: OCR text whose mean word confidence is below this (0-100) is sent to Granite for review
+TRIAGE_MIN_OCR_CONFIDENCE = env_float("TRIAGE_MIN_OCR_CONFIDENCE", 60.0)
+# Image uploads: request body cap, and decoded-size limits checked from the image header
+MAX_UPLOAD_BYTES = env_int("MAX_UPLOAD_BYTES", 10 * 1024 * 1024)
+MAX_IMAGE_PIXELS = env_int("MAX_IMAGE_PIXELS", 24_000_000)
+MAX_IMAGE_SIDE = env_int("MAX_IMAGE_SIDE", 10000)
+# Admission control: concurrent requests, queued requests and max queue wait (seconds) per kind of work.
+# The limits apply per API worker process (API_WORKERS, see app.serve), so the CPU-based defaults
+# use each worker's share of the cores. Each OCR request runs 4 Tesseract processes, so by default
+# one runs per 4 cores.
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+API_WORKERS = max(1, env_int("API_WORKERS", 1))
+WORKER_CPUS = max(1, CPU_COUNT // API_WORKERS)
+OCR_MAX_CONCURRENCY = env_int("OCR_MAX_CONCURRENCY", max(1, WORKER_CPUS // 4))
+OCR_MAX_QUEUE = env_int("OCR_MAX_QUEUE", 8)
+OCR_MAX_WAIT = env_float("OCR_MAX_WAIT", 10.0)
+VERIFY_MAX_CONCURRENCY = env_int("VERIFY_MAX_CONCURRENCY", 2 * WORKER_CPUS)
+VERIFY_MAX_QUEUE = env_int("VERIFY_MAX_QUEUE", 64)
+VERIFY_MAX_WAIT = env_float("VERIFY_MAX_WAIT", 2.0)
+LLM_MAX_CONCURRENCY = env_int("LLM_MAX_CONCURRENCY", GRANITE_MAX_BATCH_SIZE * max(1, GRANITE_WORKERS))
+LLM_MAX_QUEUE = env_int("LLM_MAX_QUEUE", 16)
+LLM_MAX_WAIT = env_float("LLM_MAX_WAIT", 30.0)
+# What this worker serves: comma-separated subset of verify, ocr, llm (or all). Endpoints of other
+# roles answer 404, and their heavy dependencies (OpenCV/Tesseract, torch/transformers) are never imported.
+APP_ROLES = {"verify", "ocr", "llm"}
+APP_ROLE = {role.strip().lower() for role in os.getenv("APP_ROLE", "all").split(",") if role.strip()}
+if "all" in APP_ROLE:
+    APP_ROLE = set(APP_ROLES)
+# Import and initialize the OCR stack in the background at startup (OCR roles only)
+OCR_PRELOAD = env_flag("OCR_PRELOAD", True)
+# Run OCR in this many worker processes (0 = threads in the API process). Uploads are handed to
+# them through a pool of shared-memory buffers of MAX_UPLOAD_BYTES each (0 = two per worker).
+OCR_WORKERS = env_int("OCR_WORKERS", 0)
+OCR_BUFFERS = env_int("OCR_BUFFERS", 0)
+# Where API workers publish metrics snapshots for /metrics to merge; set by app.serve for several workers
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+# Per-request profiling: requests with an X-Profile-Token header equal to PROFILE_TOKEN are profiled
+# (see app.profiling); empty disables it. Artifacts go to PROFILE_DIR, of which the newest
+# PROFILE_KEEP profiles are kept; the sampling profiler samples every PROFILE_INTERVAL_MS.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = env_int("PROFILE_KEEP", 50)
+PROFILE_INTERVAL_MS = env_float("PROFILE_INTERVAL_MS", 1.0)
+# Tracing: spans of each request and its pipeline stages are appended to TRACE_FILE as OTLP/JSON
+# lines (see app.tracing); empty disables it. TRACE_SAMPLE_RATE is the share of requests traced
+# when the caller did not decide it with a traceparent header.
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE_RATE = env_float("TRACE_SAMPLE_RATE", 1.0)
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "medsafe-api")
+# Audit log: every verification is recorded in this SQLite database (see app.audit); empty disables it.
+# A background thread writes batches of up to AUDIT_BATCH_SIZE at least every AUDIT_FLUSH_INTERVAL
+# seconds. At most AUDIT_QUEUE_SIZE records wait in memory; beyond that AUDIT_OVERFLOW=drop drops new
+# records, block makes the request wait up to AUDIT_MAX_WAIT seconds for room first.
+AUDIT_DB = os.getenv("AUDIT_DB", "")
+AUDIT_QUEUE_SIZE = env_int("AUDIT_QUEUE_SIZE", 10000)
+AUDIT_BATCH_SIZE = env_int("AUDIT_BATCH_SIZE", 500)
+AUDIT_FLUSH_INTERVAL = env_float("AUDIT_FLUSH_INTERVAL", 1.0)
+AUDIT_OVERFLOW = os.getenv("AUDIT_OVERFLOW", "drop").strip().lower()
+AUDIT_MAX_WAIT = env_float("AUDIT_MAX_WAIT", 1.0)
+
+def serves(role: str) -> bool:
+    return role in APP_ROLE
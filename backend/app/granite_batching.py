@@ -0,0 +1,119 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+from . import config, metrics
+from .granite_medical import granite_medical
+
+logger = logging.getLogger(__name__)
+
+class BatchScheduler:
+    """
+    Dynamic batching in front of a GraniteMedicalAssistant.
+
+    Requests submitted from any thread are queued; a single worker thread takes
+    the first waiting request, gathers more for up to `max_wait_ms` (or until
+    `max_batch_size` are waiting) and runs them as one left-padded `generate`
+    call. On CPU one batch of N is much cheaper than N batches of one.
+    """
+
+    def __init__(self, assistant, max_batch_size: Optional[int] = None, max_wait_ms: Optional[float] = None,
+                 **generate_overrides):
+        self.assistant = assistant
+        self.max_batch_size = max_batch_size or config.GRANITE_MAX_BATCH_SIZE
+        self.max_wait = (config.GRANITE_BATCH_WAIT_MS if max_wait_ms is None else max_wait_ms) / 1000
+        self.generate_overrides = generate_overrides
+        self.queue = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.batched_requests = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="granite-batcher", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """Stop the worker after the requests already queued"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, prescription_text: str, patient_age: int) -> Future:
+        """Queue one advice request; the future resolves to the generate_medical_advice-style dict"""
+        self.start()
+        future = Future()
+        self.queue.put((prescription_text, patient_age, future))
+        return future
+
+    def generate(self, prescription_text: str, patient_age: int, timeout: Optional[float] = None) -> Dict:
+        """Blocking convenience wrapper around submit()"""
+        return self.submit(prescription_text, patient_age).result(timeout)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self.run_batch(batch)
+            if stopping:
+                return
+
+    def run_batch(self, batch):
+        live = [(text, age, future) for text, age, future in batch if future.set_running_or_notify_cancel()]
+        if not live:
+            return
+        try:
+            results = self.assistant.generate_batch([(text, age) for text, age, _ in live], **self.generate_overrides)
+        except Exception as e:
+            logger.error(f"Batched generation failed: {e}")
+            results = [{"error": str(e), "success": False} for _ in live]
+
+        self.batches += 1
+        self.batched_requests += len(live)
+        for (_, _, future), result in zip(live, results):
+            future.set_result(result)
+
+    def stats(self) -> Dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queued": self.queue.qsize(),
+            "batches": self.batches,
+            "mean_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0,
+        }
+
+# Global instance
+granite_batcher = BatchScheduler(granite_medical)
+
+def batcher_samples():
+    return [
+        ("medsafe_granite_queue_depth", "gauge", "Advice requests waiting for a batch", {}, granite_batcher.queue.qsize()),
+        ("medsafe_granite_batches_total", "counter", "Batched generate calls", {}, granite_batcher.batches),
+        ("medsafe_granite_batched_requests_total", "counter", "Advice requests generated in batches", {},
+         granite_batcher.batched_requests),
+    ]
+
+metrics.register_collector(batcher_samples)
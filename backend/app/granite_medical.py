@@ -1,35 +1,173 @@
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList,
+                          TextIteratorStreamer)
+import copy
 import logging
-from typing import Dict, List
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from . import config
+from .advice_cache import age_band, cache_enabled
 
 logger = logging.getLogger(__name__)
 
+# Instructions shared by every advice prompt; kept first so their KV state can be reused
+PROMPT_INSTRUCTIONS = """As a medical AI assistant, analyze the prescription below for the given patient.
+
+Please provide:
+1. Potential drug interactions to watch for
+2. Age-appropriate dosage considerations
+3. Alternative medication suggestions if needed
+4. Safety recommendations"""
+
+# Weight dtype loaded for each CPU precision mode; int8 loads fp32 and then quantizes the Linear layers
+CPU_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "int8": torch.float32}
+
+def cpu_supports_bf16() -> bool:
+    """True when the CPU has native bfloat16 instructions; emulated bf16 is slower than fp32"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
 class GraniteMedicalAssistant:
     """IBM Granite model for medical text analysis and recommendations"""
     
-    def __init__(self):
+    def __init__(self, model_name: Optional[str] = None):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model_loaded = False
-        self.model_name = "ibm-granite/granite-3.3-2b-instruct"
+        self.model_name = model_name or config.GRANITE_MODEL
+        # Guards load_model so concurrent first callers load the weights only once
+        self.load_lock = threading.Lock()
+        # (prefix_text, prefix_ids, past_key_values) of the shared prompt instructions
+        self.prefix_cache = None
+        self.prefix_lock = threading.Lock()
         
     def load_model(self):
         """Load the IBM Granite model"""
-        try:
-            logger.info(f"Loading IBM Granite model: {self.model_name}")
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                device_map="auto" if self.device == "cuda" else None
-            )
-            self.model_loaded = True
-            logger.info("IBM Granite model loaded successfully")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to load IBM Granite model: {e}")
-            return False
+        with self.load_lock:
+            if self.model_loaded:
+                return True
+            try:
+                logger.info(f"Loading IBM Granite model: {self.model_name}")
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                precision = self.precision()
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    torch_dtype=torch.float16 if self.device == "cuda" else CPU_DTYPES[precision],
+                    device_map="auto" if self.device == "cuda" else None,
+                    low_cpu_mem_usage=True
+                )
+                if self.device == "cpu" and precision == "int8":
+                    # Dynamic int8: Linear weights stored as int8, activations quantized on the fly.
+                    # In place, so the fp32 model is not deep-copied first (twice the memory at load)
+                    self.model = torch.ao.quantization.quantize_dynamic(
+                        self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+                    )
+                self.model.eval()
+                self.model_loaded = True
+                logger.info(f"IBM Granite model loaded successfully ({self.device}, {precision})")
+                return True
+            except Exception as e:
+                logger.error(f"Failed to load IBM Granite model: {e}")
+                return False
+
+    def precision(self) -> str:
+        """Effective CPU precision: GRANITE_CPU_PRECISION, with bf16 falling back to fp32 on CPUs without it"""
+        if self.device == "cuda":
+            return "fp16"
+        precision = config.GRANITE_CPU_PRECISION
+        if precision not in CPU_DTYPES:
+            logger.warning(f"Unknown GRANITE_CPU_PRECISION {precision!r}, using fp32")
+            return "fp32"
+        if precision == "bf16" and not cpu_supports_bf16():
+            logger.warning("CPU has no native bfloat16 support (avx512_bf16/amx_bf16), using fp32")
+            return "fp32"
+        return precision
+
+    def warmup(self):
+        """Run one tiny generation so the first real request does not pay for lazy initialization"""
+        inputs = self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": "Warmup"}],
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt",
+        ).to(self.device)
+        with torch.no_grad():
+            self.model.generate(**inputs, max_new_tokens=2, do_sample=False, pad_token_id=self.tokenizer.eos_token_id)
     
+    def build_prompt(self, prescription_text: str, patient_age: int) -> str:
+        """
+        Create medical context prompt.
+        The shared instructions come first so their KV state can be cached; only the
+        patient-specific part after them differs between requests.
+        With the advice cache on, the prompt only sees the age band the cache is keyed on.
+        """
+        age = age_band(patient_age) if cache_enabled() else f"{patient_age} years"
+        return PROMPT_INSTRUCTIONS + f"""
+
+Patient age: {age}
+Prescription: {prescription_text}
+
+Analysis:"""
+
+    def encode_request(self, prescription_text: str, patient_age: int):
+        """
+        Tokenize the chat-templated prompt for one request.
+        Returns (inputs, extra generate kwargs); with the prefix cache enabled the extra
+        kwargs carry a private copy of the precomputed KV state of the shared prefix,
+        so `generate` only prefills the patient-specific suffix.
+        """
+        text = self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": self.build_prompt(prescription_text, patient_age)}],
+            add_generation_prompt=True,
+            tokenize=False,
+        )
+        if not config.GRANITE_PREFIX_CACHE:
+            inputs = self.tokenizer(text, add_special_tokens=False, return_tensors="pt").to(self.device)
+            return inputs, {}
+
+        # Everything up to the end of the instructions is identical across requests
+        split = text.index(PROMPT_INSTRUCTIONS) + len(PROMPT_INSTRUCTIONS)
+        prefix_ids, past_key_values = self.prefix_state(text[:split])
+        suffix_ids = self.tokenizer(text[split:], add_special_tokens=False, return_tensors="pt")["input_ids"]
+        input_ids = torch.cat([prefix_ids, suffix_ids.to(self.device)], dim=-1)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        return inputs, {"past_key_values": copy.deepcopy(past_key_values)}
+
+    def prefix_state(self, prefix_text: str):
+        """
+        Token ids and KV cache of the shared prompt prefix, computed once.
+        The chat template may render per-day content (e.g. today's date) before the
+        instructions, so the cache is rebuilt whenever the rendered prefix changes.
+        """
+        with self.prefix_lock:
+            if self.prefix_cache is None or self.prefix_cache[0] != prefix_text:
+                prefix_ids = self.tokenizer(prefix_text, add_special_tokens=False, return_tensors="pt")["input_ids"]
+                prefix_ids = prefix_ids.to(self.device)
+                with torch.no_grad():
+                    past_key_values = self.model(input_ids=prefix_ids, use_cache=True).past_key_values
+                self.prefix_cache = (prefix_text, prefix_ids, past_key_values)
+                logger.info(f"Cached KV state for {prefix_ids.shape[-1]}-token prompt prefix")
+            return self.prefix_cache[1], self.prefix_cache[2]
+
+    def generation_kwargs(self, **overrides) -> Dict:
+        """Sampling settings shared by the single and batched generation paths"""
+        kwargs = dict(
+            max_new_tokens=config.GRANITE_MAX_NEW_TOKENS,
+            pad_token_id=self.tokenizer.eos_token_id
+        )
+        if config.GRANITE_DETERMINISTIC:
+            kwargs.update(do_sample=False)
+        else:
+            kwargs.update(temperature=0.7, do_sample=True)
+        kwargs.update(overrides)
+        return kwargs
+
     def generate_medical_advice(self, prescription_text: str, patient_age: int) -> Dict:
         """Generate medical advice using IBM Granite model"""
         if not self.model_loaded:
@@ -37,36 +175,10 @@ class GraniteMedicalAssistant:
                 return {"error": "Model failed to load"}
         
         try:
-            # Create medical context prompt
-            prompt = f"""As a medical AI assistant, analyze this prescription for a {patient_age}-year-old patient:
-
-Prescription: {prescription_text}
-
-Please provide:
-1. Potential drug interactions to watch for
-2. Age-appropriate dosage considerations
-3. Alternative medication suggestions if needed
-4. Safety recommendations
+            inputs, cached = self.encode_request(prescription_text, patient_age)
 
-Analysis:"""
-            
-            messages = [{"role": "user", "content": prompt}]
-            
-            inputs = self.tokenizer.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt",
-            ).to(self.device)
-
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=300,
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id
-            )
+            with torch.no_grad():
+                outputs = self.model.generate(**inputs, **cached, **self.generation_kwargs())
             
             response = self.tokenizer.decode(
                 outputs[0][inputs["input_ids"].shape[-1]:], 
@@ -83,5 +195,241 @@ Analysis:"""
             logger.error(f"IBM Granite analysis failed: {e}")
             return {"error": str(e), "success": False}
 
+    def stream_medical_advice(self, prescription_text: str, patient_age: int,
+                              cancelled: Optional[threading.Event] = None) -> Iterator[Dict]:
+        """
+        Generate medical advice token by token.
+        Yields {"text": chunk} as text is decoded, then one final dict with the
+        per-request timings: time to first token, generated tokens and tokens/sec.
+        Setting `cancelled` (or closing the generator) stops the generation.
+        """
+        if not self.model_loaded:
+            if not self.load_model():
+                yield {"error": "Model failed to load", "success": False}
+                return
+
+        started = time.perf_counter()
+        # Set when the consumer closes the generator (client gone), which stops `generate`
+        if cancelled is None:
+            cancelled = threading.Event()
+        try:
+            inputs, cached = self.encode_request(prescription_text, patient_age)
+        except Exception as e:
+            logger.error(f"IBM Granite streaming failed: {e}")
+            yield {"error": str(e), "success": False}
+            return
+
+        streamer = TimedTextStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+
+        def generate():
+            try:
+                with torch.no_grad():
+                    self.model.generate(**inputs, **cached, **self.generation_kwargs(), streamer=streamer,
+                                        stopping_criteria=StoppingCriteriaList([CancelCriteria(cancelled)]))
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        worker = threading.Thread(target=generate, name="granite-stream", daemon=True)
+        worker.start()
+        try:
+            for chunk in streamer:
+                if chunk:
+                    yield {"text": chunk}
+        finally:
+            cancelled.set()
+        worker.join()
+
+        if errors:
+            logger.error(f"IBM Granite streaming failed: {errors[0]}")
+            yield {"error": str(errors[0]), "success": False}
+            return
+
+        stats = streamer.stats(started)
+        logger.info(
+            f"IBM Granite stream: ttft {stats['ttft_ms']} ms, "
+            f"{stats['generated_tokens']} tokens, {stats['tokens_per_sec']} tokens/s"
+        )
+        yield {"model": self.model_name, "success": True, **stats}
+
+    def generate_batch(self, requests: List[Tuple[str, int]], **generate_overrides) -> List[Dict]:
+        """
+        Generate advice for several (prescription_text, patient_age) requests with one
+        `generate` call. Prompts are left-padded so every row's completion starts at the
+        same position; each result also reports how many tokens were generated.
+        Left padding shifts the shared prefix, so only a batch of one uses the prefix cache.
+        """
+        if not self.model_loaded:
+            if not self.load_model():
+                return [{"error": "Model failed to load", "success": False} for _ in requests]
+
+        try:
+            if len(requests) == 1:
+                inputs, cached = self.encode_request(*requests[0])
+                with torch.no_grad():
+                    outputs = self.model.generate(**inputs, **cached, **self.generation_kwargs(**generate_overrides))
+                return [self.completion_result(outputs[0][inputs["input_ids"].shape[-1]:])]
+
+            texts = [
+                self.tokenizer.apply_chat_template(
+                    [{"role": "user", "content": self.build_prompt(text, age)}],
+                    add_generation_prompt=True,
+                    tokenize=False,
+                )
+                for text, age in requests
+            ]
+            if self.tokenizer.pad_token_id is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.tokenizer.padding_side = "left"
+            inputs = self.tokenizer(
+                texts, padding=True, add_special_tokens=False, return_tensors="pt"
+            ).to(self.device)
+
+            with torch.no_grad():
+                outputs = self.model.generate(**inputs, **self.generation_kwargs(**generate_overrides))
+
+            completions = outputs[:, inputs["input_ids"].shape[-1]:]
+            return [self.completion_result(row) for row in completions]
+
+        except Exception as e:
+            logger.error(f"IBM Granite batch analysis failed: {e}")
+            return [{"error": str(e), "success": False} for _ in requests]
+
+    def completion_result(self, row) -> Dict:
+        """Decode one generated row (up to EOS) into an advice result"""
+        generated = count_generated_tokens(row, self.tokenizer.eos_token_id)
+        return {
+            "model": self.model_name,
+            "analysis": self.tokenizer.decode(row[:generated], skip_special_tokens=True),
+            "generated_tokens": generated,
+            "success": True
+        }
+
+def count_generated_tokens(row, eos_token_id) -> int:
+    """Number of tokens up to and including the first EOS (the rest is padding)"""
+    eos_positions = (row == eos_token_id).nonzero()
+    return int(eos_positions[0]) + 1 if len(eos_positions) else len(row)
+
+class CancelCriteria(StoppingCriteria):
+    """Stops generation once `event` is set"""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+class TimedTextStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that also records when generated tokens arrive"""
+
+    def __init__(self, tokenizer, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.generated_tokens = 0
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+
+    def put(self, value):
+        is_prompt = self.skip_prompt and self.next_tokens_are_prompt
+        super().put(value)
+        if not is_prompt:
+            now = time.perf_counter()
+            if self.first_token_at is None:
+                self.first_token_at = now
+            self.last_token_at = now
+            self.generated_tokens += value.numel()
+
+    def stats(self, started: float) -> Dict:
+        if self.first_token_at is None:
+            return {"ttft_ms": None, "generated_tokens": 0, "tokens_per_sec": 0.0}
+        decode_seconds = self.last_token_at - self.first_token_at
+        return {
+            "ttft_ms": round((self.first_token_at - started) * 1000, 1),
+            "generated_tokens": self.generated_tokens,
+            # First token comes out of prefill, so the decode rate counts the ones after it
+            "tokens_per_sec": round((self.generated_tokens - 1) / decode_seconds, 1) if decode_seconds > 0 else 0.0,
+        }
+
+class ModelLifecycle:
+    """
+    Loads and warms up a GraniteMedicalAssistant on a background thread.
+    State goes idle -> loading -> warming -> ready (or failed); callers can poll
+    status() or block in wait_until_ready() with a timeout. After a failure the
+    next start() tries again, at most once per RETRY_SECONDS.
+    """
+    RETRY_SECONDS = 30.0
+
+    def __init__(self, assistant: GraniteMedicalAssistant):
+        self.assistant = assistant
+        self.state = "idle"
+        self.error: Optional[str] = None
+        self.failed_at: Optional[float] = None
+        self.load_seconds: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self.ready = threading.Event()
+        # Set once the current attempt is over, whether it succeeded or failed
+        self.settled = threading.Event()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start loading in the background; a no-op while loading or ready, or shortly after a failure"""
+        with self.lock:
+            if self.thread is not None and self.state != "failed":
+                return
+            if self.failed_at is not None and time.monotonic() - self.failed_at < self.RETRY_SECONDS:
+                return
+            self.state = "loading"
+            self.error = None
+            self.settled.clear()
+            self.thread = threading.Thread(target=self.run, name="granite-preload", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        started = time.perf_counter()
+        if not self.assistant.load_model():
+            self.fail("Model failed to load")
+            return
+        self.load_seconds = round(time.perf_counter() - started, 2)
+
+        self.state = "warming"
+        started = time.perf_counter()
+        try:
+            self.assistant.warmup()
+        except Exception as e:
+            logger.error(f"IBM Granite warmup failed: {e}")
+            self.fail(f"Warmup failed: {e}")
+            return
+        self.warmup_seconds = round(time.perf_counter() - started, 2)
+
+        self.state = "ready"
+        self.ready.set()
+        self.settled.set()
+        logger.info(f"IBM Granite model ready (load {self.load_seconds}s, warmup {self.warmup_seconds}s)")
+
+    def fail(self, error: str):
+        with self.lock:
+            self.state = "failed"
+            self.error = error
+            self.failed_at = time.monotonic()
+        self.settled.set()
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for the model; False if it is not ready by then or loading failed"""
+        if timeout > 0 and self.state != "failed":
+            self.settled.wait(timeout)
+        return self.ready.is_set()
+
+    def status(self) -> Dict:
+        return {
+            "model": self.assistant.model_name,
+            "state": self.state,
+            "ready": self.ready.is_set(),
+            "error": self.error,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+        }
+
 # Global instance
-granite_medical = GraniteMedicalAssistant()
\ No newline at end of file
+granite_medical = GraniteMedicalAssistant()
+granite_lifecycle = ModelLifecycle(granite_medical)
\ No newline at end of file
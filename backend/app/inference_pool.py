@@ -0,0 +1,349 @@
+"""
+Granite inference in dedicated worker processes.
+
+Each worker loads the model once, pins itself to its own slice of CPU cores
+and sizes torch's thread pools to that slice, so N replicas share a large
+host without oversubscription and without competing with the API process
+for the GIL. Each worker has its own request queue (a worker killed while
+blocked on a shared queue would leave its lock held) and the parent sends
+each request to the ready worker with the fewest outstanding requests; a
+worker drains up to GRANITE_MAX_BATCH_SIZE waiting requests into one batched
+generate. Results come back on one shared queue. A monitor thread restarts a
+worker that dies and fails only the requests that had been sent to it; a
+worker whose model fails to load or warm up is retried after RETRY_SECONDS.
+Closing a stream (client gone) sends its request id on the worker's cancel
+queue, which stops the generation through its stopping criteria.
+
+torch and transformers are imported inside the worker only.
+"""
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Iterator, List, Optional
+
+from . import config, metrics
+
+logger = logging.getLogger(__name__)
+
+def plan_cores(workers: int, threads_per_worker: int) -> List[Optional[List[int]]]:
+    """Split the cores this process may run on into one disjoint slice per worker"""
+    if not config.GRANITE_PIN_CORES or not hasattr(os, "sched_getaffinity"):
+        return [None] * workers
+    cores = sorted(os.sched_getaffinity(0))
+    if workers * threads_per_worker > len(cores):
+        logger.warning(f"{workers} workers x {threads_per_worker} threads exceeds {len(cores)} cores, not pinning")
+        return [None] * workers
+    return [cores[i * threads_per_worker:(i + 1) * threads_per_worker] for i in range(workers)]
+
+class Cancellations:
+    """Worker side of the cancel queue: request ids of streams whose consumer went away"""
+
+    def __init__(self, cancels):
+        self.lock = threading.Lock()
+        self.current: Optional[int] = None
+        self.event = threading.Event()
+        # Cancelled before the worker got to them; ids only grow, so older ones can be forgotten
+        self.early = set()
+        threading.Thread(target=self.listen, args=(cancels,), name="granite-cancel", daemon=True).start()
+
+    def listen(self, cancels):
+        while True:
+            request_id = cancels.get()
+            with self.lock:
+                if request_id == self.current:
+                    self.event.set()
+                elif self.current is None or request_id > self.current:
+                    self.early.add(request_id)
+
+    def watch(self, request_id: int) -> threading.Event:
+        """The event set when stream `request_id` is cancelled"""
+        with self.lock:
+            self.current, self.event = request_id, threading.Event()
+            if request_id in self.early:
+                self.event.set()
+            self.early = {rid for rid in self.early if rid > request_id}
+            return self.event
+
+def worker_main(index: int, model_name: str, threads: int, cores, requests, cancels, results, max_batch_size: int):
+    """Worker process: pin, load the model once, then serve requests until a None sentinel"""
+    if cores:
+        os.sched_setaffinity(0, cores)
+    # Must be set before torch creates its thread pools
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    from .granite_medical import GraniteMedicalAssistant
+
+    assistant = GraniteMedicalAssistant(model_name)
+    if not assistant.load_model():
+        results.put(("failed", index, "Model failed to load"))
+        return
+    try:
+        assistant.warmup()
+    except Exception as e:
+        results.put(("failed", index, f"Warmup failed: {e}"))
+        return
+    results.put(("ready", index, None))
+    cancellations = Cancellations(cancels)
+
+    carry = None
+    while True:
+        item, carry = carry or requests.get(), None
+        if item is None:
+            return
+        kind, request_id, text, age = item
+
+        if kind == "stream":
+            cancelled = cancellations.watch(request_id)
+            if not cancelled.is_set():
+                for chunk in assistant.stream_medical_advice(text, age, cancelled):
+                    results.put(("chunk", index, (request_id, chunk)))
+            results.put(("done", index, [(request_id, None)]))
+            continue
+
+        # Take whatever else is already waiting and generate it as one batch
+        batch = [(request_id, text, age)]
+        while len(batch) < max_batch_size:
+            try:
+                extra = requests.get_nowait()
+            except queue.Empty:
+                break
+            if extra is None or extra[0] == "stream":
+                carry = extra  # handled on the next loop iteration
+                break
+            batch.append(extra[1:])
+
+        try:
+            outputs = assistant.generate_batch([(t, a) for _, t, a in batch])
+        except Exception as e:
+            outputs = [{"error": str(e), "success": False} for _ in batch]
+        results.put(("done", index, [(rid, out) for (rid, _, _), out in zip(batch, outputs)]))
+
+class InferencePool:
+    """N Granite worker processes behind one request queue"""
+    RETRY_SECONDS = 30.0
+
+    def __init__(self, workers: Optional[int] = None, threads_per_worker: Optional[int] = None,
+                 model_name: Optional[str] = None):
+        self.workers = workers or config.GRANITE_WORKERS
+        self.threads_per_worker = (threads_per_worker or config.GRANITE_THREADS_PER_WORKER
+                                   or max(1, config.CPU_COUNT // self.workers))
+        self.model_name = model_name or config.GRANITE_MODEL
+        self.cores = plan_cores(self.workers, self.threads_per_worker)
+        self.processes: Dict[int, object] = {}
+        self.queues: Dict[int, object] = {}
+        self.cancels: Dict[int, object] = {}
+        self.ready_workers = set()
+        self.failed_at: Dict[int, float] = {}  # worker index -> when its model failed to load
+        self.ready = threading.Event()
+        self.error: Optional[str] = None
+        self.in_flight: Dict[int, set] = {}
+        self.pending: Dict[int, object] = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.restarts = 0
+        self.started = False
+        self.stopping = False
+
+    def start(self):
+        """Spawn the workers plus the result collector and crash monitor threads; idempotent"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            import multiprocessing
+            self.context = multiprocessing.get_context("spawn")
+            self.results = self.context.Queue()
+            for index in range(self.workers):
+                self.spawn(index)
+        threading.Thread(target=self.collect, name="granite-pool-results", daemon=True).start()
+        threading.Thread(target=self.monitor, name="granite-pool-monitor", daemon=True).start()
+        logger.info(f"Started {self.workers} Granite workers x {self.threads_per_worker} threads")
+
+    def spawn(self, index: int):
+        """Start worker `index` with a fresh request queue; caller holds the lock"""
+        self.queues[index] = self.context.Queue()
+        self.cancels[index] = self.context.Queue()
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.model_name, self.threads_per_worker, self.cores[index],
+                  self.queues[index], self.cancels[index], self.results, config.GRANITE_MAX_BATCH_SIZE),
+            name=f"granite-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        self.in_flight[index] = set()
+
+    def stop(self):
+        """Ask every worker to exit after its current request"""
+        if not self.started:
+            return
+        self.stopping = True
+        for requests in self.queues.values():
+            requests.put(None)
+        for process in self.processes.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    def dispatch(self, kind: str, prescription_text: str, patient_age: int, target) -> int:
+        """Send a request to the least busy worker, preferring ready ones"""
+        self.start()
+        request_id = next(self.ids)
+        with self.lock:
+            self.pending[request_id] = target
+            candidates = self.ready_workers or set(self.processes) - set(self.failed_at)
+            if not candidates:
+                self.finish(request_id, {"error": self.error or "No Granite worker is running", "success": False})
+                return request_id
+            index = min(candidates, key=lambda i: len(self.in_flight[i]))
+            self.in_flight[index].add(request_id)
+            self.queues[index].put((kind, request_id, prescription_text, patient_age))
+        return request_id
+
+    def submit(self, prescription_text: str, patient_age: int) -> Future:
+        """Queue one advice request; the future resolves to the generate_medical_advice-style dict"""
+        future = Future()
+        self.dispatch("generate", prescription_text, patient_age, future)
+        return future
+
+    def stream(self, prescription_text: str, patient_age: int) -> Iterator[Dict]:
+        """Like GraniteMedicalAssistant.stream_medical_advice, served by a worker process"""
+        chunks = queue.Queue()
+        request_id = self.dispatch("stream", prescription_text, patient_age, chunks)
+        finished = False
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    finished = True
+                    return
+                yield chunk
+        finally:
+            if not finished:
+                self.cancel(request_id)
+
+    def cancel(self, request_id: int):
+        """Consumer gone: drop the rest of the stream and tell its worker to stop generating"""
+        with self.lock:
+            self.pending.pop(request_id, None)
+            for index, request_ids in self.in_flight.items():
+                if request_id in request_ids:
+                    self.cancels[index].put(request_id)
+
+    def collect(self):
+        """Route worker messages to the waiting futures and stream queues"""
+        while True:
+            kind, index, payload = self.results.get()
+            with self.lock:
+                if kind == "ready":
+                    self.ready_workers.add(index)
+                    self.error = None
+                    self.ready.set()
+                elif kind == "failed":
+                    self.failed_at[index] = time.monotonic()
+                    self.error = payload
+                    logger.error(f"Granite worker {index} failed: {payload}; retrying in {self.RETRY_SECONDS:.0f}s")
+                    # Requests sent to it while it was loading would never be answered
+                    for request_id in self.in_flight[index]:
+                        self.finish(request_id, {"error": payload, "success": False})
+                    self.in_flight[index].clear()
+                elif kind == "chunk":
+                    request_id, chunk = payload
+                    target = self.pending.get(request_id)
+                    if target is not None:
+                        target.put(chunk)
+                elif kind == "done":
+                    for request_id, result in payload:
+                        self.in_flight[index].discard(request_id)
+                        self.finish(request_id, result)
+
+    def finish(self, request_id: int, result: Optional[Dict]):
+        """Resolve a pending request; caller holds the lock"""
+        target = self.pending.pop(request_id, None)
+        if isinstance(target, Future):
+            target.set_result(result)
+        elif target is not None:
+            if result is not None:
+                target.put(result)
+            target.put(None)
+
+    def monitor(self):
+        """Restart crashed workers and fail the requests that had been sent to them; retry failed ones"""
+        while not self.stopping:
+            time.sleep(1)
+            for index, process in list(self.processes.items()):
+                if self.stopping:
+                    break
+                failed_at = self.failed_at.get(index)
+                if failed_at is not None:
+                    if time.monotonic() - failed_at >= self.RETRY_SECONDS:
+                        logger.info(f"Retrying Granite worker {index}")
+                        with self.lock:
+                            del self.failed_at[index]
+                            self.restarts += 1
+                            self.spawn(index)
+                    continue
+                if process.is_alive():
+                    continue
+                logger.error(f"Granite worker {index} exited with code {process.exitcode}, restarting")
+                with self.lock:
+                    self.ready_workers.discard(index)
+                    if not self.ready_workers:
+                        self.ready.clear()
+                    for request_id in self.in_flight[index]:
+                        self.finish(request_id, {"error": "Inference worker crashed", "success": False})
+                    self.restarts += 1
+                    self.spawn(index)
+
+    def all_failed(self) -> bool:
+        return len(self.failed_at) == self.workers
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for at least one worker to be ready; False as soon as all have failed"""
+        deadline = time.monotonic() + timeout
+        while not self.ready.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.all_failed():
+                return False
+            self.ready.wait(min(remaining, 0.1))
+        return True
+
+    def status(self) -> Dict:
+        with self.lock:
+            return {
+                "model": self.model_name,
+                "state": "ready" if self.ready.is_set() else ("failed" if self.all_failed() else "loading"),
+                "ready": self.ready.is_set(),
+                "error": self.error,
+                "workers": self.workers,
+                "ready_workers": len(self.ready_workers),
+                "threads_per_worker": self.threads_per_worker,
+                "cores": self.cores,
+                "in_flight": sum(len(rids) for rids in self.in_flight.values()),
+                "restarts": self.restarts,
+            }
+
+# Global instance
+inference_pool = InferencePool() if config.GRANITE_WORKERS > 0 else None
+
+def granite_pool_samples():
+    status = inference_pool.status()
+    return [
+        ("medsafe_granite_workers_ready", "gauge", "Granite worker processes ready", {}, status["ready_workers"]),
+        ("medsafe_granite_in_flight", "gauge", "Advice requests sent to Granite workers", {}, status["in_flight"]),
+        ("medsafe_granite_worker_restarts_total", "counter", "Granite worker processes restarted", {},
+         status["restarts"]),
+    ]
+
+if inference_pool is not None:
+    metrics.register_collector(granite_pool_samples)
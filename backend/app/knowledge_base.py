@@ -0,0 +1,140 @@
+"""
+The read-only drug knowledge base: the formulary, interaction, dosage and
+alternative tables, plus the regular expressions compiled from them.
+
+It is built once at import. Under the multi-worker server (app.serve) that
+import happens in the parent before it forks, so all workers share one copy
+of the tables and compiled matchers copy-on-write instead of each building
+its own.
+"""
+import re
+from typing import Dict, List, Optional, Pattern, Tuple
+
+# Common drug names for pattern matching
+COMMON_DRUGS = [
+    "aspirin", "ibuprofen", "acetaminophen", "paracetamol", "metformin", 
+    "lisinopril", "atorvastatin", "metoprolol", "omeprazole", "simvastatin",
+    "losartan", "amlodipine", "hydrochlorothiazide", "prednisone", "tramadol",
+    "gabapentin", "furosemide", "warfarin", "clopidogrel", "pantoprazole",
+    "sertraline", "fluoxetine", "citalopram", "venlafaxine", "duloxetine",
+    "albuterol", "montelukast", "fluticasone", "loratadine", "diphenhydramine",
+    "amoxicillin", "azithromycin", "clarithromycin", "doxycycline", "cephalexin",
+    "ciprofloxacin", "levofloxacin", "penicillin", "erythromycin", "tetracycline"
+]
+
+drug_interactions = {
+    ("atorvastatin", "clarithromycin"): "May increase risk of muscle damage and kidney problems",
+    ("aspirin", "ibuprofen"): "May increase risk of gastrointestinal bleeding",
+    ("warfarin", "ibuprofen"): "May increase risk of serious bleeding",
+    ("lisinopril", "ibuprofen"): "May reduce kidney function and blood pressure control",
+    ("metformin", "ibuprofen"): "May increase risk of lactic acidosis",
+    ("simvastatin", "clarithromycin"): "May increase risk of muscle damage",
+    ("digoxin", "clarithromycin"): "May increase digoxin toxicity",
+}
+
+age_dosage_recommendations = {
+    "atorvastatin": { 
+        "adult": "10-80mg once daily", 
+        "child": "Not recommended under 18" 
+    },
+    "clarithromycin": { 
+        "adult": "250-500mg twice daily", 
+        "child": "7.5mg/kg twice daily (max 500mg)" 
+    },
+    "aspirin": { 
+        "adult": "75-325mg once daily", 
+        "child": "Contraindicated under 18 (Reye's syndrome)" 
+    },
+    "amoxicillin": { 
+        "adult": "250-500mg three times daily", 
+        "child": "20-40mg/kg per day in divided doses" 
+    },
+    "metformin": { 
+        "adult": "500-1000mg twice daily", 
+        "child": "Not recommended under 10 years" 
+    },
+    "ibuprofen": { 
+        "adult": "200-400mg three times daily", 
+        "child": "5-10mg/kg every 6-8 hours" 
+    },
+    "azithromycin": { 
+        "adult": "250-500mg once daily", 
+        "child": "5-10mg/kg once daily" 
+    },
+    "simvastatin": { 
+        "adult": "5-40mg once daily", 
+        "child": "Not recommended under 18" 
+    },
+}
+
+alternative_drugs = {
+    "atorvastatin": ["rosuvastatin", "simvastatin", "pravastatin"],
+    "clarithromycin": ["azithromycin", "amoxicillin", "doxycycline", "levofloxacin"],
+    "aspirin": ["acetaminophen", "clopidogrel"],
+    "ibuprofen": ["acetaminophen", "naproxen"],
+    "warfarin": ["apixaban", "rivaroxaban", "dabigatran"],
+    "simvastatin": ["atorvastatin", "rosuvastatin", "pravastatin"],
+}
+
+# Interaction descriptions containing one of these words are high severity
+HIGH_SEVERITY_WORDS = ["bleeding", "damage", "serious", "toxicity"]
+FREQUENCY_TERMS = "once|twice|thrice|daily|every day|qd|bid|tid|qid"
+
+# "Drug Name 500mg", "Drug Name tablets", "Rx: Drug Name", "Take Drug Name"
+DRUG_NAME_PATTERNS = [
+    r'\b([A-Z][a-z]+(?:[A-Z][a-z]+)*)\s*(\d+\s*mg)\s*(?:once|twice|daily|bid|tid|qid)?',
+    r'\b([A-Z][a-z]+(?:[A-Z][a-z]+)*)\s*(?:tablets?|capsules?)\s*(?:of\s*)?(\d+\s*mg)?',
+    r'Rx:\s*([A-Z][a-z]+(?:[A-Z][a-z]+)*)\s*(\d+\s*mg)?',
+    r'Take\s+([A-Z][a-z]+(?:[A-Z][a-z]+)*)\s*(\d+\s*mg)?',
+]
+
+def dosage_patterns(drug_name: str) -> List[Pattern]:
+    """Dosage next to the drug name: drugname 500mg, 500mg drugname, tablets of drugname 500mg"""
+    return [re.compile(pattern, re.IGNORECASE) for pattern in (
+        rf'{drug_name}\s+(\d+\s*mg)',
+        rf'(\d+\s*mg)\s+{drug_name}',
+        rf'{drug_name}\s+(\d+\s*mg)\s+',
+        rf'tablets?\s+of\s+{drug_name}\s+(\d+\s*mg)',
+    )]
+
+def frequency_patterns(drug_name: str) -> List[Pattern]:
+    """A frequency term after or before the drug name"""
+    return [re.compile(pattern, re.IGNORECASE) for pattern in (
+        rf'{drug_name}.*?({FREQUENCY_TERMS})',
+        rf'({FREQUENCY_TERMS}).*?{drug_name}',
+    )]
+
+class KnowledgeBase:
+    """Lookup structures and compiled matchers built from the tables above"""
+
+    def __init__(self, drug_names: List[str], interactions: Dict[Tuple[str, str], str],
+                 dosages: Dict[str, Dict[str, str]], alternatives: Dict[str, List[str]]):
+        self.drug_names = tuple(drug_names)
+        self.formulary = frozenset(drug_names)
+        self.dosages = dosages
+        self.alternatives = alternatives
+        # Either order of a pair -> (description, severity, whether the table lists it the other way round)
+        self.interactions: Dict[Tuple[str, str], Tuple[str, str, bool]] = {}
+        for reverse in (True, False):
+            for (drug_a, drug_b), description in interactions.items():
+                severity = "high" if any(word in description.lower() for word in HIGH_SEVERITY_WORDS) else "medium"
+                key = (drug_b, drug_a) if reverse else (drug_a, drug_b)
+                self.interactions[key] = (description, severity, reverse)
+        self.name_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in DRUG_NAME_PATTERNS]
+        self.dosage_matchers = {drug: dosage_patterns(drug) for drug in self.drug_names}
+        self.frequency_matchers = {drug: frequency_patterns(drug) for drug in self.drug_names}
+        self.sentence_split = re.compile(r'[.!?]')
+
+    def interaction(self, drug_a: str, drug_b: str) -> Optional[Tuple[str, str, bool]]:
+        return self.interactions.get((drug_a, drug_b))
+
+    def dosage_matchers_for(self, drug_name: str) -> List[Pattern]:
+        matchers = self.dosage_matchers.get(drug_name)
+        return matchers if matchers is not None else dosage_patterns(drug_name)
+
+    def frequency_matchers_for(self, drug_name: str) -> List[Pattern]:
+        matchers = self.frequency_matchers.get(drug_name)
+        return matchers if matchers is not None else frequency_patterns(drug_name)
+
+# Global instance
+knowledge_base = KnowledgeBase(COMMON_DRUGS, drug_interactions, age_dosage_recommendations, alternative_drugs)
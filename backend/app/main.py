@@ -1,14 +1,30 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File 
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+import asyncio
 import logging
-import io
+import json
+import os
+import time
+from typing import Optional
 
 # Import from your actual files
-from .models import PrescriptionRequest, VerificationResponse, Drug
-from .nlp_utils import extract_drugs_from_text
-from .drug_utils import check_interactions, check_dosage, get_alternatives
-from .ocr_processor import ocr_processor  # ← CHANGED TO OCR PROCESSOR
+from .models import (PrescriptionRequest, ImageAnalysisResponse, SessionUpdate, SessionResponse, AdviceRequest,
+                     AssessmentResponse, Drug, Patient)
+from . import pipeline
+from .sessions import session_store
+from .records import RECORD_TYPES, FastJSONResponse
+from .inference_pool import inference_pool
+from .ocr_pool import ocr_pool
+from .subsystems import ensure, get_llm, get_ocr_processor, import_seconds, loaded
+from .advice_cache import advice_cache, cache_enabled
+from . import audit, config, metrics, profiling, tracing
+from .streaming import stage_event_response, sse_response
+from .stages import stage
+from .triage import triage, triage_stats
+from .uploads import UploadLimitMiddleware, checked_upload
+from .admission import HeldResponse, admission_stats, llm_gate, ocr_gate, verify_gate
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,99 +39,409 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(UploadLimitMiddleware, paths=["/extract-text", "/analyze-image", "/analyze-image/stream"])
+if profiling.enabled:
+    app.add_middleware(profiling.ProfileMiddleware)
+if tracing.enabled:
+    app.add_middleware(tracing.TraceMiddleware)
 
-@app.post("/verify")
-async def verify_prescription(request: PrescriptionRequest):
-    """Main endpoint to verify a prescription."""
-    try:
-        drugs_to_check = request.drugs
-
-        # 1. Extract drugs from text if provided
-        if request.text_input:
-            extracted_drugs = extract_drugs_from_text(request.text_input)
-            logger.info(f"Extracted drugs from text: {extracted_drugs}")
-            # Convert extracted drugs to Drug objects if needed
-            for drug_info in extracted_drugs:
-                drugs_to_check.append(Drug(
-                    name=drug_info.get('name', ''),
-                    dosage=drug_info.get('dosage', ''),
-                    frequency=drug_info.get('frequency', '')
-                ))
-
-        if not drugs_to_check:
-            return VerificationResponse(
-                is_safe=True,
-                extracted_drugs=[],
-                interactions=[],
-                dosage_alerts=[],
-                alternatives=[]
-            )
+def requires(role: str):
+    """Route dependency: 404 on workers whose APP_ROLE does not include `role`"""
+    def check():
+        if not config.serves(role):
+            roles = ",".join(sorted(config.APP_ROLE))
+            raise HTTPException(status_code=404, detail=f"This worker does not serve {role} (APP_ROLE={roles})")
+    return Depends(check)
+
+@app.on_event("startup")
+async def preload_models():
+    """
+    Import the OCR stack and load and warm up the Granite model in the background,
+    for the roles this worker serves, so no request pays for it
+    """
+    metrics.start_publishing()
+    loop = asyncio.get_running_loop()
+    if config.serves("ocr") and config.OCR_PRELOAD:
+        loop.run_in_executor(None, preload_ocr)
+    if config.serves("llm") and config.GRANITE_PRELOAD:
+        loop.run_in_executor(None, lambda: get_llm().lifecycle.start())
 
-        # 2. Check for drug interactions
-        interaction_alerts = check_interactions(drugs_to_check, request.patient.age)
-
-        # 3. Check dosage for each drug
-        dosage_alerts = []
-        for drug in drugs_to_check:
-            dosage_alerts.extend(check_dosage(drug, request.patient.age))
-
-        # 4. Suggest alternatives for problematic drugs
-        alternative_suggestions = []
-        for alert in interaction_alerts + dosage_alerts:
-            # Find the target drug
-            target_drug_name = alert.drug_a if hasattr(alert, 'drug_a') else alert.drug
-            target_drug = next(
-                (d for d in drugs_to_check if d.name.lower() == target_drug_name.lower()),
-                None
+def preload_ocr():
+    get_ocr_processor()
+    if ocr_pool is not None:
+        # Also when get_ocr_processor() was cached before a fork: the pool was reset in this worker
+        ocr_pool.start()
+
+@app.on_event("shutdown")
+async def stop_workers():
+    if inference_pool is not None:
+        await run_in_threadpool(inference_pool.stop)
+    if ocr_pool is not None:
+        await run_in_threadpool(ocr_pool.stop)
+    tracing.flush()
+    audit.flush()
+
+@app.post("/verify", dependencies=[requires("verify")])
+async def verify_prescription(request: PrescriptionRequest, fast: bool = False):
+    """
+    Main endpoint to verify a prescription.
+    With ?fast=true the verdict is built from __slots__ records and encoded straight to JSON
+    (same response shape, no pydantic validation or jsonable_encoder pass).
+    """
+    async with verify_gate.slot():
+        try:
+            if fast:
+                verification = await run_in_threadpool(
+                    pipeline.verify_prescription, request.drugs, request.text_input, request.patient,
+                    types=RECORD_TYPES,
+                )
+                return FastJSONResponse(verification)
+            return await run_in_threadpool(
+                pipeline.verify_prescription, request.drugs, request.text_input, request.patient
             )
-            if target_drug:
-                # Use the appropriate attribute based on alert type
-                if hasattr(alert, 'description'):  # InteractionAlert
-                    reason = alert.description
-                else:  # DosageAlert
-                    reason = alert.issue
-
-                alts = get_alternatives(target_drug, request.patient, reason)
-                alternative_suggestions.extend(alts)
-
-        # 5. Determine overall safety
-        is_safe = not (interaction_alerts or dosage_alerts)
-
-        return VerificationResponse(
-            is_safe=is_safe,
-            extracted_drugs=drugs_to_check,
-            interactions=interaction_alerts,
-            dosage_alerts=dosage_alerts,
-            alternatives=alternative_suggestions
+
+        except Exception as e:
+            logger.error(f"An error occurred during verification: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/assess", response_model=AssessmentResponse, dependencies=[requires("verify")])
+async def assess_prescription(request: PrescriptionRequest):
+    """
+    Verify a prescription, then ask Granite for a review only when triage calls for it
+    (rule alerts or drug candidates outside the formulary); `triage.reasons` records why.
+    """
+    async with verify_gate.slot():
+        verification = await run_in_threadpool(
+            pipeline.verify_prescription, request.drugs, request.text_input, request.patient
         )
+    decision = triage(verification)
+    advice = await triaged_advice(decision, pipeline.advice_text(request.text_input, request.drugs), request.patient)
+    return AssessmentResponse(verification=verification, triage=decision, advice=advice)
 
-    except Exception as e:
-        logger.error(f"An error occurred during verification: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+@app.post("/verify/stream", dependencies=[requires("verify")])
+async def verify_prescription_stream(request: PrescriptionRequest):
+    """Verify a prescription, streaming per-stage progress as server-sent events."""
+    async def run(on_stage):
+        return await run_in_threadpool(
+            pipeline.verify_prescription, request.drugs, request.text_input, request.patient, on_stage
+        )
 
-@app.post("/extract-text")  # ← CHANGED ENDPOINT NAME
+    slot = await verify_gate.acquire()
+    return HeldResponse(stage_event_response(run), slot)
+
+@app.post("/sessions", dependencies=[requires("verify")])
+async def create_verification_session(request: PrescriptionRequest, stream: bool = False):
+    """
+    Start an incremental verification session and return its first verdict.
+    Use PUT /sessions/{session_id} to re-verify edited text; pass ?stream=true for stage events.
+    """
+    session = session_store.create(request.patient, request.drugs)
+    return await run_session_update(session, request.text_input, None, stream)
+
+@app.put("/sessions/{session_id}", dependencies=[requires("verify")])
+async def update_verification_session(session_id: str, update: SessionUpdate, stream: bool = False):
+    """Re-verify edited text, re-extracting changed lines and re-checking changed drugs only."""
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return await run_session_update(session, update.text_input, update.patient, stream)
+
+@app.delete("/sessions/{session_id}", dependencies=[requires("verify")])
+async def delete_verification_session(session_id: str):
+    if not session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"success": True}
+
+async def run_session_update(session, text_input, patient, stream):
+    """Apply an update to a session under its lock, as JSON or as a stage event stream"""
+    def update(on_stage=None):
+        with session.lock:
+            verification = session.update(text_input, patient, on_stage)
+        return SessionResponse(session_id=session.session_id, verification=verification)
+
+    if stream:
+        async def run(on_stage):
+            return await run_in_threadpool(update, on_stage)
+        slot = await verify_gate.acquire()
+        return HeldResponse(stage_event_response(run), slot)
+
+    async with verify_gate.slot():
+        try:
+            return await run_in_threadpool(update)
+        except Exception as e:
+            logger.error(f"An error occurred during session verification: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/extract-text", dependencies=[requires("ocr")])  # ← CHANGED ENDPOINT NAME
 async def extract_text_from_image(image_file: UploadFile = File(...)):
     """
-    Endpoint to extract text from prescription image using OCR
+    Endpoint to extract text from prescription image using OCR.
+    Uploads over MAX_UPLOAD_BYTES or images over MAX_IMAGE_PIXELS are rejected with 413.
     """
+    image = await checked_upload(image_file)
+    async with ocr_gate.slot():
+        try:
+            # OCR reads the spooled upload directly; it is never copied into one bytes object
+            ocr_processor = await ensure(get_ocr_processor)
+            extracted_text = await run_in_threadpool(ocr_processor.extract_text_from_image, image)
+            
+            return JSONResponse(content={
+                "extracted_text": extracted_text,
+                "success": True
+            })
+            
+        except Exception as e:
+            logger.error(f"OCR extraction error: {e}")
+            return JSONResponse(
+                status_code=500,
+                content={"success": False, "error": str(e)}
+            )
+
+@app.post("/analyze-image", response_model=ImageAnalysisResponse, dependencies=[requires("ocr")])
+async def analyze_prescription_image(
+    image_file: UploadFile = File(...),
+    patient: str = Form(...),
+    drugs: str = Form("[]"),
+    advice: bool = False,
+):
+    """
+    Single-hop endpoint: OCR the image and verify the result on the server.
+    `patient` and `drugs` are JSON-encoded form fields. The extracted text is
+    returned with the verdict so it can still be reviewed, edited and re-sent to /verify.
+    The response carries the triage decision; with ?advice=true Granite reviews the
+    prescription when triage calls for it (alerts, unknown drugs or low OCR confidence).
+    """
+    patient_info, listed_drugs = parse_analysis_form(patient, drugs)
+    image = await checked_upload(image_file)
+    slot = await ocr_gate.acquire()
+
     try:
-        # Read image file directly - no temp file needed
-        image_data = await image_file.read()
-        
-        # Extract text using OCR
-        extracted_text = ocr_processor.extract_text_from_image(image_data)
-        
-        return JSONResponse(content={
-            "extracted_text": extracted_text,
-            "success": True
-        })
-        
+        return await analyze_image_with_triage(image, patient_info, listed_drugs, advice, slot)
+
     except Exception as e:
-        logger.error(f"OCR extraction error: {e}")
-        return JSONResponse(
-            status_code=500,
-            content={"success": False, "error": str(e)}
-        )
+        logger.error(f"Image analysis error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/analyze-image/stream", dependencies=[requires("ocr")])
+async def analyze_prescription_image_stream(
+    image_file: UploadFile = File(...),
+    patient: str = Form(...),
+    drugs: str = Form("[]"),
+    advice: bool = False,
+):
+    """Same as /analyze-image, streaming per-stage progress as server-sent events."""
+    patient_info, listed_drugs = parse_analysis_form(patient, drugs)
+    image = await checked_upload(image_file)
+
+    async def run(on_stage):
+        return await analyze_image_with_triage(image, patient_info, listed_drugs, advice, slot, on_stage)
+
+    slot = await ocr_gate.acquire()
+    return HeldResponse(stage_event_response(run), slot)
+
+async def analyze_image_with_triage(image, patient: Patient, drugs, advice: bool, ocr_slot, on_stage=None):
+    """Image pipeline under an admitted OCR slot, released before the (LLM-gated) advice step"""
+    try:
+        extracted_text, verification, decision = await pipeline.analyze_image(image, patient, drugs, on_stage)
+    finally:
+        ocr_slot.release()
+    result = ImageAnalysisResponse(extracted_text=extracted_text, verification=verification, triage=decision)
+    if advice:
+        result.advice = await triaged_advice(decision, pipeline.advice_text(extracted_text, drugs), patient, on_stage)
+    return result
+
+def parse_analysis_form(patient: str, drugs: str):
+    """Parse the JSON-encoded patient and drugs form fields of the image endpoints"""
+    try:
+        return Patient(**json.loads(patient)), [Drug(**d) for d in json.loads(drugs)]
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Invalid form data: {e}")
+
+@app.post("/advice", dependencies=[requires("llm")])
+async def generate_advice(request: AdviceRequest):
+    """
+    AI analysis of a prescription with the Granite model.
+    While the model is still loading, requests wait up to GRANITE_READY_TIMEOUT
+    seconds and are then rejected with 503 and a Retry-After header.
+    Repeat prescriptions for the same age band are answered from the advice cache.
+    """
+    result, not_ready = await advise(request.text_input, request.patient.age)
+    if not_ready:
+        return not_ready
+    if not result.get("success"):
+        return JSONResponse(status_code=500, content=result)
+    return result
+
+@app.post("/advice/stream", dependencies=[requires("llm")])
+async def generate_advice_stream(request: AdviceRequest):
+    """
+    Granite analysis streamed as server-sent events: `token` events carry decoded
+    text as it is generated, the final `result` event carries time-to-first-token,
+    generated tokens and tokens/sec (or an `error` event). A cached answer is sent
+    as a single `token` event followed by a `result` event with `cached: true`.
+    """
+    text, cache_key = advice_request_key(request.text_input, request.patient.age)
+    cached = None
+    if cache_key is not None:
+        cached = await run_in_threadpool(advice_cache.get, cache_key)
+    if cached is not None:
+        async def cached_events():
+            yield "token", {"text": cached["analysis"]}
+            yield "result", {"model": cached["model"], "success": True, "cached": True,
+                             "generated_tokens": cached.get("generated_tokens")}
+        return sse_response(cached_events())
+
+    slot = await llm_gate.acquire()
+    try:
+        not_ready = await wait_for_model()
+    except BaseException:
+        slot.release()
+        raise
+    if not_ready:
+        slot.release()
+        return not_ready
+
+    llm = await ensure(get_llm)
+
+    async def events():
+        chunks = llm.stream(text, request.patient.age)
+        parts = []
+        started = time.perf_counter()
+        try:
+            async for chunk in iterate_in_threadpool(chunks):
+                if "text" in chunk:
+                    parts.append(chunk["text"])
+                    yield "token", chunk
+                    continue
+                metrics.observe_stage("granite_generate", time.perf_counter() - started)
+                if chunk.get("success") and cache_key is not None:
+                    await run_in_threadpool(advice_cache.put, cache_key, {
+                        "model": chunk["model"], "analysis": "".join(parts),
+                        "generated_tokens": chunk["generated_tokens"], "success": True,
+                    })
+                yield ("result" if chunk.get("success") else "error"), chunk
+        finally:
+            # Client gone: closing the generator stops generation. If a threadpool thread is still
+            # inside it, it is closed (and generation stopped) when that thread lets go of it.
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except ValueError:
+                    pass
+
+    return HeldResponse(sse_response(events()), slot)
+
+def advice_request_key(text_input: str, patient_age: int):
+    """
+    (prescription text to generate from, advice cache key or None).
+    Generation always sees the caller's text; requests whose texts differ only in
+    formatting (case, spacing, units, punctuation) share a cache entry.
+    """
+    if not cache_enabled():
+        return text_input, None
+    return text_input, advice_cache.key(config.GRANITE_MODEL, text_input, patient_age)
+
+async def advise(text_input: str, patient_age: int):
+    """
+    Advice from the cache, or generated once the model is ready (concurrent requests
+    are batched into one generate call). Returns (result, None), or (None, 503 response)
+    when the model is not ready in time. Raises 429 when the LLM queue is full.
+    """
+    text, cache_key = advice_request_key(text_input, patient_age)
+    if cache_key is not None:
+        cached = await run_in_threadpool(advice_cache.get, cache_key)
+        if cached is not None:
+            return {**cached, "cached": True}, None
+
+    async with llm_gate.slot():
+        not_ready = await wait_for_model()
+        if not_ready:
+            return None, not_ready
+        llm = await ensure(get_llm)
+        with stage("granite_generate"):
+            result = await asyncio.wrap_future(llm.runner.submit(text, patient_age))
+    if result.get("success") and cache_key is not None:
+        await run_in_threadpool(advice_cache.put, cache_key, result)
+    return result, None
+
+async def triaged_advice(decision, text_input: str, patient: Patient, on_stage=None):
+    """Granite review of a verified prescription, only when triage asked for one"""
+    if not decision.needs_advice:
+        return None
+    if not config.serves("llm"):
+        return {"success": False, "error": "Granite review is not served by this worker"}
+    logger.info(f"Granite review requested: {'; '.join(decision.reasons)}")
+    with stage("advice", on_stage) as info:
+        try:
+            result, not_ready = await advise(text_input, patient.age)
+        except HTTPException as e:
+            # The verdict still goes out when the LLM is overloaded, just without the review
+            result, not_ready = {"success": False, "error": e.detail}, None
+        if not_ready:
+            result = {"success": False, "error": "Model not ready"}
+        info["success"] = result.get("success", False)
+    return result
+
+async def wait_for_model():
+    """Wait up to GRANITE_READY_TIMEOUT for the model; returns a 503 response if it is not ready"""
+    lifecycle = (await ensure(get_llm)).lifecycle
+    lifecycle.start()
+    if await run_in_threadpool(lifecycle.wait_until_ready, config.GRANITE_READY_TIMEOUT):
+        return None
+    status = lifecycle.status()
+    return JSONResponse(
+        status_code=503,
+        content={"success": False, "error": f"Model not ready ({status['state']})"},
+        headers={"Retry-After": "10"},
+    )
+
+@app.get("/health")
+async def health():
+    """Liveness plus per-subsystem readiness; reports nothing it would have to import"""
+    llm = get_llm().status() if loaded(get_llm) else {"state": "not loaded", "ready": False}
+    return {
+        "status": "ok",
+        "roles": sorted(config.APP_ROLE),
+        "import_seconds": import_seconds,
+        "llm": {**llm, "advice_cache": advice_cache.stats()},
+        "ocr": ocr_pool.status() if ocr_pool is not None else {"workers": 0, "ready": loaded(get_ocr_processor)},
+        "triage": triage_stats.stats(),
+        "admission": admission_stats(),
+    }
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus text format: stage latency histograms, queue depths, in-flight counts, cache hits"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/profiles/{profile_id}")
+def get_profile(profile_id: str, artifact: str = "json", x_profile_token: Optional[str] = Header(None)):
+    """
+    A saved request profile (see app.profiling): artifact is json (summary), svg (flamegraph),
+    folded (folded stacks) or pstats; needs the X-Profile-Token header
+    """
+    if not profiling.authorized(x_profile_token):
+        raise HTTPException(status_code=404, detail="Not found")
+    path = profiling.artifact_path(profile_id, artifact)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"No {artifact} artifact for profile {profile_id}")
+    return FileResponse(path, media_type=profiling.ARTIFACT_TYPES[artifact], filename=os.path.basename(path))
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness probe: 503 until the subsystems this worker preloads are up, i.e. the
+    Granite model is loaded and warmed up and the OCR stack is imported or the OCR workers are up
+    """
+    status = {"roles": sorted(config.APP_ROLE), "ready": True}
+    if config.serves("ocr") and config.OCR_PRELOAD:
+        status["ocr"] = {"ready": loaded(get_ocr_processor) and (ocr_pool is None or ocr_pool.ready.is_set())}
+        status["ready"] &= status["ocr"]["ready"]
+    if config.serves("llm") and config.GRANITE_PRELOAD:
+        status["llm"] = get_llm().lifecycle.status() if loaded(get_llm) else {"state": "not loaded", "ready": False}
+        status["ready"] &= status["llm"]["ready"]
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
 
 @app.get("/")
 async def root():
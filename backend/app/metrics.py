@@ -0,0 +1,187 @@
+"""
+Prometheus metrics, exposed in the text format on /metrics.
+
+Every pipeline stage timed with stages.stage() lands in one latency
+histogram, labelled by stage (and Tesseract PSM for the OCR passes). An
+observation is a bisect plus two increments under a lock, about a
+microsecond, so it stays on in production. Everything else (queue depths,
+in-flight counts, cache hits) is read from the components' own counters at
+scrape time by collectors they register here, so it costs nothing per request.
+
+OCR worker processes cannot observe into this registry; they return their
+observations with each result and the pool records them in the parent.
+Under the multi-worker server every API worker writes a snapshot to
+METRICS_DIR about once a second, and /metrics sums the snapshots of all
+workers: counters and histograms of exited workers are kept, gauges only
+come from live ones.
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# Seconds; from sub-millisecond rule checks up to a minute of OCR or generation
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    """Fixed-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...], buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> non-cumulative count per bucket, then the +Inf bucket, then the sum
+        self.series: Dict[Tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, labels: Tuple[str, ...]):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(labels)
+            if counts is None:
+                counts = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            series = [[list(labels), list(counts)] for labels, counts in self.series.items()]
+        return {"help": self.help, "labelnames": list(self.labelnames), "buckets": list(self.buckets),
+                "series": series}
+
+stage_seconds = Histogram("medsafe_stage_seconds", "Latency of each pipeline stage", ("stage", "psm"))
+
+# Set in OCR worker processes: observations are handed to this instead of the local histogram
+forward: Optional[Callable[[Tuple[Tuple[str, str], float]], None]] = None
+
+def observe_stage(name: str, seconds: float, psm=None):
+    labels = (name, "" if psm is None else str(psm))
+    if forward is not None:
+        forward((labels, seconds))
+    else:
+        stage_seconds.observe(seconds, labels)
+
+def record_observations(observations: List[Tuple[Tuple[str, str], float]]):
+    """Record stage observations made in a worker process"""
+    for labels, seconds in observations:
+        stage_seconds.observe(seconds, tuple(labels))
+
+# A sample is (name, "counter" | "gauge", help, labels, value)
+Sample = Tuple[str, str, str, Dict[str, str], float]
+collectors: List[Callable[[], List[Sample]]] = []
+
+def register_collector(collector: Callable[[], List[Sample]]):
+    """Register a function returning the current samples of a component, called at scrape time"""
+    collectors.append(collector)
+
+def snapshot() -> Dict:
+    samples = []
+    for collector in collectors:
+        try:
+            samples.extend(collector())
+        except Exception as e:
+            logger.warning(f"Metrics collector {collector.__name__} failed: {e}")
+    return {"pid": os.getpid(), "histograms": {stage_seconds.name: stage_seconds.snapshot()}, "samples": samples}
+
+def write_snapshot():
+    """Publish this worker's snapshot for the others to merge (atomically, via rename)"""
+    path = os.path.join(config.METRICS_DIR, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+def start_publishing(interval: float = 1.0):
+    """Under the multi-worker server: keep this worker's snapshot in METRICS_DIR fresh"""
+    if not config.METRICS_DIR:
+        return
+
+    def publish():
+        while True:
+            try:
+                write_snapshot()
+            except OSError as e:
+                logger.warning(f"Could not write metrics snapshot: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=publish, name="metrics-publisher", daemon=True).start()
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def worker_snapshots() -> List[Dict]:
+    """This worker's live snapshot plus the published ones of the other workers"""
+    own = snapshot()
+    if not config.METRICS_DIR:
+        return [own]
+    snapshots = [own]
+    for entry in os.listdir(config.METRICS_DIR):
+        if not entry.endswith(".json") or entry == f"{own['pid']}.json":
+            continue
+        try:
+            with open(os.path.join(config.METRICS_DIR, entry)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+def render() -> str:
+    """All metrics of all workers in the Prometheus text exposition format"""
+    snapshots = worker_snapshots()
+    lines = []
+
+    histograms: Dict[str, Dict] = {}
+    for snap in snapshots:
+        for name, histogram in snap["histograms"].items():
+            merged = histograms.setdefault(name, {**histogram, "series": {}})
+            for labels, counts in histogram["series"]:
+                total = merged["series"].setdefault(tuple(labels), [0] * len(counts))
+                merged["series"][tuple(labels)] = [a + b for a, b in zip(total, counts)]
+    for name, histogram in histograms.items():
+        lines += [f"# HELP {name} {histogram['help']}", f"# TYPE {name} histogram"]
+        for labels, counts in sorted(histogram["series"].items()):
+            base = dict(zip(histogram["labelnames"], labels))
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"] + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels({**base, 'le': str(bound)})} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(base)} {counts[-1]}")
+            lines.append(f"{name}_count{format_labels(base)} {cumulative}")
+
+    # Counters of exited workers still count; their gauges do not
+    families: Dict[str, Tuple[str, str, Dict]] = {}
+    own_pid = os.getpid()
+    for snap in snapshots:
+        live = snap["pid"] == own_pid or alive(snap["pid"])
+        for name, kind, help, labels, value in snap["samples"]:
+            if kind == "gauge" and not live:
+                continue
+            _, _, values = families.setdefault(name, (kind, help, {}))
+            key = tuple(sorted(labels.items()))
+            values[key] = values.get(key, 0) + value
+    for name, (kind, help, values) in families.items():
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        for labels, value in sorted(values.items()):
+            lines.append(f"{name}{format_labels(dict(labels))} {value}")
+    return "\n".join(lines) + "\n"
@@ -38,4 +38,35 @@ class VerificationResponse(BaseModel):
     interactions: List[InteractionAlert] = []
     dosage_alerts: List[DosageAlert] = []
     alternatives: List[AlternativeSuggestion] = []
-    extracted_drugs: List[Drug] = []
\ No newline at end of file
+    extracted_drugs: List[Drug] = []
+
+class TriageDecision(BaseModel):
+    needs_advice: bool
+    reasons: List[str] = []
+    unrecognized_drugs: List[str] = []
+    ocr_confidence: Optional[float] = None
+
+class ImageAnalysisResponse(BaseModel):
+    success: bool = True
+    extracted_text: str = ""
+    verification: VerificationResponse
+    triage: Optional[TriageDecision] = None
+    advice: Optional[dict] = None
+
+
+class SessionUpdate(BaseModel):
+    text_input: Optional[str] = None
+    patient: Optional[Patient] = None
+
+class SessionResponse(BaseModel):
+    session_id: str
+    verification: VerificationResponse
+
+class AdviceRequest(BaseModel):
+    patient: Patient
+    text_input: str
+
+class AssessmentResponse(BaseModel):
+    verification: VerificationResponse
+    triage: TriageDecision
+    advice: Optional[dict] = None
@@ -1,17 +1,6 @@
-import re
 from typing import List, Dict
 
-# Common drug names for pattern matching
-COMMON_DRUGS = [
-    "aspirin", "ibuprofen", "acetaminophen", "paracetamol", "metformin", 
-    "lisinopril", "atorvastatin", "metoprolol", "omeprazole", "simvastatin",
-    "losartan", "amlodipine", "hydrochlorothiazide", "prednisone", "tramadol",
-    "gabapentin", "furosemide", "warfarin", "clopidogrel", "pantoprazole",
-    "sertraline", "fluoxetine", "citalopram", "venlafaxine", "duloxetine",
-    "albuterol", "montelukast", "fluticasone", "loratadine", "diphenhydramine",
-    "amoxicillin", "azithromycin", "clarithromycin", "doxycycline", "cephalexin",
-    "ciprofloxacin", "levofloxacin", "penicillin", "erythromycin", "tetracycline"
-]
+from .knowledge_base import COMMON_DRUGS, knowledge_base
 
 def extract_drugs_from_text(prescription_text: str) -> List[Dict[str, str]]:
     """
@@ -38,15 +27,8 @@ def extract_drugs_from_text(prescription_text: str) -> List[Dict[str, str]]:
             })
     
     # Look for patterns like "Drug Name 500mg" or "Drug Name tablets"
-    drug_patterns = [
-        r'\b([A-Z][a-z]+(?:[A-Z][a-z]+)*)\s*(\d+\s*mg)\s*(?:once|twice|daily|bid|tid|qid)?',
-        r'\b([A-Z][a-z]+(?:[A-Z][a-z]+)*)\s*(?:tablets?|capsules?)\s*(?:of\s*)?(\d+\s*mg)?',
-        r'Rx:\s*([A-Z][a-z]+(?:[A-Z][a-z]+)*)\s*(\d+\s*mg)?',
-        r'Take\s+([A-Z][a-z]+(?:[A-Z][a-z]+)*)\s*(\d+\s*mg)?',
-    ]
-    
-    for pattern in drug_patterns:
-        matches = re.finditer(pattern, prescription_text, re.IGNORECASE)
+    for pattern in knowledge_base.name_patterns:
+        matches = pattern.finditer(prescription_text)
         for match in matches:
             drug_name = match.group(1).title()
             dosage = match.group(2) if len(match.groups()) > 1 else None
@@ -73,15 +55,8 @@ def extract_drugs_from_text(prescription_text: str) -> List[Dict[str, str]]:
 def extract_dosage_for_drug(text: str, drug_name: str) -> str:
     """Extract dosage information for a specific drug"""
     # Look for patterns like "drugname 500mg" or "500mg drugname"
-    patterns = [
-        rf'{drug_name}\s+(\d+\s*mg)',
-        rf'(\d+\s*mg)\s+{drug_name}',
-        rf'{drug_name}\s+(\d+\s*mg)\s+',
-        rf'tablets?\s+of\s+{drug_name}\s+(\d+\s*mg)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in knowledge_base.dosage_matchers_for(drug_name):
+        match = pattern.search(text)
         if match:
             return match.group(1)
     
@@ -90,13 +65,8 @@ def extract_dosage_for_drug(text: str, drug_name: str) -> str:
 def extract_frequency_for_drug(text: str, drug_name: str) -> str:
     """Extract frequency information for a specific drug"""
     # Look for frequency patterns near the drug name
-    frequency_patterns = [
-        rf'{drug_name}.*?(once|twice|thrice|daily|every day|qd|bid|tid|qid)',
-        rf'(once|twice|thrice|daily|every day|qd|bid|tid|qid).*?{drug_name}',
-    ]
-    
-    for pattern in frequency_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in knowledge_base.frequency_matchers_for(drug_name):
+        match = pattern.search(text)
         if match:
             return match.group(1)
     
@@ -108,7 +78,7 @@ def extract_frequency(text: str, drug_name: str) -> str:
     frequency_terms = ['once', 'twice', 'thrice', 'daily', 'every day', 'qd', 'bid', 'tid', 'qid']
     
     # Look for frequency terms in the same sentence as the drug
-    sentences = re.split(r'[.!?]', text)
+    sentences = knowledge_base.sentence_split.split(text)
     for sentence in sentences:
         if drug_name in sentence.lower():
             for term in frequency_terms:
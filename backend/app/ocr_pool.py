@@ -0,0 +1,349 @@
+"""
+OCR in dedicated worker processes, with uploads handed over in shared memory.
+
+Pickling an upload through a multiprocessing queue copies it into the pipe
+and out again on the other side. Instead the parent keeps a pool of
+shared-memory buffers (MAX_UPLOAD_BYTES each), copies the spooled upload
+straight into a free one, and sends the worker only a (segment name, length)
+descriptor. The worker decodes the image directly from the shared segment,
+so the encoded bytes cross the process boundary without another copy; the
+decoded and preprocessed arrays never leave the worker. Only stage events,
+stage timings for /metrics, trace spans and the extracted text come back
+through the result queue; the request's span context goes along with the
+descriptor, so the worker's stage spans join the request's trace. Buffers go back to the
+pool when the request finishes; an upload too large for them (only possible
+when called outside the upload limit) gets a one-off segment.
+
+Like the Granite inference pool, each worker has its own request queue, the
+parent sends each request to the least busy ready worker, and a monitor
+thread restarts a worker that dies and fails only the requests sent to it.
+cv2, PIL and pytesseract are imported inside the workers only.
+"""
+import io
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Tuple
+
+from . import config, metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+class SharedBufferReader(io.RawIOBase):
+    """Read-only, seekable file over a memoryview, so PIL decodes straight from shared memory"""
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), len(self.view) - self.position)
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.view)}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+def upload_size(image_data) -> int:
+    """Length of an upload given as bytes or as a binary file"""
+    if not hasattr(image_data, "read"):
+        return len(image_data)
+    size = image_data.seek(0, io.SEEK_END)
+    image_data.seek(0)
+    return size
+
+def copy_into(view: memoryview, image_data) -> int:
+    """Copy an upload into a shared buffer, from a file without an intermediate bytes object; returns its length"""
+    if not hasattr(image_data, "read"):
+        view[:len(image_data)] = image_data
+        return len(image_data)
+    length = 0
+    while True:
+        read = image_data.readinto(view[length:])
+        if not read:
+            return length
+        length += read
+
+class BufferPool:
+    """Fixed set of shared-memory segments, recycled between requests"""
+
+    def __init__(self, count: int, size: int):
+        self.size = size
+        self.segments = [shared_memory.SharedMemory(create=True, size=size) for _ in range(count)]
+        self.free: "queue.Queue[shared_memory.SharedMemory]" = queue.Queue()
+        for segment in self.segments:
+            self.free.put(segment)
+        self.oneoff = 0
+
+    def acquire(self, size: int) -> Tuple[shared_memory.SharedMemory, bool]:
+        """A segment of at least `size` bytes and whether it is pooled; blocks until one is free"""
+        if size > self.size:
+            self.oneoff += 1
+            return shared_memory.SharedMemory(create=True, size=max(1, size)), False
+        return self.free.get(), True
+
+    def release(self, segment: shared_memory.SharedMemory, pooled: bool):
+        if pooled:
+            self.free.put(segment)
+        else:
+            segment.close()
+            segment.unlink()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+
+    def stats(self) -> Dict:
+        return {
+            "buffers": len(self.segments),
+            "buffer_mb": round(self.size / (1024 * 1024), 1),
+            "free": self.free.qsize(),
+            "oneoff_segments": self.oneoff,
+        }
+
+def worker_main(index: int, requests, results):
+    """Worker process: import the OCR stack once, then serve descriptors until a None sentinel"""
+    from .ocr_processor import ocr_processor
+
+    # Stage timings and spans go back to the parent with each result, for its /metrics and exporter
+    observations, spans = [], []
+    metrics.forward = observations.append
+    tracing.forward = spans.append
+    results.put(("ready", index, None))
+    attached: Dict[str, shared_memory.SharedMemory] = {}
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        request_id, name, length, pooled, span_context = item
+
+        def on_stage(stage_name, **info):
+            results.put(("stage", index, (request_id, stage_name, info)))
+
+        segment = attached.get(name) or shared_memory.SharedMemory(name=name)
+        if pooled:
+            attached[name] = segment
+        reader = SharedBufferReader(segment.buf[:length])
+        context_token = tracing.current.set(span_context)
+        try:
+            result = ocr_processor.extract_text_with_confidence(reader, on_stage)
+        except Exception as e:
+            logger.error(f"OCR worker {index} failed on request {request_id}: {e}")
+            result = ("", None)
+        finally:
+            tracing.current.reset(context_token)
+            reader.close()
+            if not pooled:
+                segment.close()
+        results.put(("done", index, (request_id, result, observations[:], spans[:])))
+        observations.clear()
+        spans.clear()
+
+class OCRPool:
+    """N OCR worker processes fed through shared-memory buffers"""
+
+    def __init__(self, workers: Optional[int] = None, buffers: Optional[int] = None,
+                 buffer_size: Optional[int] = None):
+        self.workers = workers or config.OCR_WORKERS
+        self.buffer_count = buffers or config.OCR_BUFFERS or 2 * self.workers
+        self.buffer_size = buffer_size or config.MAX_UPLOAD_BYTES
+        self.buffers: Optional[BufferPool] = None
+        self.processes: Dict[int, object] = {}
+        self.queues: Dict[int, object] = {}
+        self.ready_workers = set()
+        self.ready = threading.Event()
+        self.in_flight: Dict[int, set] = {}
+        self.pending: Dict[int, "queue.Queue"] = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.restarts = 0
+        self.started = False
+        self.stopping = False
+
+    def start(self):
+        """
+        Create the buffers, spawn the workers and the collector and monitor threads; idempotent.
+        The pool only counts as started once every worker has been spawned: if that fails,
+        whatever was created is torn down and the next call tries again.
+        """
+        with self.lock:
+            if self.started:
+                return
+            import multiprocessing
+            self.context = multiprocessing.get_context("spawn")
+            self.results = self.context.Queue()
+            self.buffers = BufferPool(self.buffer_count, self.buffer_size)
+            try:
+                for index in range(self.workers):
+                    self.spawn(index)
+            except Exception:
+                for process in self.processes.values():
+                    process.terminate()
+                self.processes.clear()
+                self.queues.clear()
+                self.in_flight.clear()
+                self.buffers.close()
+                self.buffers = None
+                raise
+            self.started = True
+        threading.Thread(target=self.collect, name="ocr-pool-results", daemon=True).start()
+        threading.Thread(target=self.monitor, name="ocr-pool-monitor", daemon=True).start()
+        logger.info(f"Started {self.workers} OCR workers with {self.buffer_count} shared buffers")
+
+    def forget(self):
+        """
+        In a child forked from a process that had started the pool: the worker processes,
+        buffers and threads belong to the parent, so start over with an empty pool
+        """
+        self.__init__(self.workers, self.buffer_count, self.buffer_size)
+
+    def spawn(self, index: int):
+        """Start worker `index` with a fresh request queue; caller holds the lock"""
+        self.queues[index] = self.context.Queue()
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.queues[index], self.results),
+            name=f"ocr-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        self.in_flight[index] = set()
+
+    def stop(self):
+        """Ask every worker to exit after its current request, then free the shared buffers"""
+        if not self.started:
+            return
+        self.stopping = True
+        for requests in self.queues.values():
+            requests.put(None)
+        for process in self.processes.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.buffers.close()
+
+    def extract_text_with_confidence(self, image_data, on_stage=None) -> Tuple[str, Optional[float]]:
+        """Same contract as OCRProcessor.extract_text_with_confidence, served by a worker process"""
+        self.start()
+        segment, pooled = self.buffers.acquire(upload_size(image_data))
+        try:
+            length = copy_into(segment.buf, image_data)
+            events = queue.Queue()
+            with self.lock:
+                request_id = next(self.ids)
+                candidates = self.ready_workers or set(self.processes)
+                if not candidates:
+                    raise RuntimeError("No OCR workers running")
+                index = min(candidates, key=lambda i: len(self.in_flight[i]))
+                self.pending[request_id] = events
+                self.in_flight[index].add(request_id)
+                span_context = tracing.current.get() if tracing.enabled else None
+                self.queues[index].put((request_id, segment.name, length, pooled, span_context))
+            while True:
+                kind, payload = events.get()
+                if kind == "done":
+                    return payload
+                if on_stage is not None:
+                    name, info = payload
+                    on_stage(name, **info)
+        finally:
+            self.buffers.release(segment, pooled)
+
+    def extract_text_from_image(self, image_data, on_stage=None) -> str:
+        return self.extract_text_with_confidence(image_data, on_stage)[0]
+
+    def collect(self):
+        """Route worker messages to the waiting requests"""
+        while True:
+            kind, index, payload = self.results.get()
+            with self.lock:
+                if kind == "ready":
+                    self.ready_workers.add(index)
+                    self.ready.set()
+                elif kind == "stage":
+                    request_id, name, info = payload
+                    events = self.pending.get(request_id)
+                    if events is not None:
+                        events.put(("stage", (name, info)))
+                elif kind == "done":
+                    request_id, result, observations, spans = payload
+                    metrics.record_observations(observations)
+                    if spans:
+                        tracing.export(spans)
+                    self.in_flight[index].discard(request_id)
+                    self.finish(request_id, result)
+
+    def finish(self, request_id: int, result: Tuple[str, Optional[float]]):
+        """Resolve a pending request; caller holds the lock"""
+        events = self.pending.pop(request_id, None)
+        if events is not None:
+            events.put(("done", result))
+
+    def monitor(self):
+        """Restart crashed workers and fail the requests that had been sent to them"""
+        while not self.stopping:
+            time.sleep(1)
+            for index, process in list(self.processes.items()):
+                if process.is_alive() or self.stopping:
+                    continue
+                logger.error(f"OCR worker {index} exited with code {process.exitcode}, restarting")
+                with self.lock:
+                    self.ready_workers.discard(index)
+                    if not self.ready_workers:
+                        self.ready.clear()
+                    for request_id in self.in_flight[index]:
+                        self.finish(request_id, ("", None))
+                    self.restarts += 1
+                    self.spawn(index)
+
+    def status(self) -> Dict:
+        with self.lock:
+            return {
+                "ready": self.ready.is_set(),
+                "workers": self.workers,
+                "ready_workers": len(self.ready_workers),
+                "in_flight": sum(len(rids) for rids in self.in_flight.values()),
+                "restarts": self.restarts,
+                **(self.buffers.stats() if self.buffers is not None else {}),
+            }
+
+# Global instance
+ocr_pool = OCRPool() if config.OCR_WORKERS > 0 else None
+if ocr_pool is not None:
+    # A forked API worker must not use its parent's pool (it has no collector thread there)
+    os.register_at_fork(after_in_child=ocr_pool.forget)
+
+def ocr_pool_samples():
+    status = ocr_pool.status()
+    return [
+        ("medsafe_ocr_workers_ready", "gauge", "OCR worker processes ready", {}, status["ready_workers"]),
+        ("medsafe_ocr_in_flight", "gauge", "Images sent to OCR workers", {}, status["in_flight"]),
+        ("medsafe_ocr_buffers_free", "gauge", "Shared-memory upload buffers free", {}, status.get("free", 0)),
+        ("medsafe_ocr_worker_restarts_total", "counter", "OCR worker processes restarted", {}, status["restarts"]),
+    ]
+
+if ocr_pool is not None:
+    metrics.register_collector(ocr_pool_samples)
@@ -2,15 +2,25 @@ import pytesseract
 from PIL import Image
 import cv2
 import numpy as np
+import contextvars
 import logging
 import io
 import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from .stages import stage
 
 logger = logging.getLogger(__name__)
 
+# Page segmentation modes tried on every image; the longest result wins
+PSM_MODES = [6, 8, 11, 12]
+
 class OCRProcessor:
     def __init__(self):
         logger.info("OCR Processor initialized")
+        # Each Tesseract pass runs in its own subprocess, so the passes can overlap
+        self.executor = ThreadPoolExecutor(max_workers=len(PSM_MODES), thread_name_prefix="ocr-psm")
         # Medical terms dictionary for correction
         self.medical_words = [
             "amoxicillin", "atorvastatin", "ibuprofen", "metformin",
@@ -26,31 +36,36 @@ class OCRProcessor:
     def preprocess_image(self, image):
         """Enhanced preprocessing for prescription images"""
         # Convert to OpenCV format
-        img_cv = np.array(image)
-        
-        # Convert to grayscale
-        if len(img_cv.shape) == 3:
-            img_cv = cv2.cvtColor(img_cv, cv2.COLOR_RGB2GRAY)
+        with stage("preprocess_grayscale"):
+            img_cv = np.array(image)
+            
+            # Convert to grayscale
+            if len(img_cv.shape) == 3:
+                img_cv = cv2.cvtColor(img_cv, cv2.COLOR_RGB2GRAY)
         
         # Noise reduction
-        img_cv = cv2.medianBlur(img_cv, 3)
-        img_cv = cv2.GaussianBlur(img_cv, (5, 5), 0)
+        with stage("preprocess_denoise"):
+            img_cv = cv2.medianBlur(img_cv, 3)
+            img_cv = cv2.GaussianBlur(img_cv, (5, 5), 0)
         
         # Contrast enhancement
-        img_cv = cv2.convertScaleAbs(img_cv, alpha=1.5, beta=40)
+        with stage("preprocess_contrast"):
+            img_cv = cv2.convertScaleAbs(img_cv, alpha=1.5, beta=40)
         
         # Multiple thresholding techniques
-        _, thresh1 = cv2.threshold(img_cv, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        thresh2 = cv2.adaptiveThreshold(img_cv, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                                      cv2.THRESH_BINARY, 11, 2)
-        
-        # Combine results
-        processed = cv2.bitwise_or(thresh1, thresh2)
+        with stage("preprocess_threshold"):
+            _, thresh1 = cv2.threshold(img_cv, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            thresh2 = cv2.adaptiveThreshold(img_cv, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
+                                          cv2.THRESH_BINARY, 11, 2)
+            
+            # Combine results
+            processed = cv2.bitwise_or(thresh1, thresh2)
         
         # Morphological operations to clean up text
-        kernel = np.ones((2, 2), np.uint8)
-        processed = cv2.morphologyEx(processed, cv2.MORPH_CLOSE, kernel)
-        processed = cv2.dilate(processed, kernel, iterations=1)
+        with stage("preprocess_morphology"):
+            kernel = np.ones((2, 2), np.uint8)
+            processed = cv2.morphologyEx(processed, cv2.MORPH_CLOSE, kernel)
+            processed = cv2.dilate(processed, kernel, iterations=1)
         
         return processed
 
@@ -108,41 +123,93 @@ class OCRProcessor:
         
         return ' '.join(corrected_words)
 
-    def extract_text_from_image(self, image_data: bytes) -> str:
+    def decode_image(self, image_data):
+        """Decode uploaded bytes (or a binary file such as a spooled upload) into a PIL image"""
+        return Image.open(image_data if hasattr(image_data, "read") else io.BytesIO(image_data))
+
+    def run_psm_pass(self, img_cv, psm: int, on_stage=None) -> Tuple[str, Optional[float]]:
         """
-        Extract text from prescription image using enhanced OCR
+        Run a single Tesseract pass with the given page segmentation mode.
+        Returns (text, mean word confidence 0-100). Text is rebuilt from the word
+        boxes of the same pass; postprocessing collapses whitespace anyway.
         """
+        with stage("ocr_pass", on_stage, psm=psm) as info:
+            config = self.get_medical_config(psm)
+            data = pytesseract.image_to_data(img_cv, config=config, output_type=pytesseract.Output.DICT)
+            lines, confidences = {}, []
+            for i, word in enumerate(data["text"]):
+                if not word.strip():
+                    continue
+                line = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+                lines.setdefault(line, []).append(word)
+                if float(data["conf"][i]) >= 0:
+                    confidences.append(float(data["conf"][i]))
+            text = "\n".join(" ".join(words) for words in lines.values()).strip()
+            confidence = round(sum(confidences) / len(confidences), 1) if confidences else None
+            info["chars"] = len(text)
+            info["confidence"] = confidence
+        return text, confidence
+
+    def run_ocr_passes(self, img_cv, on_stage=None):
+        """Run all PSM passes concurrently and return the non-empty results as (psm, text, confidence)"""
+        # Each pass runs in the request's context, so its spans and profile include the passes
+        futures = [
+            self.executor.submit(contextvars.copy_context().run, self.run_psm_pass, img_cv, psm, on_stage)
+            for psm in PSM_MODES
+        ]
+        results = [(psm, *future.result()) for psm, future in zip(PSM_MODES, futures)]
+        return [result for result in results if result[1]]
+
+    def postprocess_text(self, results) -> Tuple[str, Optional[float], Optional[int]]:
+        """
+        Pick the best pass (longest text) and apply medical corrections;
+        returns (text, confidence, psm of the chosen pass)
+        """
+        if not results:
+            return "", None, None
+        psm, best_text, confidence = max(results, key=lambda result: len(result[1]))
+
+        # Clean and enhance the text
+        with stage("clean_medical_text"):
+            cleaned_text = self.clean_medical_text(best_text)
+        with stage("dictionary_correction"):
+            enhanced_text = self.enhance_with_medical_dictionary(cleaned_text)
+        return enhanced_text, confidence, psm
+
+    def extract_text_from_image(self, image_data, on_stage=None) -> str:
+        """
+        Extract text from prescription image using enhanced OCR.
+        `on_stage` is called as each stage (decode, preprocess, every PSM pass, postprocess) completes.
+        """
+        return self.extract_text_with_confidence(image_data, on_stage)[0]
+
+    def extract_text_with_confidence(self, image_data, on_stage=None) -> Tuple[str, Optional[float]]:
+        """Like extract_text_from_image, also returning the mean word confidence of the chosen pass"""
         try:
-            # Convert bytes to image
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Preprocess image
-            img_cv = self.preprocess_image(image)
-            
-            # Try multiple PSM modes for better accuracy
-            texts = []
-            for psm in [6, 8, 11, 12]:  # Different page segmentation modes
-                config = self.get_medical_config(psm)
-                text = pytesseract.image_to_string(img_cv, config=config)
-                if text.strip():
-                    texts.append(text.strip())
-            
-            # Return the best result (longest text)
-            if texts:
-                best_text = max(texts, key=len)
-                
-                # Clean and enhance the text
-                cleaned_text = self.clean_medical_text(best_text)
-                enhanced_text = self.enhance_with_medical_dictionary(cleaned_text)
-                
-                logger.info(f"OCR extracted text: {enhanced_text}")
-                return enhanced_text
-            else:
-                return ""
-                
+            return self.extract(image_data, on_stage)
         except Exception as e:
             logger.error(f"OCR processing error: {e}")
-            return ""
+            return "", None
+
+    def extract(self, image_data, on_stage=None) -> Tuple[str, Optional[float]]:
+        """extract_text_with_confidence that raises on an undecodable image or a failed pass"""
+        # Convert bytes to image
+        with stage("decode", on_stage) as info:
+            image = self.decode_image(image_data)
+            info["width"], info["height"] = image.size
+
+        # Preprocess image
+        with stage("preprocess", on_stage):
+            img_cv = self.preprocess_image(image)
+
+        # Try multiple PSM modes for better accuracy
+        results = self.run_ocr_passes(img_cv, on_stage)
+
+        with stage("postprocess", on_stage) as info:
+            enhanced_text, confidence, info["chosen_psm"] = self.postprocess_text(results)
+        if enhanced_text:
+            logger.debug(f"OCR extracted text (confidence {confidence}): {enhanced_text}")
+        return enhanced_text, confidence
 
 # Global instance
 ocr_processor = OCRProcessor()
\ No newline at end of file
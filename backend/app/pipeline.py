@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from . import audit
+from .models import Drug, Patient, VerificationResponse
+from .nlp_utils import extract_drugs_from_text
+from .drug_utils import check_interactions, check_dosage, get_alternatives
+from .records import MODEL_TYPES
+from .stages import stage
+from .subsystems import ensure, get_ocr_processor
+from .triage import triage
+
+logger = logging.getLogger(__name__)
+
+def drugs_from_text(text: Optional[str], on_stage=None, types=MODEL_TYPES) -> List[Drug]:
+    """Run drug extraction on prescription text and convert to Drug objects"""
+    if not text:
+        return []
+    with stage("extraction", on_stage) as info:
+        extracted_drugs = extract_drugs_from_text(text)
+        info["drugs_found"] = len(extracted_drugs)
+    logger.debug(f"Extracted drugs from text: {extracted_drugs}")
+    return to_drug_objects(extracted_drugs, types.drug)
+
+def to_drug_objects(extracted_drugs, drug_cls=Drug) -> List[Drug]:
+    """Convert extract_drugs_from_text dictionaries to Drug objects"""
+    return [
+        drug_cls(
+            name=drug_info.get('name', ''),
+            dosage=drug_info.get('dosage', ''),
+            frequency=drug_info.get('frequency', '')
+        )
+        for drug_info in extracted_drugs
+    ]
+
+def check_drug_dosages(drugs: List[Drug], patient_age: int, on_stage=None, types=MODEL_TYPES):
+    """Check dosage for each drug"""
+    dosage_alerts = []
+    with stage("dosage", on_stage) as info:
+        for drug in drugs:
+            dosage_alerts.extend(check_dosage(drug, patient_age, types.dosage))
+        info["alerts"] = len(dosage_alerts)
+    return dosage_alerts
+
+def build_verification(drugs: List[Drug], patient: Patient, dosage_alerts=None, on_stage=None,
+                       types=MODEL_TYPES) -> VerificationResponse:
+    """
+    Run the rule checks on a list of drugs and assemble the verdict.
+    Dosage alerts that were already computed (e.g. while OCR was running) can be passed in.
+    `types` selects pydantic models (default) or the lightweight records of records.py.
+    """
+    if not drugs:
+        return types.verification(
+            is_safe=True,
+            extracted_drugs=[],
+            interactions=[],
+            dosage_alerts=[],
+            alternatives=[]
+        )
+
+    # 1. Check for drug interactions
+    with stage("interactions", on_stage) as info:
+        interaction_alerts = check_interactions(drugs, patient.age, types.interaction)
+        info["alerts"] = len(interaction_alerts)
+
+    # 2. Check dosage for each drug
+    if dosage_alerts is None:
+        dosage_alerts = check_drug_dosages(drugs, patient.age, on_stage, types)
+
+    return assemble_verification(drugs, patient, interaction_alerts, dosage_alerts, on_stage, types)
+
+def assemble_verification(drugs: List[Drug], patient: Patient, interaction_alerts, dosage_alerts, on_stage=None,
+                          types=MODEL_TYPES) -> VerificationResponse:
+    """Suggest alternatives for the alerts and build the final verdict"""
+    # 3. Suggest alternatives for problematic drugs
+    with stage("alternatives", on_stage) as info:
+        alternative_suggestions = suggest_alternatives(drugs, patient, interaction_alerts + dosage_alerts, types)
+        info["suggestions"] = len(alternative_suggestions)
+
+    # 4. Determine overall safety
+    is_safe = not (interaction_alerts or dosage_alerts)
+
+    return types.verification(
+        is_safe=is_safe,
+        extracted_drugs=drugs,
+        interactions=interaction_alerts,
+        dosage_alerts=dosage_alerts,
+        alternatives=alternative_suggestions
+    )
+
+def suggest_alternatives(drugs: List[Drug], patient: Patient, alerts, types=MODEL_TYPES):
+    """Suggest alternatives for the drugs targeted by interaction or dosage alerts"""
+    alternative_suggestions = []
+    for alert in alerts:
+        # Find the target drug
+        target_drug_name = alert.drug_a if hasattr(alert, 'drug_a') else alert.drug
+        target_drug = next(
+            (d for d in drugs if d.name.lower() == target_drug_name.lower()),
+            None
+        )
+        if target_drug:
+            # Use the appropriate attribute based on alert type
+            if hasattr(alert, 'description'):  # InteractionAlert
+                reason = alert.description
+            else:  # DosageAlert
+                reason = alert.issue
+
+            alts = get_alternatives(target_drug, patient, reason, types.alternative)
+            alternative_suggestions.extend(alts)
+    return alternative_suggestions
+
+def verify_prescription(drugs: List[Drug], text_input: Optional[str], patient: Patient, on_stage=None,
+                        types=MODEL_TYPES) -> VerificationResponse:
+    """Verify explicitly listed drugs plus any drugs found in the prescription text"""
+    if audit.enabled:
+        started = time.perf_counter()
+        stages, on_stage = audit.collect(on_stage)
+    drugs_to_check = list(drugs) + drugs_from_text(text_input, on_stage, types)
+    verification = build_verification(drugs_to_check, patient, on_stage=on_stage, types=types)
+    if audit.enabled:
+        audit.record("verify", drugs, text_input, patient, verification, started, stages)
+    return verification
+
+async def analyze_image(image_data, patient: Patient, drugs: Optional[List[Drug]] = None, on_stage=None):
+    """
+    Image-to-verdict pipeline: OCR -> drug extraction -> rule checks -> triage, all server side.
+    Dosage checks for explicitly listed drugs run while OCR is still in flight.
+    Returns (extracted_text, VerificationResponse, TriageDecision).
+    """
+    drugs = list(drugs or [])
+    if audit.enabled:
+        started = time.perf_counter()
+        stages, on_stage = audit.collect(on_stage)
+
+    ocr_processor = await ensure(get_ocr_processor)
+    ocr_task = asyncio.ensure_future(
+        run_in_threadpool(ocr_processor.extract_text_with_confidence, image_data, on_stage)
+    )
+    try:
+        listed_dosage_alerts = await run_in_threadpool(check_drug_dosages, drugs, patient.age)
+    except BaseException:
+        ocr_task.cancel()
+        raise
+    extracted_text, ocr_confidence = await ocr_task
+
+    text_drugs = await run_in_threadpool(drugs_from_text, extracted_text, on_stage)
+    dosage_alerts = listed_dosage_alerts + await run_in_threadpool(check_drug_dosages, text_drugs, patient.age, on_stage)
+
+    verification = await run_in_threadpool(build_verification, drugs + text_drugs, patient, dosage_alerts, on_stage)
+    decision = await run_in_threadpool(triage, verification, ocr_confidence, on_stage)
+    if audit.enabled:
+        # On the event loop: never wait for room in the audit queue
+        audit.record("analyze-image", drugs, extracted_text, patient, verification, started, stages, block=False)
+    return extracted_text, verification, decision
+
+def advice_text(text: Optional[str], drugs: List[Drug]) -> str:
+    """Prescription text for the model: the explicitly listed drugs followed by the free text"""
+    listed = [" ".join(part for part in (d.name, d.dosage, d.frequency) if part) for d in drugs]
+    return "\n".join(listed + ([text] if text else []))
@@ -0,0 +1,285 @@
+"""
+Opt-in profiling of single requests.
+
+Enabled only when PROFILE_TOKEN is set; otherwise the middleware is not even
+installed. A request that carries `X-Profile-Token: <PROFILE_TOKEN>` runs
+under a profiler, and its response gets an `X-Profile-Id` header naming the
+artifact saved in PROFILE_DIR (fetch it from GET /profiles/{id} with the same
+token). `X-Profile-Mode` picks the profiler:
+
+- sample (default): a sampling thread records the stacks of the threads
+  working on this request every PROFILE_INTERVAL_MS; saved as folded stacks
+  (<id>.folded, for flamegraph.pl, inferno or speedscope) and a flamegraph
+  (<id>.svg).
+- cprofile: deterministic cProfile of the same code, merged across threads
+  into <id>.pstats; better for fast requests such as /verify, whose rule
+  stages take less than one sampling interval.
+
+Work for one request hops between the event loop, the threadpool and the OCR
+pass threads, all shared with other requests. The request's context carries
+the active profile, and stages.stage() registers the current thread with it
+for the duration of each stage, so only that request's stages (OCR, NLP,
+rules, triage) are profiled. Stages run in OCR worker processes
+(OCR_WORKERS > 0) are not included, and neither are stages entered on the
+event loop thread (advice, granite_generate): they span awaits, during which
+the loop runs other requests' coroutines.
+"""
+import cProfile
+import hmac
+import html
+import json
+import logging
+import os
+import pstats
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+enabled = bool(config.PROFILE_TOKEN)
+# The profile of the request being handled in this context, if it asked for one
+active: ContextVar[Optional["Profile"]] = ContextVar("active_profile", default=None)
+
+MODES = ("sample", "cprofile")
+PROFILE_ID = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$")
+ARTIFACT_TYPES = {
+    "json": "application/json",
+    "svg": "image/svg+xml",
+    "folded": "text/plain",
+    "pstats": "application/octet-stream",
+}
+
+def authorized(token: Optional[str]) -> bool:
+    return enabled and token is not None and hmac.compare_digest(token.encode(), config.PROFILE_TOKEN.encode())
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def fold(frame) -> str:
+    """One stack as a folded line, outermost frame first"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+class Profile:
+    """Profiler state of one request; threads are profiled while inside one of its stages"""
+
+    def __init__(self, profile_id: str, mode: str, interval: float):
+        self.id = profile_id
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.depth: Dict[int, int] = {}  # thread ident -> nesting depth of stages
+        self.names: Dict[int, str] = {}
+        self.samples: Counter = Counter()
+        self.profilers: Dict[int, cProfile.Profile] = {}
+        self.finished: List[cProfile.Profile] = []
+        self.stages: Counter = Counter()
+        self.stopped = threading.Event()
+        self.started = time.perf_counter()
+        # Created by the middleware, so on the event loop thread, which is never profiled
+        self.loop_thread = threading.get_ident()
+
+    def start(self):
+        if self.mode == "sample":
+            threading.Thread(target=self.sample, name=f"profile-{self.id}", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def enter(self, stage_name: str):
+        ident = threading.get_ident()
+        if ident == self.loop_thread:
+            return
+        with self.lock:
+            depth = self.depth.get(ident, 0)
+            self.depth[ident] = depth + 1
+            self.names[ident] = threading.current_thread().name
+            self.stages[stage_name] += 1
+        if depth == 0 and self.mode == "cprofile":
+            profiler = cProfile.Profile()
+            self.profilers[ident] = profiler
+            profiler.enable()
+
+    def exit(self):
+        ident = threading.get_ident()
+        if ident == self.loop_thread:
+            return
+        with self.lock:
+            self.depth[ident] -= 1
+            outermost = self.depth[ident] == 0
+        if outermost and self.mode == "cprofile":
+            profiler = self.profilers.pop(ident)
+            profiler.disable()
+            self.finished.append(profiler)
+
+    def sample(self):
+        """Sampling thread: record the stacks of the threads currently inside a stage"""
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                threads = [ident for ident, depth in self.depth.items() if depth > 0]
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples[f"{self.names[ident]};{fold(frame)}"] += 1
+
+    def save(self, request: Dict) -> Dict:
+        """Write the artifacts plus a <id>.json summary; returns the summary"""
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        base = os.path.join(config.PROFILE_DIR, self.id)
+        summary = {
+            "id": self.id,
+            "mode": self.mode,
+            **request,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages": dict(self.stages),
+            "artifacts": [],
+        }
+        if self.mode == "sample":
+            summary["samples"] = sum(self.samples.values())
+            summary["interval_ms"] = self.interval * 1000
+        if self.samples:
+            with open(base + ".folded", "w") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in self.samples.items())
+            with open(base + ".svg", "w") as f:
+                f.write(flamegraph(self.samples, f"{request['method']} {request['path']} ({self.id})"))
+            summary["artifacts"] = [self.id + ".folded", self.id + ".svg"]
+        if self.finished:
+            stats = pstats.Stats(self.finished[0])
+            for profiler in self.finished[1:]:
+                stats.add(profiler)
+            stats.dump_stats(base + ".pstats")
+            summary["artifacts"] = [self.id + ".pstats"]
+        with open(base + ".json", "w") as f:
+            json.dump(summary, f, indent=2)
+        prune()
+        return summary
+
+def artifact_path(profile_id: str, artifact: str) -> Optional[str]:
+    """Path of a saved artifact, or None if there is none (or the id or artifact type is malformed)"""
+    if not PROFILE_ID.match(profile_id) or artifact not in ARTIFACT_TYPES:
+        return None
+    path = os.path.join(config.PROFILE_DIR, f"{profile_id}.{artifact}")
+    return path if os.path.exists(path) else None
+
+def prune():
+    """Keep the newest PROFILE_KEEP profiles"""
+    summaries = sorted(
+        (entry for entry in os.listdir(config.PROFILE_DIR) if entry.endswith(".json")),
+        key=lambda entry: os.path.getmtime(os.path.join(config.PROFILE_DIR, entry)),
+    )
+    for entry in summaries[:max(0, len(summaries) - config.PROFILE_KEEP)]:
+        profile_id = entry[:-len(".json")]
+        for artifact in ARTIFACT_TYPES:
+            try:
+                os.remove(os.path.join(config.PROFILE_DIR, f"{profile_id}.{artifact}"))
+            except FileNotFoundError:
+                pass
+
+def flamegraph(samples: Counter, title: str, width: int = 1200, row: int = 16) -> str:
+    """A self-contained SVG flamegraph of folded stacks (hover a frame for its sample count)"""
+    root: Dict = {"count": 0, "children": {}}
+    for stack, count in samples.items():
+        node = root
+        node["count"] += count
+        for label in stack.split(";"):
+            node = node["children"].setdefault(label, {"count": 0, "children": {}})
+            node["count"] += count
+
+    def depth(node) -> int:
+        return 1 + max((depth(child) for child in node["children"].values()), default=0)
+
+    total = max(1, root["count"])
+    height = (depth(root) + 1) * row + 30
+    rects = []
+
+    def draw(node, label: str, x: float, level: int):
+        w = node["count"] / total * width
+        if w < 0.5:
+            return
+        y = height - (level + 1) * row
+        hue = 20 + hash(label) % 40
+        text = html.escape(label)
+        share = node["count"] / total * 100
+        rects.append(
+            f'<g><title>{text} ({node["count"]} samples, {share:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row - 1}" fill="hsl({hue},80%,60%)"/>'
+            + (f'<text x="{x + 3:.1f}" y="{y + row - 4}">{html.escape(label[:int(w / 7)])}</text>' if w > 30 else "")
+            + "</g>"
+        )
+        for child_label, child in sorted(node["children"].items()):
+            draw(child, child_label, x, level + 1)
+            x += child["count"] / total * width
+
+    draw(root, "all", 0.0, 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'font-family="monospace" font-size="11">'
+        f'<text x="4" y="16" font-size="13">{html.escape(title)}, {root["count"]} samples</text>'
+        + "".join(rects) + "</svg>"
+    )
+
+def new_profile_id() -> str:
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(4)}"
+
+class ProfileMiddleware:
+    """Runs requests that carry a valid X-Profile-Token under a profiler"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        token = headers.get(b"x-profile-token")
+        # Downloads of saved profiles carry the token too, but are not profiled themselves
+        if token is None or scope["path"].startswith("/profiles/"):
+            await self.app(scope, receive, send)
+            return
+        if not authorized(token.decode("latin-1")):
+            await JSONResponse(status_code=403, content={"detail": "Invalid profile token"})(scope, receive, send)
+            return
+        mode = headers.get(b"x-profile-mode", b"sample").decode("latin-1")
+        if mode not in MODES:
+            await JSONResponse(status_code=400, content={"detail": f"X-Profile-Mode must be one of {MODES}"})(
+                scope, receive, send)
+            return
+
+        profile = Profile(new_profile_id(), mode, config.PROFILE_INTERVAL_MS / 1000)
+        status = {}
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        context_token = active.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profile.stop()
+            active.reset(context_token)
+            request = {"method": scope["method"], "path": scope["path"], "status": status.get("code")}
+            summary = await run_in_threadpool(profile.save, request)
+            logger.info(f"Saved profile {profile.id} of {scope['method']} {scope['path']}: {summary['artifacts']}")
@@ -0,0 +1,116 @@
+"""
+Lightweight response records for the high-throughput /verify mode.
+
+The records take the same constructor arguments as the pydantic response
+models, so the rule functions in drug_utils can build either. They skip
+validation entirely: everything they hold is produced by our own rule tables
+or was already validated on the way in.
+"""
+import json
+from collections import namedtuple
+
+from fastapi.responses import Response
+
+from .models import Drug, InteractionAlert, DosageAlert, AlternativeSuggestion, VerificationResponse
+
+try:
+    import orjson
+except ImportError:  # optional dependency, fall back to the standard library encoder
+    orjson = None
+
+class DrugRecord:
+    __slots__ = ("name", "dosage", "frequency")
+
+    def __init__(self, name, dosage=None, frequency=None):
+        self.name = name
+        self.dosage = dosage
+        self.frequency = frequency
+
+    def to_dict(self):
+        return {"name": self.name, "dosage": self.dosage, "frequency": self.frequency}
+
+class InteractionRecord:
+    __slots__ = ("drug_a", "drug_b", "description", "severity")
+
+    def __init__(self, drug_a, drug_b, description, severity):
+        self.drug_a = drug_a
+        self.drug_b = drug_b
+        self.description = description
+        self.severity = severity
+
+    def to_dict(self):
+        return {
+            "drug_a": self.drug_a,
+            "drug_b": self.drug_b,
+            "description": self.description,
+            "severity": self.severity,
+        }
+
+class DosageRecord:
+    __slots__ = ("drug", "issue", "recommended_dosage")
+
+    def __init__(self, drug, issue, recommended_dosage=None):
+        self.drug = drug
+        self.issue = issue
+        self.recommended_dosage = recommended_dosage
+
+    def to_dict(self):
+        return {"drug": self.drug, "issue": self.issue, "recommended_dosage": self.recommended_dosage}
+
+class AlternativeRecord:
+    __slots__ = ("original_drug", "suggested_drug", "reason")
+
+    def __init__(self, original_drug, suggested_drug, reason):
+        self.original_drug = original_drug
+        self.suggested_drug = suggested_drug
+        self.reason = reason
+
+    def to_dict(self):
+        return {"original_drug": self.original_drug, "suggested_drug": self.suggested_drug, "reason": self.reason}
+
+class VerificationRecord:
+    __slots__ = ("is_safe", "interactions", "dosage_alerts", "alternatives", "extracted_drugs")
+
+    def __init__(self, is_safe, interactions=(), dosage_alerts=(), alternatives=(), extracted_drugs=()):
+        self.is_safe = is_safe
+        self.interactions = interactions
+        self.dosage_alerts = dosage_alerts
+        self.alternatives = alternatives
+        self.extracted_drugs = extracted_drugs
+
+    def to_dict(self):
+        """Same JSON shape as VerificationResponse"""
+        return {
+            "is_safe": self.is_safe,
+            "interactions": [a.to_dict() for a in self.interactions],
+            "dosage_alerts": [a.to_dict() for a in self.dosage_alerts],
+            "alternatives": [a.to_dict() for a in self.alternatives],
+            "extracted_drugs": [drug_dict(d) for d in self.extracted_drugs],
+        }
+
+def drug_dict(drug):
+    """Serialize a DrugRecord or an (already validated) request Drug"""
+    if isinstance(drug, DrugRecord):
+        return drug.to_dict()
+    return {"name": drug.name, "dosage": drug.dosage, "frequency": drug.frequency}
+
+# The classes the verification pipeline builds its results from
+ResponseTypes = namedtuple("ResponseTypes", ["drug", "interaction", "dosage", "alternative", "verification"])
+
+MODEL_TYPES = ResponseTypes(Drug, InteractionAlert, DosageAlert, AlternativeSuggestion, VerificationResponse)
+RECORD_TYPES = ResponseTypes(DrugRecord, InteractionRecord, DosageRecord, AlternativeRecord, VerificationRecord)
+
+def dumps(content) -> bytes:
+    """Encode plain JSON content, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(Response):
+    """JSON response for records: serialized with to_dict() + orjson, no jsonable_encoder pass"""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if hasattr(content, "to_dict"):
+            content = content.to_dict()
+        return dumps(content)
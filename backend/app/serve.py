@@ -0,0 +1,154 @@
+"""
+Prefork multi-worker server.
+
+    python -m app.serve --workers 4 --port 8000
+
+The parent imports the app once: that builds the knowledge base (drug tables
+and compiled matchers) and, for OCR roles, imports the OCR stack. It then
+freezes the garbage collector so collections in the workers never touch (and
+so never copy) the inherited objects, binds the listening socket and forks
+the workers. Each worker runs its own uvicorn server and event loop on the
+shared socket and the kernel spreads connections across them, so an extra
+worker costs little more than its own request-handling state. The parent
+restarts workers that die and passes SIGTERM/SIGINT on for a graceful stop.
+Workers publish their metrics to a shared directory so /metrics on any one
+of them reports all of them.
+
+Granite is never loaded in the parent (torch does not survive a fork): every
+worker serving the llm role loads its own model, or its own GRANITE_WORKERS
+pool, so deploy the llm role separately with one worker. /sessions state
+lives in the memory of the worker that created the session, so it needs
+sticky routing or a single-worker deployment as well.
+"""
+import argparse
+import gc
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# A worker that dies sooner than this after starting is restarted with a delay
+MIN_WORKER_UPTIME = 5.0
+
+def bind(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    """The listening socket shared by all workers"""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+def preload():
+    """Everything the workers share: imported, built and frozen in the parent before forking"""
+    from . import config
+    from .knowledge_base import knowledge_base
+    from .main import app
+    from .subsystems import get_ocr_processor
+
+    if config.serves("ocr") and config.OCR_PRELOAD and config.OCR_WORKERS == 0:
+        # An OCR worker pool is started by each API worker instead: its threads do not survive the fork
+        get_ocr_processor()
+    if config.API_WORKERS > 1 and config.serves("llm"):
+        logger.warning(f"Each of the {config.API_WORKERS} workers will load its own Granite model; "
+                       "consider APP_ROLE=verify,ocr here and a separate single-worker llm deployment")
+    if config.API_WORKERS > 1 and config.serves("verify"):
+        logger.warning("/sessions state is per worker and needs sticky routing across workers")
+    logger.info(f"Knowledge base: {len(knowledge_base.formulary)} drugs, "
+                f"{len(knowledge_base.interactions) // 2} interactions")
+    gc.collect()
+    gc.freeze()
+    return app
+
+class Supervisor:
+    """Forks the workers and keeps that many running until told to stop"""
+
+    def __init__(self, app, sock: socket.socket, workers: int, log_level: str):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.log_level = log_level
+        self.children: Dict[int, int] = {}  # pid -> worker index
+        self.started_at: Dict[int, float] = {}
+        self.stopping = False
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.run_worker()
+                code = 0
+            except BaseException:
+                logger.exception(f"API worker {index} failed")
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+        self.started_at[index] = time.monotonic()
+        logger.info(f"Started API worker {index} (pid {pid})")
+
+    def run_worker(self):
+        """Worker process body: one uvicorn server on the inherited socket"""
+        import uvicorn
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        server = uvicorn.Server(uvicorn.Config(self.app, log_level=self.log_level))
+        server.run(sockets=[self.sock])
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while self.children:
+            pid, status = os.wait()
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            logger.error(f"API worker {index} (pid {pid}) exited with status {status}, restarting")
+            if time.monotonic() - self.started_at[index] < MIN_WORKER_UPTIME:
+                time.sleep(1)
+            self.spawn(index)
+        logger.info("All API workers stopped")
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the API from several forked worker processes")
+    parser.add_argument("--host", default=os.getenv("API_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("API_WORKERS", 1)))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    # Read by app.config, which sizes the per-worker admission limits from it
+    os.environ["API_WORKERS"] = str(args.workers)
+    metrics_dir = None
+    if args.workers > 1 and not os.getenv("METRICS_DIR"):
+        # Each worker publishes its metrics here so that /metrics on any of them covers all
+        metrics_dir = os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="medsafe-metrics-")
+    app = preload()
+    sock = bind(args.host, args.port)
+    logger.info(f"Listening on {args.host}:{args.port} with {args.workers} workers")
+    try:
+        Supervisor(app, sock, args.workers, args.log_level).run()
+    finally:
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
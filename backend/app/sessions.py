@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional
+
+from . import audit, metrics
+from .models import Drug, Patient, VerificationResponse
+from .nlp_utils import extract_drugs_from_text
+from .drug_utils import check_interactions, check_dosage
+from .pipeline import to_drug_objects, assemble_verification
+from .stages import stage
+
+logger = logging.getLogger(__name__)
+
+class VerificationSession:
+    """
+    Server-side state of one prescription being edited and re-verified.
+
+    Extraction is cached per line and rule results per drug (dosage) and per
+    drug pair (interactions), so an update only re-extracts the lines that
+    changed and only checks the pairs involving drugs that were added.
+    Drugs are de-duplicated by name across the listed drugs and all lines, and
+    dosage/frequency lookups only see the line a drug was found on.
+    """
+
+    def __init__(self, session_id: str, patient: Patient, drugs: Optional[List[Drug]] = None):
+        self.session_id = session_id
+        self.patient = patient
+        self.listed_drugs = list(drugs or [])
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.lines: List[str] = []
+        self.line_drugs: List[List[dict]] = []
+        self.drugs: List[Drug] = []
+        self.dosage_alerts: Dict[str, list] = {}
+        self.pair_alerts: Dict[frozenset, list] = {}
+        self.verification: Optional[VerificationResponse] = None
+
+    def reset(self, patient: Patient):
+        """Drop the cached rule results when the patient details change; extraction is kept"""
+        self.patient = patient
+        self.drugs = []
+        self.dosage_alerts, self.pair_alerts = {}, {}
+
+    def update(self, text: Optional[str], patient: Optional[Patient] = None, on_stage=None) -> VerificationResponse:
+        """Re-verify after the prescription text (and optionally the patient) changed; text=None keeps the text"""
+        if patient is not None and patient != self.patient:
+            self.reset(patient)
+        if audit.enabled:
+            started = time.perf_counter()
+            stages, on_stage = audit.collect(on_stage)
+
+        # 1. Re-extract only the lines that differ from the previous text
+        with stage("extraction", on_stage) as info:
+            new_lines = self.lines if text is None else text.splitlines()
+            self.line_drugs, info["lines_reextracted"] = diff_extract(self.lines, self.line_drugs, new_lines)
+            self.lines = new_lines
+            drugs = self.merge_drugs()
+            info["drugs_found"] = len(drugs)
+
+        old_names = {d.name.lower() for d in self.drugs}
+        new_names = {d.name.lower() for d in drugs}
+        added, removed = new_names - old_names, old_names - new_names
+        self.drugs = drugs
+
+        # 2. Interactions: forget pairs with removed drugs, check pairs with added ones
+        with stage("interactions", on_stage) as info:
+            for pair in [p for p in self.pair_alerts if p & removed]:
+                del self.pair_alerts[pair]
+            by_name = {d.name.lower(): d for d in drugs}
+            for name in added:
+                for other in new_names:
+                    pair = frozenset((name, other))
+                    if other != name and pair not in self.pair_alerts:
+                        self.pair_alerts[pair] = check_interactions([by_name[name], by_name[other]], self.patient.age)
+            interaction_alerts = self.ordered_interactions()
+            info["alerts"] = len(interaction_alerts)
+            info["drugs_added"], info["drugs_removed"] = len(added), len(removed)
+
+        # 3. Dosage depends on the drug name and patient age only
+        with stage("dosage", on_stage) as info:
+            for name in removed:
+                self.dosage_alerts.pop(name, None)
+            for name in added:
+                self.dosage_alerts[name] = check_dosage(by_name[name], self.patient.age)
+            dosage_alerts = [alert for d in drugs for alert in self.dosage_alerts[d.name.lower()]]
+            info["alerts"] = len(dosage_alerts)
+
+        self.verification = assemble_verification(drugs, self.patient, interaction_alerts, dosage_alerts, on_stage)
+        if audit.enabled:
+            audit.record("session", self.listed_drugs, "\n".join(self.lines), self.patient, self.verification,
+                         started, stages)
+        return self.verification
+
+    def merge_drugs(self) -> List[Drug]:
+        """Listed drugs first, then drugs in line order, first occurrence of a name wins"""
+        seen = {d.name.lower() for d in self.listed_drugs}
+        drugs = list(self.listed_drugs)
+        for found in self.line_drugs:
+            for drug in to_drug_objects(found):
+                if drug.name.lower() not in seen:
+                    seen.add(drug.name.lower())
+                    drugs.append(drug)
+        return drugs
+
+    def ordered_interactions(self):
+        """Cached interaction alerts in the order check_interactions would report them"""
+        position = {d.name.lower(): i for i, d in enumerate(self.drugs)}
+        flagged = [pair for pair, alerts in self.pair_alerts.items() if alerts]
+        flagged.sort(key=lambda pair: sorted(position[name] for name in pair))
+        return [alert for pair in flagged for alert in self.pair_alerts[pair]]
+
+def diff_extract(old_lines: List[str], old_results: List[List[dict]], new_lines: List[str]):
+    """
+    Map per-line extraction results onto the edited text.
+    Unchanged lines keep their cached result; only inserted or replaced lines are
+    run through extract_drugs_from_text. Returns (results, lines_reextracted).
+    """
+    # Trim the common prefix and suffix first so a small edit never diffs the whole text
+    start = 0
+    while start < min(len(old_lines), len(new_lines)) and old_lines[start] == new_lines[start]:
+        start += 1
+    end = 0
+    while (end < min(len(old_lines), len(new_lines)) - start
+           and old_lines[-1 - end] == new_lines[-1 - end]):
+        end += 1
+
+    old_mid = old_lines[start:len(old_lines) - end]
+    new_mid = new_lines[start:len(new_lines) - end]
+    mid_results = []
+    reextracted = 0
+    matcher = SequenceMatcher(a=old_mid, b=new_mid, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            mid_results.extend(old_results[start + i1:start + i2])
+        elif tag in ("replace", "insert"):
+            for line in new_mid[j1:j2]:
+                mid_results.append(extract_drugs_from_text(line))
+                reextracted += 1
+
+    results = old_results[:start] + mid_results + old_results[len(old_results) - end:]
+    return results, reextracted
+
+class SessionStore:
+    """In-memory verification sessions with idle expiry and a size bound (LRU eviction)"""
+
+    def __init__(self, max_sessions: int = 1000, ttl_seconds: float = 1800):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.sessions: "OrderedDict[str, VerificationSession]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, patient: Patient, drugs: Optional[List[Drug]] = None) -> VerificationSession:
+        session = VerificationSession(uuid.uuid4().hex, patient, drugs)
+        with self.lock:
+            self.expire()
+            self.sessions[session.session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                evicted, _ = self.sessions.popitem(last=False)
+                logger.info(f"Evicted verification session {evicted}")
+        return session
+
+    def get(self, session_id: str) -> Optional[VerificationSession]:
+        with self.lock:
+            self.expire()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self.sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def expire(self):
+        """Drop sessions idle for longer than the TTL (oldest first); caller holds the lock"""
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.last_used >= cutoff:
+                break
+            del self.sessions[session_id]
+
+# Global instance
+session_store = SessionStore()
+
+def session_samples():
+    return [("medsafe_sessions_active", "gauge", "Verification sessions held in memory", {},
+             len(session_store.sessions))]
+
+metrics.register_collector(session_samples)
@@ -0,0 +1,40 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from . import metrics, profiling, tracing
+
+# Signature of a progress callback: on_stage(stage_name, elapsed_ms=..., **info)
+StageCallback = Callable[..., None]
+
+@contextmanager
+def stage(name: str, on_stage: Optional[StageCallback] = None, **info):
+    """
+    Time one pipeline stage, record it in the stage latency histogram and report it
+    to `on_stage` when it finishes.
+    The yielded dict can be filled with extra attributes (e.g. counts) to report.
+    With tracing on, the stage is a span with those attributes; when the request
+    asked to be profiled, this thread is profiled for the duration (unless it is
+    the event loop's).
+    """
+    profile = profiling.active.get() if profiling.enabled else None
+    if profile is not None:
+        profile.enter(name)
+    span = tracing.start_span(name) if tracing.enabled else None
+    started = time.perf_counter()
+    try:
+        yield info
+    except BaseException as e:
+        if span is not None:
+            tracing.end_span(span, info, e)
+            span = None
+        raise
+    finally:
+        if span is not None:
+            tracing.end_span(span, info)
+        if profile is not None:
+            profile.exit()
+    elapsed = time.perf_counter() - started
+    metrics.observe_stage(name, elapsed, info.get("psm"))
+    if on_stage is not None:
+        on_stage(name, elapsed_ms=round(elapsed * 1000, 1), **info)
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import logging
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+def format_sse(event: str, data) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+def sse_response(events):
+    """Wrap an async iterator of (event, data) pairs in a text/event-stream response"""
+    async def body():
+        async for event, data in events:
+            yield format_sse(event, data)
+
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def stage_event_response(run):
+    """
+    Stream the progress of `run(on_stage)` as server-sent events.
+
+    `run` is an async callable that receives an `on_stage` callback and returns
+    the final result. Every reported stage is sent as a `stage` event the moment
+    it completes (the callback is safe to call from worker threads); the return
+    value is sent as a `result` event, or an `error` event if `run` raises.
+    """
+    async def events():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        # Every put goes through call_soon_threadsafe so events keep the order they were reported in
+        def put(item):
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        def on_stage(name, **info):
+            put(("stage", {"stage": name, **info}))
+
+        async def runner():
+            try:
+                result = await run(on_stage)
+                put(("result", result))
+            except Exception as e:
+                logger.error(f"Streaming request failed: {e}")
+                put(("error", {"error": str(e)}))
+            put(None)
+
+        task = asyncio.ensure_future(runner())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            if not task.done():
+                task.cancel()
+
+    return sse_response(events())
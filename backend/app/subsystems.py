@@ -0,0 +1,66 @@
+"""
+Heavy subsystems, imported on first use.
+
+The OCR stack (OpenCV, Tesseract, numpy, PIL) and the Granite stack (torch,
+transformers) take from hundreds of milliseconds to several seconds to import,
+so no module imports them at the top level. Callers go through these
+accessors, and startup preloads only what this worker's APP_ROLE serves.
+"""
+import functools
+import logging
+import time
+from collections import namedtuple
+from typing import Dict
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# How /advice reaches Granite: in-process batcher or the worker process pool
+LLMBackend = namedtuple("LLMBackend", ["lifecycle", "runner", "stream", "status"])
+
+# Seconds each subsystem took to import, for /health
+import_seconds: Dict[str, float] = {}
+
+@functools.lru_cache(maxsize=None)
+def get_ocr_processor():
+    from .ocr_pool import ocr_pool
+    if ocr_pool is not None:
+        # Same extract_text_* interface; the OCR stack is only imported inside the worker processes
+        ocr_pool.start()
+        return ocr_pool
+
+    started = time.perf_counter()
+    from .ocr_processor import ocr_processor
+    import_seconds["ocr"] = round(time.perf_counter() - started, 2)
+    logger.info(f"OCR stack imported in {import_seconds['ocr']}s")
+    return ocr_processor
+
+@functools.lru_cache(maxsize=None)
+def get_llm() -> LLMBackend:
+    from .inference_pool import inference_pool
+    if inference_pool is not None:
+        # torch is only imported inside the worker processes
+        return LLMBackend(inference_pool, inference_pool, inference_pool.stream, inference_pool.status)
+
+    started = time.perf_counter()
+    from .granite_medical import granite_medical, granite_lifecycle
+    from .granite_batching import granite_batcher
+    import_seconds["llm"] = round(time.perf_counter() - started, 2)
+    logger.info(f"Granite stack imported in {import_seconds['llm']}s")
+    return LLMBackend(
+        granite_lifecycle,
+        granite_batcher,
+        granite_medical.stream_medical_advice,
+        lambda: {**granite_lifecycle.status(), "batching": granite_batcher.stats()},
+    )
+
+def loaded(accessor) -> bool:
+    """Whether the subsystem behind `accessor` has been imported already"""
+    return accessor.cache_info().currsize > 0
+
+async def ensure(accessor):
+    """The subsystem, imported off the event loop the first time it is needed"""
+    if loaded(accessor):
+        return accessor()
+    return await run_in_threadpool(accessor)
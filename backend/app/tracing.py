@@ -0,0 +1,330 @@
+"""
+Trace spans that follow one request through OCR, extraction and the rules.
+
+Enabled by TRACE_FILE. Each request gets a root span (joining the caller's
+trace when it sends a W3C traceparent header; the response carries
+X-Trace-Id), and every stages.stage() inside it becomes a child span whose
+attributes are what the stage reports: image size on decode, PSM, characters
+and confidence of each OCR pass, the PSM chosen, drugs found, alert counts,
+the triage decision.
+
+The current span lives in a ContextVar, so it follows the request into the
+threadpool (run_in_threadpool copies the context) and into the OCR pass
+threads (submitted with the request's context). OCR worker processes get the
+span context with each image and send their finished spans back with the
+result, which the pool exports in the parent, as it does with their metrics.
+
+Finished spans are queued (bounded; spans are dropped rather than blocking
+a request) and a background thread appends them to TRACE_FILE in batches, as
+OTLP/JSON lines: one ExportTraceServiceRequest per line, the format of the
+OpenTelemetry Collector's otlpjsonfile receiver, so the file can be shipped
+on to Jaeger, Tempo and the like. To see where the tail latency comes from:
+
+    python -m app.tracing traces.jsonl [--slowest 10]
+
+prints latency percentiles per span name and the slowest requests broken
+down by stage.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from . import config, metrics
+
+logger = logging.getLogger(__name__)
+
+enabled = bool(config.TRACE_FILE)
+
+# OTLP span kinds
+INTERNAL = 1
+SERVER = 2
+
+# Probes and scrapes are not traced
+UNTRACED_PATHS = {"/health", "/ready", "/metrics"}
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+# The span that new spans in this context are children of
+current: ContextVar[Optional[SpanContext]] = ContextVar("current_span", default=None)
+
+# Set in OCR worker processes: finished spans are handed to this instead of the exporter
+forward: Optional[Callable[[Dict], None]] = None
+
+def new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+def parse_traceparent(header: Optional[str]) -> Optional[SpanContext]:
+    match = TRACEPARENT.match(header.strip().lower()) if header else None
+    if match is None:
+        return None
+    trace_id, span_id, flags = match.groups()
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+class Span:
+    """A started span; ended (and exported, if sampled) by end_span()"""
+    __slots__ = ("name", "context", "parent_id", "kind", "start_ns", "attributes", "token")
+
+    def __init__(self, name: str, context: SpanContext, parent_id: Optional[str], kind: int, attributes: Dict):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.token = None
+
+def start_span(name: str, kind: int = INTERNAL, parent: Optional[SpanContext] = None, **attributes) -> Span:
+    """
+    Start a span as a child of `parent` (default: the current span) or as the root of a
+    new trace, sampled at TRACE_SAMPLE_RATE, and make it the current span
+    """
+    parent = parent or current.get()
+    if parent is None:
+        context = SpanContext(new_id(128), new_id(64), random.random() < config.TRACE_SAMPLE_RATE)
+    else:
+        context = SpanContext(parent.trace_id, new_id(64), parent.sampled)
+    span = Span(name, context, parent.span_id if parent else None, kind, attributes)
+    span.token = current.set(context)
+    return span
+
+def end_span(span: Span, attributes: Optional[Dict] = None, error: Optional[BaseException] = None):
+    """Restore the parent as the current span and export this one"""
+    current.reset(span.token)
+    if not span.context.sampled:
+        return
+    if attributes:
+        span.attributes.update(attributes)
+    record = {
+        "traceId": span.context.trace_id,
+        "spanId": span.context.span_id,
+        "parentSpanId": span.parent_id or "",
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(time.time_ns()),
+        "attributes": [otlp_attribute(key, value) for key, value in span.attributes.items() if value is not None],
+        "status": {"code": 1},
+    }
+    if error is not None:
+        record["status"] = {"code": 2, "message": f"{type(error).__name__}: {error}"}
+    export([record])
+
+def otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+def otlp_attribute(key: str, value) -> Dict:
+    return {"key": key, "value": otlp_value(value)}
+
+class Exporter:
+    """Appends finished spans to a file as OTLP/JSON lines, in batches, from a background thread"""
+
+    def __init__(self, path: str, max_queue: int = 10000, batch_size: int = 512, interval: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue: "queue.Queue[Dict]" = queue.Queue(max_queue)
+        self.dropped = 0
+        self.exported = 0
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def export(self, records: List[Dict]):
+        self.ensure_started()
+        for record in records:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+    def ensure_started(self):
+        # Started lazily in the process that exports, so a forked API worker gets its own thread
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    threading.Thread(target=self.run, name="trace-exporter", daemon=True).start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            batch, flushed = [], None
+            deadline = time.monotonic() + self.interval
+            while True:
+                if isinstance(item, threading.Event):
+                    flushed = item
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self.write(batch)
+            if flushed is not None:
+                flushed.set()
+
+    def flush(self, timeout: float = 5.0):
+        """Write everything exported so far (at shutdown)"""
+        if self.pid != os.getpid():
+            return
+        flushed = threading.Event()
+        try:
+            self.queue.put(flushed, timeout=timeout)
+        except queue.Full:
+            return
+        flushed.wait(timeout)
+
+    def write(self, spans: List[Dict]):
+        line = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [
+                otlp_attribute("service.name", config.TRACE_SERVICE_NAME),
+                otlp_attribute("process.pid", os.getpid()),
+                otlp_attribute("medsafe.roles", sorted(config.APP_ROLE)),
+            ]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+        }]}) + "\n"
+        try:
+            # One append per batch, so batches of several API workers do not interleave
+            with open(self.path, "a") as f:
+                f.write(line)
+            self.exported += len(spans)
+        except OSError as e:
+            self.dropped += len(spans)
+            logger.warning(f"Could not write traces to {self.path}: {e}")
+
+exporter = Exporter(config.TRACE_FILE) if enabled else None
+
+def export(records: List[Dict]):
+    """Export finished span records, or hand them to `forward` in OCR worker processes"""
+    if forward is not None:
+        for record in records:
+            forward(record)
+    else:
+        exporter.export(records)
+
+def flush():
+    if exporter is not None:
+        exporter.flush()
+
+def tracing_samples():
+    return [
+        ("medsafe_trace_spans_exported_total", "counter", "Trace spans written to TRACE_FILE", {},
+         exporter.exported),
+        ("medsafe_trace_spans_dropped_total", "counter", "Trace spans dropped (queue full or write failed)", {},
+         exporter.dropped),
+    ]
+
+if exporter is not None:
+    metrics.register_collector(tracing_samples)
+
+class TraceMiddleware:
+    """Wraps each request in a root span and returns its trace id in X-Trace-Id"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in UNTRACED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        parent = parse_traceparent(headers.get(b"traceparent", b"").decode("latin-1"))
+        span = start_span(f"{scope['method']} {scope['path']}", SERVER, parent, **{
+            "http.method": scope["method"],
+            "http.target": scope["path"],
+        })
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit():
+            span.attributes["http.request_content_length"] = int(length)
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                span.attributes["http.status_code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-trace-id", span.context.trace_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        except BaseException as e:
+            end_span(span, error=e)
+            raise
+        endpoint = scope.get("endpoint")
+        end_span(span, {"code.function": getattr(endpoint, "__name__", None)})
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+def load_spans(path: str) -> List[Dict]:
+    spans = []
+    with open(path) as f:
+        for line in f:
+            for resource in json.loads(line)["resourceSpans"]:
+                for scope in resource["scopeSpans"]:
+                    spans.extend(scope["spans"])
+    return spans
+
+def duration_ms(span: Dict) -> float:
+    return (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e6
+
+def span_label(span: Dict) -> str:
+    psm = next((a["value"].get("intValue") for a in span["attributes"] if a["key"] == "psm"), None)
+    return span["name"] if psm is None else f"{span['name']}[psm={psm}]"
+
+def summarize(path: str, slowest: int):
+    spans = load_spans(path)
+    durations = defaultdict(list)
+    for span in spans:
+        durations[span["name"]].append(duration_ms(span))
+    print(f"{len(spans)} spans in {len({span['traceId'] for span in spans})} traces; durations in ms")
+    print(f"{'span':<32} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, values in sorted(durations.items(), key=lambda item: -percentile(item[1], 99)):
+        print(f"{name:<32} {len(values):>7} {percentile(values, 50):>9.1f} {percentile(values, 95):>9.1f} "
+              f"{percentile(values, 99):>9.1f} {max(values):>9.1f}")
+
+    ids = {span["spanId"] for span in spans}
+    roots = [span for span in spans if span["parentSpanId"] not in ids]
+    children = defaultdict(list)
+    for span in spans:
+        children[span["traceId"]].append(span)
+    print(f"\nSlowest {slowest} requests, with their longest stages:")
+    for root in sorted(roots, key=duration_ms, reverse=True)[:slowest]:
+        stages = sorted((span for span in children[root["traceId"]] if span is not root), key=duration_ms,
+                        reverse=True)[:6]
+        breakdown = ", ".join(f"{span_label(span)} {duration_ms(span):.1f}" for span in stages)
+        print(f"{duration_ms(root):9.1f}  {root['name']}  trace {root['traceId']}\n           {breakdown}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a TRACE_FILE: latency per stage and the slowest requests")
+    parser.add_argument("path")
+    parser.add_argument("--slowest", type=int, default=10)
+    args = parser.parse_args()
+    summarize(args.path, args.slowest)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Decides whether a verified prescription needs a Granite review.
+
+The rule checks are cheap and cover the known formulary, so the model is
+only worth running when they found a problem (an interaction, a dosage
+issue such as a contraindication, or a dose outside the recommended range),
+when extraction produced drug candidates the formulary does not know, or
+when the OCR text itself is unreliable. The informational dosage
+recommendation every known drug gets is not a reason on its own.
+"""
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Dict, Optional
+
+from . import config, metrics
+from .models import TriageDecision
+from .drug_utils import RECOMMENDATION_ISSUE
+from .knowledge_base import knowledge_base
+from .stages import stage
+
+logger = logging.getLogger(__name__)
+
+FORMULARY = knowledge_base.formulary
+# "250-500mg twice daily" (per-kg ranges such as "5-10mg/kg" are not comparable to a written dose)
+DOSE_RANGE = re.compile(r"(\d+(?:\.\d+)?)\s*-\s*(\d+(?:\.\d+)?)\s*mg\b(?!/)", re.IGNORECASE)
+DOSE = re.compile(r"(\d+(?:\.\d+)?)\s*mg\b(?!/)", re.IGNORECASE)
+
+def out_of_range(drug, recommended: str) -> bool:
+    """Whether the drug's written mg dose lies outside the recommended mg range"""
+    dose = DOSE.search(drug.dosage or "")
+    limits = DOSE_RANGE.search(recommended or "")
+    if dose is None or limits is None:
+        return False
+    return not float(limits.group(1)) <= float(dose.group(1)) <= float(limits.group(2))
+
+class TriageStats:
+    """How many prescriptions were triaged, how many went to the model, and why"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.triaged = 0
+        self.advised = 0
+        self.reasons = Counter()
+
+    def record(self, decision: TriageDecision):
+        with self.lock:
+            self.triaged += 1
+            if decision.needs_advice:
+                self.advised += 1
+                self.reasons.update(reason.split(":")[0] for reason in decision.reasons)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "triaged": self.triaged,
+                "advised": self.advised,
+                "skipped": self.triaged - self.advised,
+                "reasons": dict(self.reasons),
+            }
+
+def triage(verification, ocr_confidence: Optional[float] = None, on_stage=None) -> TriageDecision:
+    """Record and return why (or whether) the verdict should be reviewed by the model"""
+    with stage("triage", on_stage) as info:
+        reasons = []
+        if verification.interactions:
+            reasons.append(f"interaction_alerts: {len(verification.interactions)}")
+        dosage_issues = [a for a in verification.dosage_alerts if a.issue != RECOMMENDATION_ISSUE]
+        if dosage_issues:
+            reasons.append(f"dosage_alerts: {len(dosage_issues)}")
+        drugs = {d.name.lower(): d for d in verification.extracted_drugs}
+        out_of_range_doses = [
+            f"{a.drug} {drugs[a.drug.lower()].dosage} (recommended {a.recommended_dosage})"
+            for a in verification.dosage_alerts
+            if a.issue == RECOMMENDATION_ISSUE and a.drug.lower() in drugs
+            and out_of_range(drugs[a.drug.lower()], a.recommended_dosage)
+        ]
+        if out_of_range_doses:
+            reasons.append(f"dose_out_of_range: {', '.join(out_of_range_doses)}")
+        unrecognized = [d.name for d in verification.extracted_drugs if d.name.lower() not in FORMULARY]
+        if unrecognized:
+            reasons.append(f"unrecognized_drugs: {', '.join(unrecognized)}")
+        if ocr_confidence is not None and ocr_confidence < config.TRIAGE_MIN_OCR_CONFIDENCE:
+            reasons.append(f"low_ocr_confidence: {ocr_confidence}")
+
+        decision = TriageDecision(
+            needs_advice=bool(reasons),
+            reasons=reasons,
+            unrecognized_drugs=unrecognized,
+            ocr_confidence=ocr_confidence,
+        )
+        info["needs_advice"] = decision.needs_advice
+    triage_stats.record(decision)
+    return decision
+
+# Global instance
+triage_stats = TriageStats()
+
+def triage_samples():
+    stats = triage_stats.stats()
+    return [
+        ("medsafe_triage_total", "counter", "Verdicts triaged", {}, stats["triaged"]),
+        ("medsafe_triage_advised_total", "counter", "Verdicts sent to Granite for review", {}, stats["advised"]),
+    ] + [
+        ("medsafe_triage_reasons_total", "counter", "Reasons verdicts were sent for review", {"reason": reason}, count)
+        for reason, count in stats["reasons"].items()
+    ]
+
+metrics.register_collector(triage_samples)
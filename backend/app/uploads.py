@@ -0,0 +1,106 @@
+"""
+Bounded handling of image uploads.
+
+UploadLimitMiddleware rejects an upload with 413 as soon as its declared
+Content-Length, or the bytes actually received, exceed MAX_UPLOAD_BYTES, so an
+oversized body is never read to the end. The multipart parser spools the file
+part to a temporary file (in memory up to 1 MB, on disk beyond), which is
+handed to OCR as is; check_image reads only the image header (format and
+dimensions) before anything is decoded.
+"""
+import warnings
+from typing import Iterable, Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from . import config
+
+# Formats the OCR pipeline accepts (what the frontend uploader offers)
+ALLOWED_FORMATS = {"PNG", "JPEG", "BMP", "TIFF"}
+# Room for multipart boundaries and the other form fields on top of the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+def too_large(max_bytes: int) -> str:
+    megabytes = max_bytes / (1024 * 1024)
+    if max_bytes < 1024 * 1024:
+        limit = f"{max_bytes} byte"
+    elif megabytes.is_integer():
+        limit = f"{megabytes:.0f} MB"
+    else:
+        limit = f"{megabytes:.1f} MB"
+    return f"Upload exceeds the {limit} limit"
+
+class UploadLimitMiddleware:
+    """Caps the request body size of the upload endpoints while it is being received"""
+
+    def __init__(self, app, paths: Iterable[str], max_bytes: Optional[int] = None):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes or config.MAX_UPLOAD_BYTES
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.max_bytes + MULTIPART_OVERHEAD
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse(status_code=413, content={"detail": too_large(self.max_bytes)})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside form parsing; FastAPI turns it into the 413 response
+                    raise HTTPException(status_code=413, detail=too_large(self.max_bytes))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+def check_image(fileobj):
+    """Validate format and dimensions from the image header only, then rewind"""
+    from PIL import Image, UnidentifiedImageError
+
+    # Defence in depth for any decode path: PIL refuses images over twice this many pixels
+    Image.MAX_IMAGE_PIXELS = config.MAX_IMAGE_PIXELS
+    try:
+        with warnings.catch_warnings():
+            # Oversized images are rejected below with a clear message instead
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            image = Image.open(fileobj)
+        with image:
+            image_format, (width, height) = image.format, image.size
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail=f"Image exceeds the {config.MAX_IMAGE_PIXELS / 1e6:.0f} MP limit")
+    except (UnidentifiedImageError, OSError):
+        raise HTTPException(status_code=415, detail="Upload is not a readable image")
+    finally:
+        fileobj.seek(0)
+
+    if image_format not in ALLOWED_FORMATS:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported image format {image_format}; use one of {', '.join(sorted(ALLOWED_FORMATS))}",
+        )
+    if width * height > config.MAX_IMAGE_PIXELS or max(width, height) > config.MAX_IMAGE_SIDE:
+        raise HTTPException(
+            status_code=413,
+            detail=(f"Image is {width}x{height} ({width * height / 1e6:.1f} MP); the limit is "
+                    f"{config.MAX_IMAGE_PIXELS / 1e6:.0f} MP and {config.MAX_IMAGE_SIDE} px per side"),
+        )
+
+async def checked_upload(upload: UploadFile):
+    """The spooled file of a size- and header-checked image upload, ready for OCR"""
+    if upload.size is not None and upload.size > config.MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=too_large(config.MAX_UPLOAD_BYTES))
+    await run_in_threadpool(check_image, upload.file)
+    return upload.file
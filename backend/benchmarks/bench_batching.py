@@ -0,0 +1,79 @@
+"""
+Granite generation throughput with and without dynamic batching.
+
+For each concurrency level, that many client threads submit advice requests
+at the same time; we report generated tokens/sec and per-request latency for
+batch-of-one generation vs. the BatchScheduler. Uses the tiny offline model
+unless GRANITE_MODEL points somewhere else.
+
+Run from backend/: python -m benchmarks.bench_batching [--tokens 32] [--rounds 3]
+"""
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import print_table
+from .tiny_model import build_tiny_model
+
+PRESCRIPTIONS = [
+    "Aspirin 100 mg once daily, Ibuprofen 400 mg TID",
+    "Metformin 500 mg BID",
+    "Atorvastatin 20 mg daily, Clarithromycin 500 mg BID",
+    "Warfarin 5 mg daily",
+]
+
+def run_level(scheduler, concurrency: int, rounds: int):
+    """Fire `concurrency` simultaneous requests, `rounds` times; return (tokens/sec, mean latency s)"""
+    latencies, tokens = [], 0
+
+    def one(i):
+        started = time.perf_counter()
+        result = scheduler.generate(PRESCRIPTIONS[i % len(PRESCRIPTIONS)], 30 + i)
+        latencies.append(time.perf_counter() - started)
+        return result.get("generated_tokens", 0)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(rounds):
+            tokens += sum(pool.map(one, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return tokens / elapsed, statistics.mean(latencies)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=32, help="tokens generated per request")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--levels", default="1,2,4,8")
+    args = parser.parse_args()
+
+    model_path = os.getenv("GRANITE_MODEL") or build_tiny_model("/tmp/tiny-granite")
+
+    from app.granite_medical import GraniteMedicalAssistant
+    from app.granite_batching import BatchScheduler
+
+    assistant = GraniteMedicalAssistant(model_path)
+    assistant.load_model()
+    assistant.warmup()
+    # Fixed-length completions so both modes do the same amount of work
+    overrides = dict(max_new_tokens=args.tokens, min_new_tokens=args.tokens)
+
+    rows = []
+    for level in [int(x) for x in args.levels.split(",")]:
+        unbatched = BatchScheduler(assistant, max_batch_size=1, max_wait_ms=0, **overrides)
+        batched = BatchScheduler(assistant, max_batch_size=level, max_wait_ms=20, **overrides)
+        single_tps, single_latency = run_level(unbatched, level, args.rounds)
+        batch_tps, batch_latency = run_level(batched, level, args.rounds)
+        unbatched.stop()
+        batched.stop()
+        rows.append((
+            level,
+            f"{single_tps:.1f}", f"{single_latency:.3f}",
+            f"{batch_tps:.1f}", f"{batch_latency:.3f}",
+            f"{batch_tps / single_tps:.2f}x",
+        ))
+    print_table(["concurrency", "batch=1 tok/s", "batch=1 lat s", "batched tok/s", "batched lat s", "gain"], rows)
+
+if __name__ == "__main__":
+    main()
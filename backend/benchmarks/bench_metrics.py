@@ -0,0 +1,57 @@
+"""
+Overhead of the /metrics instrumentation.
+
+stage(): one timed pipeline stage with the histogram observation, against a
+bare context manager that only reads the clock. verify: the whole /verify
+rule pipeline (extraction, interactions, dosage, alternatives: 4 stages)
+with and without metrics. render: one /metrics scrape.
+
+Run from backend/: python -m benchmarks.bench_metrics
+"""
+import time
+from contextlib import contextmanager
+
+from app import metrics, pipeline
+from app.models import Drug, Patient
+from app.stages import stage
+from .common import measure, print_table
+
+TEXT = "Rx: Aspirin 100mg once daily. Ibuprofen 400 mg tid. Clarithromycin 500mg bid; atorvastatin 20 mg"
+
+@contextmanager
+def clock_only(name, on_stage=None, **info):
+    started = time.perf_counter()
+    yield info
+    time.perf_counter() - started
+
+def main():
+    def timed_stage():
+        with stage("bench"):
+            pass
+
+    def bare_stage():
+        with clock_only("bench"):
+            pass
+
+    patient = Patient(age=70)
+    drugs = [Drug(name="Warfarin", dosage="5mg", frequency="daily")]
+
+    def verify():
+        pipeline.verify_prescription(drugs, TEXT, patient)
+
+    rows = [
+        ("stage()", f"{measure(bare_stage, 100000):.2f}", f"{measure(timed_stage, 100000):.2f}"),
+    ]
+    with_metrics = measure(verify, 2000)
+    observe = metrics.observe_stage
+    metrics.observe_stage = lambda *args: None
+    try:
+        without_metrics = measure(verify, 2000)
+    finally:
+        metrics.observe_stage = observe
+    rows.append(("verify", f"{without_metrics:.2f}", f"{with_metrics:.2f}"))
+    rows.append(("render", "-", f"{measure(metrics.render, 200):.2f}"))
+    print_table(["operation", "without metrics us", "with metrics us"], rows)
+
+if __name__ == "__main__":
+    main()
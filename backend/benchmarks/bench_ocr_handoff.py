@@ -0,0 +1,105 @@
+"""
+Per-request IPC cost of handing an image to an OCR worker process: pickled
+through a multiprocessing queue vs. a shared-memory buffer from the pool
+with only a descriptor on the queue (what app.ocr_pool does).
+
+Payloads are encoded uploads (as received) and decoded 6000x4000 arrays
+(what a design that decodes in the API process would have to ship). The
+worker reads every byte (crc32) and acknowledges, so both paths pay the
+same consumer-side memory traffic; "in-process" is that crc32 alone, i.e.
+the floor without any IPC.
+
+Run from backend/: python -m benchmarks.bench_ocr_handoff [--number 20]
+"""
+import argparse
+import os
+import zlib
+
+import numpy as np
+
+from app.ocr_pool import BufferPool, copy_into
+from .common import measure, print_table
+
+MB = 1024 * 1024
+
+def worker(requests, replies):
+    """Consume a payload (pickled object or shared-memory descriptor), touch every byte, acknowledge"""
+    from multiprocessing import shared_memory
+
+    attached = {}
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        if isinstance(item, tuple):
+            name, length = item
+            segment = attached.setdefault(name, shared_memory.SharedMemory(name=name))
+            view = segment.buf[:length]
+            replies.put(zlib.crc32(view))
+            view.release()
+        else:
+            replies.put(zlib.crc32(item))
+
+def payloads():
+    rng = np.random.default_rng(0)
+    for mb in (1, 4, 10):
+        yield f"upload {mb} MB", rng.integers(0, 256, mb * MB, dtype=np.uint8).tobytes()
+    yield "decoded 6000x4000 gray", rng.integers(0, 256, (4000, 6000), dtype=np.uint8)
+    yield "decoded 6000x4000 RGB", rng.integers(0, 256, (4000, 6000, 3), dtype=np.uint8)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    requests, replies = context.Queue(), context.Queue()
+    process = context.Process(target=worker, args=(requests, replies), daemon=True)
+    process.start()
+    buffers = BufferPool(2, 80 * MB)
+
+    def pickled(payload):
+        requests.put(payload)
+        replies.get()
+
+    def shared(payload):
+        segment, pooled = buffers.acquire(payload.nbytes if isinstance(payload, np.ndarray) else len(payload))
+        try:
+            if isinstance(payload, np.ndarray):
+                # A decoder would write straight into the segment; the copy is counted here anyway
+                target = np.ndarray(payload.shape, payload.dtype, buffer=segment.buf)
+                np.copyto(target, payload)
+                length = payload.nbytes
+                del target
+            else:
+                length = copy_into(segment.buf, payload)
+            requests.put((segment.name, length))
+            replies.get()
+        finally:
+            buffers.release(segment, pooled)
+
+    rows = []
+    try:
+        for label, payload in payloads():
+            size = payload.nbytes if isinstance(payload, np.ndarray) else len(payload)
+            floor = measure(lambda: zlib.crc32(payload), number=args.number, repeat=3)
+            pickle_us = measure(lambda: pickled(payload), number=args.number, repeat=3)
+            shared_us = measure(lambda: shared(payload), number=args.number, repeat=3)
+            rows.append((
+                label, f"{size / MB:.1f}", f"{floor / 1000:.2f}",
+                f"{pickle_us / 1000:.2f}", f"{shared_us / 1000:.2f}",
+                f"{(pickle_us - floor) / 1000:.2f}", f"{(shared_us - floor) / 1000:.2f}",
+                f"{size / (pickle_us / 1e6) / 1e9:.2f}", f"{size / (shared_us / 1e6) / 1e9:.2f}",
+            ))
+    finally:
+        requests.put(None)
+        process.join(timeout=10)
+        buffers.close()
+
+    print(f"{os.cpu_count()} CPUs, best of 3 x {args.number} requests; times in ms per request")
+    print_table(["payload", "MB", "in-process", "pickle", "shared", "pickle IPC", "shared IPC",
+                 "pickle GB/s", "shared GB/s"], rows)
+
+if __name__ == "__main__":
+    main()
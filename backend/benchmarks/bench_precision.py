@@ -0,0 +1,103 @@
+"""
+Granite CPU precision modes (fp32 / bf16 / int8) compared on latency, tokens/sec and RSS.
+
+Each mode runs in its own subprocess so resident memory is measured cleanly.
+bf16 needs native CPU support (avx512_bf16 or amx_bf16); without it the
+model falls back to fp32, so on most CPUs the bf16 row measures fp32 again.
+The "effective" column shows which precision actually ran.
+Uses a tiny offline model (pass --hidden/--layers for a larger one) unless
+GRANITE_MODEL points somewhere else.
+
+Run from backend/: python -m benchmarks.bench_precision [--tokens 64] [--hidden 512 --layers 8]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from .common import print_table
+from .tiny_model import build_tiny_model
+
+MODES = ["fp32", "bf16", "int8"]
+
+def rss_mb() -> float:
+    """Current resident set size of this process"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def run_mode(model_path: str, tokens: int, runs: int) -> dict:
+    """Child-process body: load in the configured precision and measure generation"""
+    import torch
+    from app.granite_medical import GraniteMedicalAssistant
+
+    before = rss_mb()
+    assistant = GraniteMedicalAssistant(model_path)
+    started = time.perf_counter()
+    assistant.load_model()
+    load_s = time.perf_counter() - started
+    assistant.warmup()
+
+    latencies = []
+    for _ in range(runs):
+        inputs, cached = assistant.encode_request("Aspirin 100 mg once daily, Ibuprofen 400 mg TID", 45)
+        started = time.perf_counter()
+        with torch.no_grad():
+            assistant.model.generate(**inputs, **cached, max_new_tokens=tokens, min_new_tokens=tokens,
+                                     do_sample=False, pad_token_id=assistant.tokenizer.eos_token_id)
+        latencies.append(time.perf_counter() - started)
+
+    latency = sorted(latencies)[len(latencies) // 2]
+    return {
+        "precision": assistant.precision(),
+        "load_s": load_s,
+        "latency_s": latency,
+        "tokens_per_sec": tokens / latency,
+        "model_rss_mb": rss_mb() - before,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--hidden", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    model_path = os.getenv("GRANITE_MODEL") or build_tiny_model(
+        f"/tmp/tiny-granite-{args.hidden}x{args.layers}", hidden_size=args.hidden, layers=args.layers
+    )
+
+    if args.child:
+        print(json.dumps(run_mode(model_path, args.tokens, args.runs)))
+        return
+
+    rows = []
+    for mode in MODES:
+        env = dict(os.environ, GRANITE_CPU_PRECISION=mode, GRANITE_PREFIX_CACHE="1")
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_precision", "--child", mode,
+             "--tokens", str(args.tokens), "--runs", str(args.runs),
+             "--hidden", str(args.hidden), "--layers", str(args.layers)],
+            env=env, capture_output=True, text=True, check=True,
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        rows.append((
+            mode, result["precision"], f"{result['load_s']:.2f}", f"{result['latency_s'] * 1000:.1f}",
+            f"{result['tokens_per_sec']:.1f}", f"{result['model_rss_mb']:.1f}", f"{result['peak_rss_mb']:.1f}",
+        ))
+
+    print(f"model: {model_path}, {args.tokens} tokens per request")
+    print_table(["mode", "effective", "load s", "latency ms", "tok/s", "model RSS MB", "peak RSS MB"], rows)
+    if any(mode == "bf16" and effective == "fp32" for mode, effective, *_ in rows):
+        print("\nnote: this CPU has no native bf16, so the bf16 row ran in fp32")
+
+if __name__ == "__main__":
+    main()
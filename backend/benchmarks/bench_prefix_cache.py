@@ -0,0 +1,66 @@
+"""
+Prefill latency of an advice request with and without the prompt-prefix KV cache.
+
+Times a generate call that produces a single token (i.e. prefill + one step),
+alternating between prescriptions so only the shared instructions are reused.
+Uses the tiny offline model unless GRANITE_MODEL points somewhere else.
+
+Run from backend/: python -m benchmarks.bench_prefix_cache [--runs 20]
+"""
+import argparse
+import os
+import statistics
+import time
+
+import torch
+
+from app import config
+from .common import print_table
+from .tiny_model import build_tiny_model
+
+PRESCRIPTIONS = [
+    "Aspirin 100 mg once daily, Ibuprofen 400 mg TID",
+    "Metformin 500 mg BID",
+    "Atorvastatin 20 mg daily, Clarithromycin 500 mg BID",
+]
+
+def time_prefill(assistant, runs: int):
+    timings = []
+    for i in range(runs):
+        started = time.perf_counter()
+        inputs, cached = assistant.encode_request(PRESCRIPTIONS[i % len(PRESCRIPTIONS)], 30 + i)
+        with torch.no_grad():
+            assistant.model.generate(**inputs, **cached, max_new_tokens=1, do_sample=False,
+                                     pad_token_id=assistant.tokenizer.eos_token_id)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), len(inputs["input_ids"][0])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    model_path = os.getenv("GRANITE_MODEL") or build_tiny_model("/tmp/tiny-granite")
+
+    from app.granite_medical import GraniteMedicalAssistant
+
+    assistant = GraniteMedicalAssistant(model_path)
+    assistant.load_model()
+    assistant.warmup()
+
+    config.GRANITE_PREFIX_CACHE = False
+    full_ms, prompt_tokens = time_prefill(assistant, args.runs)
+    config.GRANITE_PREFIX_CACHE = True
+    assistant.encode_request(PRESCRIPTIONS[0], 30)  # build the cache outside the timed runs
+    cached_ms, _ = time_prefill(assistant, args.runs)
+    prefix_tokens = assistant.prefix_cache[1].shape[-1]
+
+    print(f"model: {model_path}  prompt: {prompt_tokens} tokens, cached prefix: {prefix_tokens} tokens")
+    print_table(
+        ["mode", "median prefill ms"],
+        [("full prefill", f"{full_ms:.2f}"), ("prefix cache", f"{cached_ms:.2f}"),
+         ("speedup", f"{full_ms / cached_ms:.2f}x")],
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Serialization cost of one /verify response, default path vs ?fast=true.
+
+default: pydantic models -> jsonable_encoder -> json.dumps (what FastAPI does for /verify)
+fast:    __slots__ records -> to_dict -> orjson (FastJSONResponse)
+
+Run from backend/: python -m benchmarks.bench_serialization
+"""
+import json
+
+from fastapi.encoders import jsonable_encoder
+
+from app.records import MODEL_TYPES, RECORD_TYPES, FastJSONResponse
+from .common import measure, print_table
+
+def build_response(types, alerts: int):
+    """A verdict with `alerts` interaction, dosage and alternative entries each"""
+    drugs = [types.drug(name=f"Drug{i}", dosage="500mg", frequency="twice daily") for i in range(alerts)]
+    return types.verification(
+        is_safe=False,
+        extracted_drugs=drugs,
+        interactions=[
+            types.interaction(drug_a=f"Drug{i}", drug_b="Ibuprofen",
+                              description="May increase risk of serious bleeding", severity="high")
+            for i in range(alerts)
+        ],
+        dosage_alerts=[
+            types.dosage(drug=f"Drug{i}", issue="Age-appropriate dosage recommendation",
+                         recommended_dosage="250-500mg twice daily")
+            for i in range(alerts)
+        ],
+        alternatives=[
+            types.alternative(original_drug=f"Drug{i}", suggested_drug="Acetaminophen",
+                              reason="Alternative due to May increase risk of serious bleeding")
+            for i in range(alerts)
+        ],
+    )
+
+def default_path(alerts):
+    response = build_response(MODEL_TYPES, alerts)
+    return json.dumps(jsonable_encoder(response), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def fast_path(alerts):
+    return FastJSONResponse(build_response(RECORD_TYPES, alerts)).body
+
+def main():
+    rows = []
+    for alerts in (1, 10, 100):
+        assert json.loads(default_path(alerts)) == json.loads(fast_path(alerts))
+        number = max(10, 2000 // alerts)
+        default_us = measure(lambda: default_path(alerts), number)
+        fast_us = measure(lambda: fast_path(alerts), number)
+        rows.append((alerts, f"{default_us:.1f}", f"{fast_us:.1f}", f"{default_us / fast_us:.1f}x"))
+    print_table(["alerts", "default us/resp", "fast us/resp", "speedup"], rows)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Cold-start cost of the API per APP_ROLE.
+
+Each measurement runs in a fresh interpreter: the time to import app.main
+(what a worker pays before it can accept connections), then the time to
+import the subsystems the role serves (what the background preload, or the
+first request without preload, pays). Best of --runs.
+
+Run from backend/: python -m benchmarks.bench_startup [--runs 3]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from .common import print_table
+
+ROLES = ["verify", "ocr", "llm", "all"]
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import app.main
+from app import config
+from app.subsystems import get_llm, get_ocr_processor
+app_s = time.perf_counter() - started
+started = time.perf_counter()
+if config.serves("ocr"):
+    get_ocr_processor()
+if config.serves("llm"):
+    get_llm()
+print(json.dumps({
+    "app_s": app_s,
+    "subsystems_s": time.perf_counter() - started,
+    "modules": len(sys.modules),
+    "heavy": sorted(m for m in ("torch", "transformers", "cv2", "pytesseract", "numpy") if m in sys.modules),
+}))
+"""
+
+def measure_role(role: str, runs: int) -> dict:
+    env = dict(os.environ, APP_ROLE=role, GRANITE_WORKERS="0")
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    best = min(results, key=lambda r: r["app_s"] + r["subsystems_s"])
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = []
+    for role in ROLES:
+        result = measure_role(role, args.runs)
+        rows.append((
+            role, f"{result['app_s']:.2f}", f"{result['subsystems_s']:.2f}",
+            f"{result['app_s'] + result['subsystems_s']:.2f}", result["modules"], ", ".join(result["heavy"]) or "-",
+        ))
+    print_table(["role", "import app s", "subsystems s", "total s", "modules", "heavy modules"], rows)
+
+if __name__ == "__main__":
+    main()
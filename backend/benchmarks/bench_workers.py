@@ -0,0 +1,139 @@
+"""
+/verify throughput and memory against the number of API worker processes.
+
+For each worker count, starts the prefork server (app.serve) on a free port,
+drives it with keep-alive HTTP clients in separate processes for a fixed
+time, then reads the memory of the parent and workers from
+/proc/<pid>/smaps_rollup. PSS splits shared pages between the processes
+that map them, so the growth of total PSS per added worker is what a worker
+really costs; USS is the memory private to one worker.
+
+The load clients share the machine with the server: pin them elsewhere
+(taskset) or use a large host for meaningful throughput numbers.
+
+Run from backend/: python -m benchmarks.bench_workers [--workers 1 2 4] [--seconds 10] [--clients 4]
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from .common import free_port, print_table, wait_ready
+
+BODY = json.dumps({
+    "patient": {"age": 70},
+    "drugs": [{"name": "Warfarin", "dosage": "5mg", "frequency": "daily"}],
+    "text_input": "Rx: Aspirin 100mg once daily. Ibuprofen 400 mg tid. Clarithromycin 500mg bid; atorvastatin 20 mg",
+})
+
+def client(port: int, connections: int, seconds: float, results):
+    """Client process: `connections` threads, each posting /verify over one keep-alive connection"""
+    latencies, errors = [], [0]
+    deadline = time.monotonic() + seconds
+
+    def run():
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        headers = {"Content-Type": "application/json"}
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                conn.request("POST", "/verify", BODY, headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=run) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((latencies, errors[0]))
+
+def memory_mb(pid: int) -> dict:
+    """PSS and USS (private clean + dirty) of one process"""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {"pss": fields.get("Pss", 0.0),
+            "uss": fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0)}
+
+def server_pids(parent: int) -> list:
+    with open(f"/proc/{parent}/task/{parent}/children") as f:
+        return [int(pid) for pid in f.read().split()]
+
+def measure(workers: int, args) -> dict:
+    port = free_port()
+    env = dict(os.environ, APP_ROLE=args.role, VERIFY_MAX_QUEUE="100000")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.serve", "--workers", str(workers), "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(port)
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(port, args.connections, args.seconds, results))
+                   for _ in range(args.clients)]
+        for process in clients:
+            process.start()
+        collected = [results.get() for _ in clients]
+        for process in clients:
+            process.join()
+
+        parent = memory_mb(server.pid)
+        children = [memory_mb(pid) for pid in server_pids(server.pid)]
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    latencies = sorted(latency for batch, _ in collected for latency in batch)
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {
+        "rps": len(latencies) / args.seconds,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "errors": sum(errors for _, errors in collected),
+        "pss_mb": parent["pss"] + sum(child["pss"] for child in children),
+        "worker_uss_mb": statistics.mean(child["uss"] for child in children) if children else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=4, help="load generator processes")
+    parser.add_argument("--connections", type=int, default=8, help="keep-alive connections per client process")
+    parser.add_argument("--role", default="verify", help="APP_ROLE of the server")
+    args = parser.parse_args()
+
+    rows, baseline = [], None
+    for workers in args.workers:
+        result = measure(workers, args)
+        baseline = baseline or result
+        rows.append((
+            workers, f"{result['rps']:.0f}", f"{result['rps'] / baseline['rps']:.2f}x",
+            f"{result['p50_ms']:.1f}", f"{result['p99_ms']:.1f}", result["errors"],
+            f"{result['pss_mb']:.0f}", f"{result['worker_uss_mb']:.1f}",
+        ))
+    print(f"{os.cpu_count()} CPUs, APP_ROLE={args.role}, {args.clients}x{args.connections} connections, "
+          f"{args.seconds:g}s per run")
+    print_table(["workers", "req/s", "speedup", "p50 ms", "p99 ms", "errors", "total PSS MB", "USS/worker MB"], rows)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import http.client
+import socket
+import sys
+import time
+
+def measure(fn, number: int = 1000, repeat: int = 5) -> float:
+    """Best-of-`repeat` time per call of `fn`, in microseconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best * 1e6
+
+def print_table(headers, rows, out=sys.stdout):
+    """Print rows as a fixed-width text table"""
+    widths = [max(len(str(h)), *(len(str(r[i])) for r in rows)) for i, h in enumerate(headers)]
+    line = "  ".join(f"{{:>{w}}}" for w in widths)
+    print(line.format(*headers), file=out)
+    for row in rows:
+        print(line.format(*row), file=out)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_ready(port: int, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/ready")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} not ready after {timeout}s")
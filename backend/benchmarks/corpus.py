@@ -0,0 +1,77 @@
+"""
+Synthetic prescription corpus for load tests and OCR runs, with no patient data.
+
+Records come from benchmarks.synthetic.prescription(): drugs from the
+formulary with strengths from the dosage table, frequency terms the
+extractor knows, and a known interacting pair in about a third of them.
+With --images each record is also rendered to a noisy, skewed, blurred,
+hand-lettered JPEG (see synthetic.render_prescription). Handwriting fonts
+are picked up from the system font directories or --fonts; without any,
+the default font is jittered per character.
+
+Writes OUT/manifest.jsonl, one record per line:
+{"id", "text", "drugs", "patient", "image": "images/<id>.jpg" (with --images)}
+
+Run from backend/: python -m benchmarks.corpus --out corpus --count 500 [--images]
+"""
+import argparse
+import json
+import os
+import random
+import time
+from typing import Dict, Iterator, List, Optional
+
+from . import synthetic
+
+def generate(count: int, seed: int = 0, images: bool = False, fonts: Optional[List[str]] = None,
+             width: int = 1240, height: int = 1754, quality: int = 80) -> Iterator[Dict]:
+    """Corpus records; with `images`, each also has its rendered JPEG under "image_bytes" """
+    rng = random.Random(seed)
+    for index in range(count):
+        record = {"id": f"rx{index:06d}", **synthetic.prescription(rng)}
+        if images:
+            image = synthetic.render_prescription(record["text"], rng, width, height, fonts)
+            record["image_bytes"] = synthetic.encode(image, "JPEG", quality=quality)
+        yield record
+
+def load(directory: str, images: bool = True) -> List[Dict]:
+    """Read a corpus written by this module, with the image bytes of records that have one"""
+    records = []
+    with open(os.path.join(directory, "manifest.jsonl")) as f:
+        for line in f:
+            record = json.loads(line)
+            if images and "image" in record:
+                with open(os.path.join(directory, record["image"]), "rb") as image:
+                    record["image_bytes"] = image.read()
+            records.append(record)
+    return records
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic prescription corpus")
+    parser.add_argument("--out", default="corpus")
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--images", action="store_true", help="also render each prescription to a JPEG")
+    parser.add_argument("--fonts", nargs="*", help="directories with handwriting fonts (default: system fonts)")
+    parser.add_argument("--width", type=int, default=1240)
+    parser.add_argument("--height", type=int, default=1754)
+    args = parser.parse_args()
+
+    fonts = synthetic.handwriting_fonts(args.fonts) if args.images else None
+    if args.images:
+        print(f"{len(fonts)} handwriting fonts found" + ("" if fonts else "; using the jittered default font"))
+    os.makedirs(os.path.join(args.out, "images") if args.images else args.out, exist_ok=True)
+    started = time.perf_counter()
+    with open(os.path.join(args.out, "manifest.jsonl"), "w") as manifest:
+        for record in generate(args.count, args.seed, args.images, fonts, args.width, args.height):
+            image = record.pop("image_bytes", None)
+            if image is not None:
+                record["image"] = f"images/{record['id']}.jpg"
+                with open(os.path.join(args.out, record["image"]), "wb") as f:
+                    f.write(image)
+            manifest.write(json.dumps(record) + "\n")
+    elapsed = time.perf_counter() - started
+    print(f"Wrote {args.count} records to {args.out} in {elapsed:.1f}s ({args.count / elapsed:.1f}/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Replay a prescription corpus against the API and report throughput, latency
+percentiles and error rates per endpoint.
+
+Without --url it starts the prefork server (app.serve) with --workers on a
+free port, APP_ROLE=verify,ocr (no Granite), waits for /ready and stops it
+afterwards. The corpus is read from --corpus (see benchmarks.corpus) or
+generated in memory.
+
+Two load models:
+- --rate R: open loop. Request i is due at start + i/R whatever the server
+  does, and its latency counts from that due time, so a server that falls
+  behind shows up as latency rather than as a lower offered load. At most
+  --max-in-flight requests are outstanding; requests that could only start
+  more than 10 ms late are counted.
+- --concurrency N (default): closed loop, N clients each sending the next
+  request as soon as the previous one is answered.
+
+--mix weights the endpoints: verify (the record's drugs and text as JSON),
+analyze-image and extract-text (its rendered JPEG). 429 answers (admission
+control shedding load) are counted as rejected, apart from errors (other
+statuses and connection failures). Latency percentiles are over the 200
+answers. The driver shares the machine with a local server: pin one or both
+(taskset) for meaningful numbers on a small box.
+
+Run from backend/: python -m benchmarks.loadtest [--corpus corpus] [--rate 20 | --concurrency 8] [--seconds 30]
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+from . import corpus
+from .common import free_port, print_table, wait_ready
+
+PATHS = {"verify": "/verify", "analyze-image": "/analyze-image", "extract-text": "/extract-text"}
+IMAGE_ENDPOINTS = {"analyze-image", "extract-text"}
+# A request that starts this much after its due time counts as late (open loop)
+LATE_AFTER = 0.010
+
+def multipart(fields: Dict[str, str], files: Dict[str, Tuple[str, bytes, str]]) -> Tuple[bytes, str]:
+    """A multipart/form-data body and its Content-Type"""
+    boundary = f"----loadtest{uuid.uuid4().hex}"
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data, content_type) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+def build_request(record: Dict, endpoint: str) -> Tuple[str, bytes, Dict[str, str]]:
+    """(path, body, headers) of one request for a corpus record"""
+    if endpoint == "verify":
+        body = {"patient": record["patient"], "drugs": record["drugs"], "text_input": record["text"]}
+        return PATHS[endpoint], json.dumps(body).encode(), {"Content-Type": "application/json"}
+    fields = {"patient": json.dumps(record["patient"])} if endpoint == "analyze-image" else {}
+    body, content_type = multipart(fields, {"image_file": (f"{record['id']}.jpg", record["image_bytes"], "image/jpeg")})
+    return PATHS[endpoint], body, {"Content-Type": content_type}
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in PATHS:
+            raise SystemExit(f"Unknown endpoint {name!r} in --mix; choose from {', '.join(PATHS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+def plan(records: List[Dict], weights: Dict[str, float], seed: int) -> List[Tuple[str, Dict]]:
+    """The (endpoint, record) sequence to replay; records without an image only go to /verify"""
+    rng = random.Random(seed)
+    endpoints, shares = zip(*weights.items())
+    sequence = []
+    for record in records:
+        endpoint = rng.choices(endpoints, shares)[0]
+        if endpoint in IMAGE_ENDPOINTS and "image_bytes" not in record:
+            endpoint = "verify"
+        sequence.append((endpoint, record))
+    return sequence
+
+class Driver:
+    """Sends the planned requests from worker threads, one keep-alive connection each"""
+
+    def __init__(self, url: str, sequence: List[Tuple[str, Dict]], timeout: float):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.sequence = sequence
+        self.timeout = timeout
+        self.counter = itertools.count()
+        self.results: List[Tuple[str, float, int]] = []  # (endpoint, latency, status; 0 = failed)
+        self.late = 0
+        self.lock = threading.Lock()
+
+    def connect(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def send(self, conn, index: int) -> Tuple[str, int, http.client.HTTPConnection]:
+        endpoint, record = self.sequence[index % len(self.sequence)]
+        path, body, headers = build_request(record, endpoint)
+        try:
+            conn.request("POST", path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            return endpoint, response.status, conn
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            return endpoint, 0, self.connect()
+
+    def closed_loop(self, deadline: float):
+        conn = self.connect()
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            endpoint, status, conn = self.send(conn, next(self.counter))
+            self.results.append((endpoint, time.monotonic() - started, status))
+
+    def open_loop(self, start: float, rate: float, deadline: float):
+        conn = self.connect()
+        while True:
+            index = next(self.counter)
+            due = start + index / rate
+            if due >= deadline:
+                return
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif -delay > LATE_AFTER:
+                with self.lock:
+                    self.late += 1
+            endpoint, status, conn = self.send(conn, index)
+            self.results.append((endpoint, time.monotonic() - due, status))
+
+    def run(self, seconds: float, concurrency: int, rate: float = 0.0) -> float:
+        """Drive for `seconds`; returns the elapsed wall time"""
+        start = time.monotonic()
+        deadline = start + seconds
+        target, args = (self.open_loop, (start, rate, deadline)) if rate else (self.closed_loop, (deadline,))
+        threads = [threading.Thread(target=target, args=args) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - start
+
+def summarize(results: List[Tuple[str, float, int]], elapsed: float) -> Dict[str, Dict]:
+    """Per endpoint and in total: counts, throughput, error rates and latency percentiles (ms)"""
+    groups = defaultdict(list)
+    for endpoint, latency, status in results:
+        groups[endpoint].append((latency, status))
+        groups["total"].append((latency, status))
+    report = {}
+    for endpoint, entries in groups.items():
+        ok = sorted(latency for latency, status in entries if status == 200)
+        statuses = Counter(status for _, status in entries)
+        quantiles = statistics.quantiles(ok, n=100, method="inclusive") if len(ok) > 1 else [ok[0] if ok else 0.0] * 99
+        rejected = statuses.get(429, 0)
+        errors = len(entries) - len(ok) - rejected
+        report[endpoint] = {
+            "requests": len(entries),
+            "ok": len(ok),
+            "rejected": rejected,
+            "errors": errors,
+            "throughput_rps": len(ok) / elapsed,
+            "error_rate": errors / len(entries),
+            "reject_rate": rejected / len(entries),
+            "p50_ms": quantiles[49] * 1000,
+            "p95_ms": quantiles[94] * 1000,
+            "p99_ms": quantiles[98] * 1000,
+            "max_ms": (ok[-1] if ok else 0.0) * 1000,
+            "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        }
+    return report
+
+def start_server(workers: int, role: str) -> Tuple[subprocess.Popen, str]:
+    port = free_port()
+    env = dict(os.environ, APP_ROLE=role)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.serve", "--workers", str(workers), "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(port)
+    except RuntimeError:
+        server.terminate()
+        raise
+    return server, f"http://127.0.0.1:{port}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a prescription corpus against the API")
+    parser.add_argument("--url", help="API to load (default: start app.serve locally)")
+    parser.add_argument("--workers", type=int, default=1, help="API workers of the local server")
+    parser.add_argument("--role", default="verify,ocr", help="APP_ROLE of the local server")
+    parser.add_argument("--corpus", help="corpus directory from benchmarks.corpus (default: generate in memory)")
+    parser.add_argument("--generate", type=int, default=100, help="records to generate without --corpus")
+    parser.add_argument("--mix", default="verify=1", help="endpoint weights, e.g. verify=4,analyze-image=1")
+    parser.add_argument("--rate", type=float, default=0.0, help="open loop: requests per second")
+    parser.add_argument("--concurrency", type=int, default=8, help="closed loop: concurrent clients")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="open loop: outstanding request cap")
+    parser.add_argument("--seconds", type=float, default=30.0)
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    images = bool(IMAGE_ENDPOINTS & weights.keys())
+    if args.corpus:
+        records = corpus.load(args.corpus, images)
+    else:
+        records = list(corpus.generate(args.generate, args.seed, images))
+    sequence = plan(records, weights, args.seed)
+
+    server, url = (None, args.url) if args.url else start_server(args.workers, args.role)
+    try:
+        driver = Driver(url, sequence, args.timeout)
+        clients = args.max_in_flight if args.rate else args.concurrency
+        elapsed = driver.run(args.seconds, clients, args.rate)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    report = summarize(driver.results, elapsed)
+    load = f"open loop at {args.rate:g} req/s" if args.rate else f"closed loop, {args.concurrency} clients"
+    print(f"{url}, {load}, {elapsed:.1f}s, {len(records)} records, {os.cpu_count()} CPUs"
+          + (f", {driver.late} requests started late" if args.rate else ""))
+    print_table(
+        ["endpoint", "requests", "ok/s", "p50 ms", "p95 ms", "p99 ms", "max ms", "rejected %", "errors %"],
+        [(endpoint, r["requests"], f"{r['throughput_rps']:.1f}", f"{r['p50_ms']:.1f}", f"{r['p95_ms']:.1f}",
+          f"{r['p99_ms']:.1f}", f"{r['max_ms']:.1f}", f"{r['reject_rate'] * 100:.1f}", f"{r['error_rate'] * 100:.1f}")
+         for endpoint, r in sorted(report.items(), key=lambda item: item[0] == "total")],
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"url": url, "load": load, "seconds": elapsed, "late": driver.late, "endpoints": report}, f,
+                      indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Regression suite over the hot paths, with stored baselines.
+
+Micro: drug extraction, dosage extraction, interaction checks against a
+synthetic 1000-drug formulary for 2 to 50-drug regimens, the OCR dictionary
+correction, and image preprocessing at three resolutions. End to end:
+/verify and /extract-text through an in-process client (/extract-text is
+skipped when the tesseract binary is missing). Inputs come from
+benchmarks.synthetic, so nothing is downloaded; APP_ROLE defaults to
+verify,ocr, so Granite is never loaded.
+
+Every case is timed with common.measure, i.e. the best of several repeats,
+the least noisy statistic on a shared box.
+
+    python -m benchmarks.suite run [--filter interactions] [--quick] [--output results.json]
+    python -m benchmarks.suite save [--baseline benchmarks/baselines/default.json]
+    python -m benchmarks.suite compare [--baseline ...] [--results results.json] [--threshold 15]
+
+compare exits with status 1 when any case is slower than its baseline by
+more than --threshold percent (default: BENCH_THRESHOLD, else 15). Baselines
+are only comparable on the machine they were saved on; compare warns when
+the recorded machine differs.
+
+Run from backend/: python -m benchmarks.suite run
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+
+# Before the app is imported: the end-to-end cases need no model
+os.environ.setdefault("APP_ROLE", "verify,ocr")
+os.environ.setdefault("OCR_PRELOAD", "0")
+
+from app import drug_utils, nlp_utils
+from app.models import Drug
+from . import synthetic
+from .common import measure, print_table
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baselines", "default.json")
+
+# Each group yields (case name, function to time, calls per repeat); setup happens between yields
+
+def extraction_cases():
+    for drugs in (1, 5, 20):
+        text = synthetic.prescription_text(drugs, seed=drugs)
+        yield (f"extract_drugs_from_text/{drugs}_drugs",
+               lambda text=text: nlp_utils.extract_drugs_from_text(text), 200)
+    text = synthetic.prescription_text(20, seed=20).lower()
+    yield "extract_dosage_for_drug/hit", lambda: nlp_utils.extract_dosage_for_drug(text, "aspirin"), 5000
+    yield "extract_dosage_for_drug/miss", lambda: nlp_utils.extract_dosage_for_drug(text, "tramadol"), 50000
+
+def interaction_cases():
+    # A synthetic formulary replaces the knowledge base while these run
+    kb = synthetic.knowledge_base(1000, 20000)
+    original = drug_utils.knowledge_base
+    drug_utils.knowledge_base = kb
+    try:
+        for size in (2, 10, 25, 50):
+            regimen = [Drug(name=name) for name in random.Random(size).sample(kb.drug_names, size)]
+            number = max(50, 200000 // (size * size))
+            yield (f"check_interactions/{size}_drugs",
+                   lambda regimen=regimen: drug_utils.check_interactions(regimen, 70), number)
+    finally:
+        drug_utils.knowledge_base = original
+
+def ocr_cases():
+    from app.ocr_processor import ocr_processor
+
+    for words in (50, 300):
+        text = synthetic.ocr_text(words, seed=words)
+        yield (f"enhance_with_medical_dictionary/{words}_words",
+               lambda text=text: ocr_processor.enhance_with_medical_dictionary(text), max(20, 20000 // words))
+    for label, (width, height) in {"vga": (640, 480), "a4_150dpi": (1240, 1754), "a4_300dpi": (2480, 3508)}.items():
+        image = synthetic.prescription_image(width, height, seed=width)
+        yield (f"preprocess_image/{label}",
+               lambda image=image: ocr_processor.preprocess_image(image), max(2, 20000000 // (width * height)))
+
+def tesseract_available() -> bool:
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+        return True
+    except Exception:
+        return False
+
+def endpoint_cases():
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    def checked(response):
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.request.url} answered {response.status_code}: {response.text[:200]}")
+        return response
+
+    with TestClient(app) as client:
+        body = {
+            "patient": {"age": 70},
+            "drugs": [{"name": name, "dosage": "100mg"} for name in ("warfarin", "aspirin", "clarithromycin")],
+            "text_input": synthetic.prescription_text(5, seed=3),
+        }
+        for name, path in (("endpoint/verify", "/verify"), ("endpoint/verify_fast", "/verify?fast=true")):
+            checked(client.post(path, json=body))
+            yield name, lambda path=path: checked(client.post(path, json=body)), 100
+        if not tesseract_available():
+            print("skipping endpoint/extract-text: tesseract not installed", file=sys.stderr)
+            return
+        image = synthetic.encode(synthetic.prescription_image(1240, 1754, seed=1))
+        files = {"image_file": ("rx.png", image, "image/png")}
+        checked(client.post("/extract-text", files=files))
+        yield "endpoint/extract-text", lambda: checked(client.post("/extract-text", files=files)), 3
+
+GROUPS = [extraction_cases, interaction_cases, ocr_cases, endpoint_cases]
+
+def run(pattern: str = "", quick: bool = False) -> dict:
+    """Time every case whose name matches `pattern`; returns {"meta": ..., "results": {name: us per call}}"""
+    selected = re.compile(pattern)
+    results = {}
+    for group in GROUPS:
+        for name, fn, number in group():
+            if not selected.search(name):
+                continue
+            results[name] = round(measure(fn, number=max(1, number // 10) if quick else number,
+                                          repeat=3 if quick else 5), 2)
+            print(f"{name:<45} {results[name]:>12.1f} us", file=sys.stderr)
+    return {"meta": machine(), "results": results}
+
+def machine() -> dict:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def compare(baseline: dict, current: dict, threshold: float, pattern: str = "") -> bool:
+    """Print per-case changes against the baseline; False if any case regressed beyond `threshold` percent"""
+    old_meta, new_meta = baseline["meta"], current["meta"]
+    differs = [key for key in ("python", "machine", "processor", "cpus") if old_meta.get(key) != new_meta.get(key)]
+    if differs:
+        details = ", ".join(f"{key} {old_meta.get(key)} vs {new_meta.get(key)}" for key in differs)
+        print(f"warning: the baseline was saved on a different machine ({details})")
+    rows, regressed = [], []
+    for name, us in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            rows.append((name, "-", f"{us:.1f}", "-", "new"))
+            continue
+        change = (us - base) / base * 100
+        status = "REGRESSED" if change > threshold else "faster" if change < -threshold else "ok"
+        if status == "REGRESSED":
+            regressed.append(name)
+        rows.append((name, f"{base:.1f}", f"{us:.1f}", f"{change:+.1f}%", status))
+    for name in sorted(baseline["results"].keys() - current["results"].keys()):
+        if re.search(pattern, name):
+            rows.append((name, f"{baseline['results'][name]:.1f}", "-", "-", "not run"))
+    print_table(["case", "baseline us", "current us", "change", "status"], rows)
+    if regressed:
+        print(f"\n{len(regressed)} case(s) regressed by more than {threshold}%: {', '.join(regressed)}")
+    return not regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot-path benchmark suite with stored baselines")
+    parser.add_argument("command", choices=["run", "save", "compare"])
+    parser.add_argument("--filter", default="", help="only cases whose name matches this regex")
+    parser.add_argument("--quick", action="store_true", help="a tenth of the calls and 3 repeats per case")
+    parser.add_argument("--output", help="run: also write the results to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--results", help="compare: a results file from `run --output` instead of a fresh run")
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("BENCH_THRESHOLD", 15)),
+                        help="compare: percent slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    if args.command == "compare" and args.results:
+        with open(args.results) as f:
+            current = json.load(f)
+    else:
+        current = run(args.filter, args.quick)
+
+    if args.command == "run":
+        print_table(["case", "us/call"], [(name, f"{us:.1f}") for name, us in current["results"].items()])
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2)
+    elif args.command == "save":
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"Saved {len(current['results'])} cases to {args.baseline}")
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.exit(0 if compare(baseline, current, args.threshold, args.filter) else 1)
+
+if __name__ == "__main__":
+    main()
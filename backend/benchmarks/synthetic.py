@@ -0,0 +1,206 @@
+"""
+Synthetic inputs for the benchmarks: prescription texts, rendered
+prescription images and formularies of any size. Everything is seeded, so
+every run measures the same data.
+
+prescription() builds realistic records from the knowledge base's
+vocabularies (formulary, dosage table strengths, frequency terms, known
+interacting pairs) and render_prescription() puts them on paper the way a
+scan or phone photo would: handwriting-like lettering, skew, blur and noise.
+"""
+import glob
+import io
+import os
+import random
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+from app.knowledge_base import (COMMON_DRUGS, FREQUENCY_TERMS, KnowledgeBase, age_dosage_recommendations,
+                                drug_interactions)
+
+STRENGTHS = ["5", "10", "20", "25", "40", "50", "100", "200", "250", "400", "500", "850", "1000"]
+FREQUENCIES = ["once daily", "twice daily", "daily", "bid", "tid", "qid", "every day", "thrice daily"]
+# Lines that mention no drug, as found around the drug lines of a real prescription
+FILLER = [
+    "Patient: J. Doe    DOB: 04/11/1956",
+    "Dr. A. Smith, MD - General Practice",
+    "Take with food. Do not exceed the stated dose.",
+    "Refills: 2    Dispense as written",
+    "Review in 4 weeks",
+]
+
+def drug_line(rng: random.Random, drug: str) -> str:
+    return f"{drug.title()} {rng.choice(STRENGTHS)}mg {rng.choice(FREQUENCIES)}"
+
+def prescription_text(drugs: int, seed: int = 0, names: Optional[List[str]] = None) -> str:
+    """A prescription of `drugs` drug lines (from COMMON_DRUGS, or `names`) among filler lines"""
+    rng = random.Random(seed)
+    pool = names or COMMON_DRUGS
+    chosen = rng.sample(pool, drugs) if drugs <= len(pool) else [rng.choice(pool) for _ in range(drugs)]
+    lines = [drug_line(rng, drug) for drug in chosen] + FILLER[:2 + drugs // 5]
+    rng.shuffle(lines)
+    return "\n".join(["Rx"] + lines)
+
+def ocr_text(words: int, seed: int = 0) -> str:
+    """OCR-like output: drug names, truncated and misspelled words, units and noise tokens"""
+    rng = random.Random(seed)
+    vocabulary = COMMON_DRUGS + ["mg", "tablet", "take", "daily", "bid", "with", "food", "refill", "Dr.", "qty"]
+    tokens = []
+    for _ in range(words):
+        word = rng.choice(vocabulary)
+        roll = rng.random()
+        if roll < 0.2:
+            word = word[:max(3, len(word) - 2)]
+        elif roll < 0.3:
+            i = rng.randrange(len(word))
+            word = word[:i] + rng.choice("0o1lI5s") + word[i + 1:]
+        elif roll < 0.4:
+            word = rng.choice(STRENGTHS) + "mg"
+        tokens.append(word)
+    return " ".join(tokens)
+
+def font(size: int):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1 has a single bitmap font
+        return ImageFont.load_default()
+
+def prescription_image(width: int, height: int, text: Optional[str] = None, seed: int = 0) -> Image.Image:
+    """A white page with the prescription typed on it, text scaled to the page width"""
+    text = text or prescription_text(5, seed)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    size = max(10, width // 40)
+    typeface = font(size)
+    y = size
+    for line in text.splitlines():
+        draw.text((size * 2, y), line, fill=(20, 20, 40), font=typeface)
+        y += int(size * 1.6)
+        if y > height - size:
+            break
+    return image
+
+def encode(image: Image.Image, format: str = "PNG", **options) -> bytes:
+    out = io.BytesIO()
+    image.save(out, format, **options)
+    return out.getvalue()
+
+def knowledge_base(drugs: int, interactions: int, seed: int = 0) -> KnowledgeBase:
+    """A formulary of `drugs` made-up drugs with `interactions` random pairs"""
+    rng = random.Random(seed)
+    names = [f"drug{i:05d}" for i in range(drugs)]
+    pairs = {}
+    while len(pairs) < min(interactions, drugs * (drugs - 1) // 2):
+        a, b = rng.sample(names, 2)
+        if (b, a) not in pairs:
+            pairs[(a, b)] = rng.choice(["May increase risk of bleeding", "Reduced effect", "Increased toxicity"])
+    dosages = {name: {"adult": "10-20mg daily", "child": "5mg daily"} for name in names}
+    alternatives = {name: rng.sample(names, 2) for name in names[:drugs // 4]}
+    return KnowledgeBase(names, pairs, dosages, alternatives)
+
+# Prescription records built from the knowledge base vocabularies
+
+def strengths_for(drug: str) -> List[str]:
+    """Strengths (mg) quoted in the dosage table for a drug, else common ones"""
+    adult = age_dosage_recommendations.get(drug, {}).get("adult", "")
+    quoted = [value for value in re.findall(r"\d+", adult.split("mg")[0])] if "mg" in adult else []
+    return quoted or STRENGTHS
+
+# The frequency terms the extractor knows, bare counts ("twice") completed to "twice daily"
+FREQUENCY_PHRASES = sorted({f"{term} daily" if term in ("once", "twice", "thrice") else term
+                            for term in FREQUENCY_TERMS.split("|")} | set(FREQUENCIES))
+INTERACTING_PAIRS = [pair for pair in drug_interactions if all(drug in COMMON_DRUGS for drug in pair)]
+LINE_FORMATS = [
+    "{name} {strength}mg {frequency}",
+    "{name} {strength} mg - {frequency}",
+    "Tab. {name} {strength}mg, 1 tab {frequency}",
+    "{name} {strength}mg tablets {frequency}",
+    "{name}: {strength}mg {frequency} x 7 days",
+]
+
+def prescription(rng: random.Random, max_drugs: int = 6, interaction_rate: float = 0.3) -> Dict:
+    """
+    One prescription record: text, the drugs written on it and a patient. With
+    probability `interaction_rate` it contains a pair from the interaction table.
+    """
+    names = rng.sample(COMMON_DRUGS, rng.randint(1, max_drugs))
+    if rng.random() < interaction_rate:
+        pair = rng.choice(INTERACTING_PAIRS)
+        names = list(pair) + [name for name in names if name not in pair][:max(0, max_drugs - 2)]
+        rng.shuffle(names)
+    drugs, lines = [], []
+    for name in names:
+        strength, frequency = rng.choice(strengths_for(name)), rng.choice(FREQUENCY_PHRASES)
+        drugs.append({"name": name.title(), "dosage": f"{strength}mg", "frequency": frequency})
+        lines.append(rng.choice(LINE_FORMATS).format(name=name.title(), strength=strength, frequency=frequency))
+    header = rng.sample(FILLER, 3)
+    footer = [header.pop()]
+    age = rng.choice([rng.randint(2, 17), rng.randint(18, 64), rng.randint(65, 95)])
+    return {
+        "text": "\n".join(header + ["Rx"] + lines + footer),
+        "drugs": drugs,
+        "patient": {"age": age},
+    }
+
+# Rendering
+
+FONT_DIRS = ["/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.fonts")]
+HANDWRITING = re.compile(r"hand|script|comic|caveat|dancing|marker|kalam|indie|shadows|architect|gloria|"
+                         r"homemade|reenie|rocksalt|satisfy|cursive", re.IGNORECASE)
+
+def handwriting_fonts(directories: Optional[List[str]] = None) -> List[str]:
+    """TrueType/OpenType fonts with handwriting-like names under `directories`"""
+    paths = []
+    for directory in directories or FONT_DIRS:
+        for pattern in ("**/*.ttf", "**/*.otf"):
+            paths += [path for path in glob.glob(os.path.join(directory, pattern), recursive=True)
+                      if HANDWRITING.search(os.path.basename(path))]
+    return sorted(paths)
+
+@lru_cache(maxsize=64)
+def truetype(path: Optional[str], size: int):
+    return ImageFont.truetype(path, size) if path else font(size)
+
+def render_prescription(text: str, rng: random.Random, width: int = 1240, height: int = 1754,
+                        fonts: Optional[List[str]] = None, skew: float = 3.0, blur: float = 1.2,
+                        noise: float = 0.05) -> Image.Image:
+    """
+    Letter `text` onto a tinted page like a hand-written or photographed
+    prescription: a handwriting font from `fonts` if any (else the default
+    font), each character with its own size and baseline jitter; then rotate
+    by up to `skew` degrees, blur with a radius up to `blur` and add Gaussian
+    plus salt-and-pepper noise of strength `noise` (0-1).
+    """
+    paper = tuple(rng.randint(225, 255) for _ in range(3))
+    ink = rng.choice([(20, 20, 30), (15, 30, 110), (40, 40, 40)])
+    image = Image.new("RGB", (width, height), paper)
+    draw = ImageDraw.Draw(image)
+    face = rng.choice(fonts) if fonts else None
+    size = max(12, width // rng.randint(28, 40))
+    y = size * 2
+    for line in text.splitlines():
+        x = size * 2 + rng.randint(0, size)
+        for char in line:
+            typeface = truetype(face, max(8, int(size * rng.uniform(0.9, 1.1))))
+            draw.text((x, y + rng.uniform(-0.08, 0.08) * size), char, fill=ink, font=typeface)
+            x += draw.textlength(char, font=typeface) * rng.uniform(0.95, 1.1)
+        y += int(size * rng.uniform(1.5, 1.9))
+        if y > height - size * 2:
+            break
+
+    if skew:
+        image = image.rotate(rng.uniform(-skew, skew), resample=Image.BICUBIC, fillcolor=paper)
+    if blur:
+        image = image.filter(ImageFilter.GaussianBlur(rng.uniform(0, blur)))
+    if noise:
+        pixels = np.asarray(image, dtype=np.float32)
+        generator = np.random.default_rng(rng.getrandbits(32))
+        pixels += generator.normal(0, 255 * noise * 0.5, pixels.shape)
+        specks = generator.random(pixels.shape[:2]) < noise * 0.05
+        pixels[specks] = generator.choice([0.0, 255.0], size=(int(specks.sum()), 1))
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    return image
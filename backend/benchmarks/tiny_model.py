@@ -0,0 +1,81 @@
+"""
+Build a tiny causal LM + tokenizer on disk so the Granite code paths can run offline.
+
+The model is a randomly initialised Llama-architecture network with a few
+hundred thousand parameters and a byte-level BPE tokenizer trained on the
+drug vocabulary, saved with save_pretrained so it goes through the same
+from_pretrained / apply_chat_template path as the real model:
+
+    GRANITE_MODEL=$(python -m benchmarks.tiny_model /tmp/tiny-granite) uvicorn app.main:app
+"""
+import os
+import sys
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|start_of_role|>{{ message['role'] }}<|end_of_role|>{{ message['content'] }}<|end_of_text|>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|start_of_role|>assistant<|end_of_role|>{% endif %}"
+)
+
+SPECIAL_TOKENS = ["<|end_of_text|>", "<|start_of_role|>", "<|end_of_role|>", "<|pad|>"]
+
+def training_corpus():
+    from app.nlp_utils import COMMON_DRUGS
+    words = COMMON_DRUGS + [
+        "As a medical AI assistant, analyze this prescription for a patient",
+        "Prescription: take 500 mg twice daily once daily BID TID QID",
+        "Please provide potential drug interactions dosage considerations alternative safety recommendations",
+        "Analysis: user assistant system",
+    ]
+    return [" ".join(words)] * 4
+
+def build_tiny_model(path: str, hidden_size: int = 64, layers: int = 2, vocab_size: int = 512) -> str:
+    """Create (once) and return a directory loadable by AutoTokenizer/AutoModelForCausalLM"""
+    if os.path.exists(os.path.join(path, "config.json")):
+        return path
+
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(training_corpus(), trainer)
+
+    hf_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|end_of_text|>",
+        bos_token="<|end_of_text|>",
+        pad_token="<|pad|>",
+    )
+    hf_tokenizer.chat_template = CHAT_TEMPLATE
+
+    torch.manual_seed(0)
+    model_config = LlamaConfig(
+        vocab_size=len(hf_tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=2048,
+        eos_token_id=hf_tokenizer.eos_token_id,
+        bos_token_id=hf_tokenizer.bos_token_id,
+        pad_token_id=hf_tokenizer.pad_token_id,
+    )
+    model = LlamaForCausalLM(model_config)
+
+    os.makedirs(path, exist_ok=True)
+    hf_tokenizer.save_pretrained(path)
+    model.save_pretrained(path)
+    return path
+
+if __name__ == "__main__":
+    print(build_tiny_model(sys.argv[1] if len(sys.argv) > 1 else "/tmp/tiny-granite"))
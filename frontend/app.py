@@ -1,8 +1,15 @@
 import streamlit as st
 import requests
-from PIL import Image
-import io
-import time
+from requests.adapters import HTTPAdapter
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+# Backend base URL(s), comma separated; later ones are tried when an earlier one is unreachable
+API_URLS = [url.strip().rstrip("/") for url in os.getenv("MEDISAFE_API_URLS", "http://localhost:8000").split(",") if url.strip()]
+# Keep-alive connections kept open per backend URL (per browser session)
+API_POOL_SIZE = int(os.getenv("MEDISAFE_API_POOL_SIZE", "10"))
 
 # Configure page
 st.set_page_config(
@@ -312,36 +319,173 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Helper functions
-def extract_text_from_image_api(image_file):
-    """Send image to backend for OCR processing"""
-    try:
-        files = {"image_file": (image_file.name, image_file.getvalue(), image_file.type)}
-        response = requests.post("http://localhost:8000/extract-text", files=files, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            if result["success"]:
-                return result["extracted_text"], None
-            else:
-                return None, result.get("error", "Extraction failed")
-        else:
-            return None, f"API Error: {response.status_code}"
-            
-    except Exception as e:
-        return None, f"Connection failed: {str(e)}"
+def api_session():
+    """
+    A pooled keep-alive HTTP session per browser session, kept across reruns.
+    requests.Session is not guaranteed to be thread-safe and Streamlit runs each
+    browser session's script in its own thread, so sessions are not shared.
+    """
+    if "api_session" not in st.session_state:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(API_URLS), pool_maxsize=API_POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        st.session_state.api_session = session
+    return st.session_state.api_session
+
+def api_request(method, path, **kwargs):
+    """Send a request to the first reachable backend URL"""
+    for i, base_url in enumerate(API_URLS):
+        try:
+            return api_session().request(method, f"{base_url}{path}", **kwargs)
+        except requests.exceptions.ConnectionError:
+            if i == len(API_URLS) - 1:
+                raise
+
+# Successful API results kept per browser session, keyed by (kind, content hash)
+RESULT_CACHE_SIZE = 256
 
-def verify_prescription_api(prescription_data):
-    """Send prescription to backend for verification"""
-    API_URL = "http://localhost:8000/verify"
+def result_cache():
+    if "result_cache" not in st.session_state:
+        st.session_state.result_cache = OrderedDict()
+    return st.session_state.result_cache
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def cached_api_call(kind, key, call):
+    """
+    Return the cached result for `key`, or run `call()` -> (result, error) and cache a success.
+    The call itself is not wrapped in st.cache_data because it drives a progress bar
+    created outside it, which cached calls cannot replay.
+    """
+    cache = result_cache()
+    if (kind, key) in cache:
+        cache.move_to_end((kind, key))
+        return cache[(kind, key)], None
+    result, error = call()
+    if not error:
+        cache[(kind, key)] = result
+        while len(cache) > RESULT_CACHE_SIZE:
+            cache.popitem(last=False)
+    return result, error
+
+# Labels for the stage events streamed by the backend
+STAGE_LABELS = {
+    "decode": "Decoding image...",
+    "preprocess": "Preprocessing image...",
+    "ocr_pass": "Reading text from image...",
+    "postprocess": "Correcting medical terms...",
+    "extraction": "Extracting drug information...",
+    "interactions": "Analyzing drug interactions...",
+    "dosage": "Checking dosage recommendations...",
+    "alternatives": "Finding alternative medications...",
+}
+
+# Number of stage events each streaming endpoint reports
+VERIFY_STAGES = 4  # extraction, interactions, dosage, alternatives
+ANALYZE_IMAGE_STAGES = 12  # decode, preprocess, 4 OCR passes, postprocess + the verify stages + triage
+
+def iter_sse(response):
+    """Parse a server-sent events response into (event, data) pairs"""
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
+def stream_api(path, on_stage=None, method="POST", **kwargs):
+    """Call a streaming backend endpoint, calling on_stage for each progress event"""
     try:
-        response = requests.post(API_URL, json=prescription_data, timeout=30)
-        if response.status_code == 200:
-            return response.json(), None
-        else:
-            return None, f"API Error: {response.status_code} - {response.text}"
+        with api_request(method, path, stream=True, timeout=60, **kwargs) as response:
+            if response.status_code != 200:
+                return None, f"API Error: {response.status_code} - {response.text}"
+            for event, data in iter_sse(response):
+                if event == "stage" and on_stage:
+                    on_stage(data)
+                elif event == "result":
+                    return data, None
+                elif event == "error":
+                    return None, data.get("error", "Analysis failed")
+        return None, "Analysis stream ended without a result"
     except requests.exceptions.RequestException as e:
         return None, f"Connection failed: {str(e)}"
 
+def progress_reporter(total_stages):
+    """Create a progress bar driven by backend stage events; returns (on_stage, clear)"""
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    completed = []
+
+    def on_stage(event):
+        completed.append(event["stage"])
+        label = STAGE_LABELS.get(event["stage"], event["stage"])
+        status_text.text(f"{label} ({event.get('elapsed_ms', 0):.0f} ms)")
+        progress_bar.progress(min(len(completed) / total_stages, 1.0))
+
+    def clear():
+        status_text.empty()
+        progress_bar.empty()
+
+    return on_stage, clear
+
+def analyze_image_api(image_file, patient, on_stage=None):
+    """
+    Send image and patient info to backend for OCR and verification in one call.
+    Results are cached by image content and patient, so the same upload is never re-sent.
+    """
+    image_bytes = image_file.getvalue()
+    files = {"image_file": (image_file.name, image_bytes, image_file.type)}
+    data = {"patient": json.dumps(patient)}
+    return cached_api_call(
+        "analyze-image", content_hash(image_bytes, patient),
+        lambda: stream_api("/analyze-image/stream", on_stage, files=files, data=data),
+    )
+
+def build_patient_payload(age, weight, allergies, conditions):
+    """Build the patient section of a verification request"""
+    return {
+        "age": age,
+        "weight_kg": weight,
+        "allergies": [a.strip() for a in allergies.split(',') if a.strip()],
+        "conditions": [c.strip() for c in conditions.split(',') if c.strip()]
+    }
+
+def verify_prescription_api(prescription_data, on_stage=None):
+    """
+    Send prescription to backend for verification.
+    Verdicts are cached by request content; on a miss an incremental session is used,
+    so re-analysing edited text only re-checks what changed.
+    """
+    return cached_api_call(
+        "verify", content_hash(prescription_data),
+        lambda: verify_with_session(prescription_data, on_stage),
+    )
+
+def verify_with_session(prescription_data, on_stage=None):
+    """Verify through the backend's incremental session API (POST /sessions, then PUT /sessions/{id})"""
+    session_id = st.session_state.get("verify_session_id")
+    if session_id:
+        update = {"text_input": prescription_data["text_input"], "patient": prescription_data["patient"]}
+        result, error = stream_api(f"/sessions/{session_id}?stream=true", on_stage, method="PUT", json=update)
+        if not error:
+            return result["verification"], None
+        # Session expired or was evicted: start a new one below
+
+    result, error = stream_api("/sessions?stream=true", on_stage, json=prescription_data)
+    if error:
+        return None, error
+    st.session_state.verify_session_id = result["session_id"]
+    return result["verification"], None
+
 # Initialize session state
 if 'analysis_step' not in st.session_state:
     st.session_state.analysis_step = 0
@@ -429,14 +573,24 @@ if input_method == "📷 Upload Prescription Image":
     )
     
     if uploaded_file is not None:
-        image = Image.open(uploaded_file)
-        st.image(image, caption="Uploaded Prescription", use_column_width=True)
+        # Raw bytes: no PIL decode on reruns, and the browser does the rendering
+        st.image(uploaded_file.getvalue(), caption="Uploaded Prescription", use_column_width=True)
         
         if st.button("🔍 Extract Text from Image", key="extract_btn"):
             with st.spinner("🔍 Extracting text from image using AI..."):
-                extracted_text, error = extract_text_from_image_api(uploaded_file)
+                patient = build_patient_payload(age, weight, allergies, conditions)
+                on_stage, clear_progress = progress_reporter(ANALYZE_IMAGE_STAGES)
+                analysis, error = analyze_image_api(uploaded_file, patient, on_stage)
+                clear_progress()
+                extracted_text = analysis["extracted_text"] if analysis else None
                 if extracted_text:
                     st.session_state.extracted_text = extracted_text
+                    # Keep the server-side verdict; it is reused as long as the text and patient are unchanged
+                    st.session_state.image_analysis = {
+                        "text": extracted_text,
+                        "patient": patient,
+                        "verification": analysis["verification"],
+                    }
                     st.markdown("""
                     <div class="success-alert">
                         <strong>✅ Text Extracted Successfully!</strong> Review and edit the extracted text below if needed.
@@ -444,6 +598,8 @@ if input_method == "📷 Upload Prescription Image":
                     """, unsafe_allow_html=True)
                     prescription_text = extracted_text
                 else:
+                    if not error:
+                        error = "No text could be extracted from the image"
                     st.markdown(f"""
                     <div class="error-alert">
                         <strong>❌ Extraction Error:</strong> {error}
@@ -486,45 +642,29 @@ if age and age > 0:
         if st.button("🚀 View Analysed Prescription", key="verify_btn"):
             # Prepare the request payload
             prescription_data = {
-                "patient": {
-                    "age": age,
-                    "weight_kg": weight,
-                    "allergies": [a.strip() for a in allergies.split(',') if a.strip()],
-                    "conditions": [c.strip() for c in conditions.split(',') if c.strip()]
-                },
+                "patient": build_patient_payload(age, weight, allergies, conditions),
                 "drugs": [],  # Will be extracted from text by backend
                 "text_input": prescription_text
             }
             
-            # Simulate analysis process with progress
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            steps = [
-                "Connecting to AI analysis engine...",
-                "Extracting drug information...",
-                "Analyzing drug interactions...",
-                "Checking dosage recommendations...",
-                "Generating safety report..."
-            ]
-            
-            for i, step in enumerate(steps):
-                status_text.text(step)
-                progress_bar.progress((i + 1) / len(steps))
-                time.sleep(0.5)
-            
-            # Call the API
-            with st.spinner("🧠 AI is analyzing your prescription for safety and interactions..."):
-                result, error = verify_prescription_api(prescription_data)
-            
-            status_text.empty()
-            progress_bar.empty()
+            image_analysis = st.session_state.get("image_analysis")
+            if (input_method == "📷 Upload Prescription Image" and image_analysis
+                    and image_analysis["text"] == prescription_text
+                    and image_analysis["patient"] == prescription_data["patient"]):
+                # Text was not edited since extraction: the verdict computed with the OCR is still valid
+                result, error = image_analysis["verification"], None
+            else:
+                # Call the API; progress follows the real backend stages
+                on_stage, clear_progress = progress_reporter(VERIFY_STAGES)
+                with st.spinner("🧠 AI is analyzing your prescription for safety and interactions..."):
+                    result, error = verify_prescription_api(prescription_data, on_stage)
+                clear_progress()
             
             if error:
                 st.markdown(f"""
                 <div class="error-alert">
                     <strong>❌ Analysis Error:</strong> {error}<br>
-                    <strong>💡 Tip:</strong> Make sure the backend API is running on http://localhost:8000
+                    <strong>💡 Tip:</strong> Make sure the backend API is running on {API_URLS[0]}
                 </div>
                 """, unsafe_allow_html=True)
             else: